@@ -1,14 +1,24 @@
 from __future__ import absolute_import
 
+import Queue
+import collections
+import logging
+import multiprocessing
 import signal
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 from metaclasses.singleton_wrapper import SingletonWrapper
 from models.paramiko_model import ParamikoModel
 from models.remote_execution_template import RemoteExecutionTemplate
+from networkobjects.command import Command
 from networkobjects.connection import Connection
+from networkobjects.exec_result_reduced import ReducedExecResult
 from networkobjects.host import Host
 from networkobjects.user import User
-from executor_exceptions import InvalidModelException
+from executor_exceptions import DispatchError, ExecutorException, InvalidCommandValue, InvalidModelException, \
+    RollingAborted, WaitTimeout
 
 __author__ = 'mlesko'
 __all_ = ['Executor']
@@ -17,6 +27,7 @@ __all_ = ['Executor']
 class Executor(object):
     __metaclass__ = SingletonWrapper
     active_connection = None
+    dispatch_parallelism = 64  # maximal number of connections dispatched at once by *_everywhere and connect_all
 
     def __init__(self, model=ParamikoModel):
         if model is None or not issubclass(model, RemoteExecutionTemplate):
@@ -56,15 +67,16 @@ class Executor(object):
         """
         return iter(User)
 
-    def create_command(self, command):
+    def create_command(self, command, **kwargs):
         """
         Creates a command object.
         @param command: command to execute
         @type command: str
+        @param kwargs: optional attributes of the command, e.g. capture policy, see L{Command.__init__}
         @return: command object
         @rtype: L{dtestlib.executor.dataobjects.command.Command}
         """
-        return self.model.create_command(command=command)
+        return self.model.create_command(command=command, **kwargs)
 
     def execute(self, command=None, connection=None):
         """
@@ -118,19 +130,23 @@ class Executor(object):
         self.wait(results)
         return results
 
-    def execute_everywhere(self, command=None):
+    def execute_everywhere(self, command=None, parallelism=None, errors=None):
         """
-        Executes command on every available connection
+        Executes command on every available connection. Connections are dispatched in parallel,
+        so the dispatch takes roughly one round trip instead of one round trip per connection.
         @param command: command to execute
         @type command: str or L{dtestlib.executor.dataobjects.command.Command}
+        @param parallelism: maximal number of connections dispatched at once, None means L{dispatch_parallelism}
+        @type parallelism: int
+        @param errors: if provided, failed connections are stored into it with the raised exception
+            and they are omitted from the returned list, otherwise L{DispatchError} is raised
+        @type errors: dict
         @return: list of result objects L{dtestlib.executor.networkobjects_tests.exec_result.ExecResult} with provided API
         @rtype: list
+        @raise DispatchError: if dispatch failed on some connection and errors are not collected
         """
-        res_list = []
-        for connection in Connection:
-            result = self.model.execute(command=command, connection=connection)
-            res_list.append(result)
-        return res_list
+        return self._dispatch(lambda connection: self.model.execute(command=command, connection=connection),
+                              list(Connection), parallelism, errors)
 
     def execute_everywhere_wait(self, command=None):
         """
@@ -144,19 +160,70 @@ class Executor(object):
         self.wait(res_list)
         return res_list
 
-    def execute_batch_everywhere(self, commands=()):
+    def execute_batch_everywhere(self, commands=(), parallelism=None, errors=None):
         """
-        Executes a set of commands on every available connection
+        Executes a set of commands on every available connection. Connections are dispatched in parallel,
+        see L{execute_everywhere}.
         @param command: A set of commands to be executed
         @type command: iterable
+        @param parallelism: maximal number of connections dispatched at once, None means L{dispatch_parallelism}
+        @type parallelism: int
+        @param errors: if provided, failed connections are stored into it with the raised exception
+            and they are omitted from the returned list, otherwise L{DispatchError} is raised
+        @type errors: dict
         @return: list of lists of result objects L{dtestlib.executor.networkobjects_tests.exec_result.ExecResult} with provided API
         @rtype: list
+        @raise DispatchError: if dispatch failed on some connection and errors are not collected
         """
-        res_list = []
-        for connection in Connection:
-            results = self.model.execute_batch(commands=commands, connection=connection)
-            res_list.append(results)
-        return res_list
+        commands = list(commands)  # iterated once per connection
+        return self._dispatch(lambda connection: self.model.execute_batch(commands=commands, connection=connection),
+                              list(Connection), parallelism, errors)
+
+    def _dispatch(self, dispatch_func, connections, parallelism=None, errors=None):
+        """
+        Calls the dispatch function for every connection using a bounded number of threads.
+        Failure of one connection does not affect the others.
+        @param dispatch_func: function taking the connection and returning its result(s)
+        @param connections: connections to dispatch
+        @type connections: list
+        @param parallelism: maximal number of concurrent calls, None means L{dispatch_parallelism}
+        @type parallelism: int
+        @param errors: dictionary for failed connections, see L{execute_everywhere}
+        @type errors: dict
+        @return: results in the order of connections
+        @rtype: list
+        @raise DispatchError: if some call failed and errors are not collected
+        """
+        if not connections:
+            return []
+        if parallelism is None:
+            parallelism = self.dispatch_parallelism
+        if parallelism < 1:
+            raise ValueError("parallelism must be a positive number")
+
+        def dispatch(connection):
+            try:
+                return dispatch_func(connection), None
+            except Exception as e:
+                return None, e
+
+        pool = ThreadPool(processes=min(parallelism, len(connections)))
+        try:
+            outcomes = pool.map(dispatch, connections)
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = dict((connection, error) for connection, (_, error) in zip(connections, outcomes)
+                      if error is not None)
+        if errors is not None:
+            errors.update(failed)
+            return [result for result, error in outcomes if error is None]
+        results = [result for result, _ in outcomes]
+        if failed:
+            raise DispatchError("dispatch failed on %s of %s connections" % (len(failed), len(connections)),
+                                results=results, errors=failed)
+        return results
 
     def execute_batch_everywhere_wait(self, commands=()):
         """
@@ -170,14 +237,360 @@ class Executor(object):
         self.wait(res_list)
         return res_list
 
+    def execute_sharded(self, command=None, processes=None, parallelism=None, timeout=None, errors=None):
+        """
+        Executes command on every available connection using a pool of worker processes, so encryption
+        of many transports is not limited by one interpreter. Connections are spread among the workers,
+        every worker connects its share by its own model, executes the command and waits for the results.
+        Results are shipped back in the picklable reduced form.
+        @param command: command to execute, only its string and capture policy are used by workers
+        @type command: str or L{dtestlib.executor.dataobjects.command.Command}
+        @param processes: number of worker processes, None means the number of CPUs
+        @type processes: int
+        @param parallelism: maximal number of connections dispatched at once by one worker, None means
+            L{dispatch_parallelism}
+        @type parallelism: int
+        @param timeout: timeout in seconds of the connection establishment, None means the default of the model
+        @type timeout: float
+        @param errors: if provided, failed connections are stored into it with the exception describing
+            the failure and they are omitted from the returned list, otherwise L{DispatchError} is raised
+        @type errors: dict
+        @return: list of L{ReducedExecResult} in the order of connections
+        @rtype: list
+        @raise DispatchError: if some connection failed and errors are not collected
+        """
+        if isinstance(command, basestring):
+            command = self.create_command(command)
+        if not isinstance(command, Command):
+            raise InvalidCommandValue("command must be the string or an instance of the Command class")
+        connections = list(Connection)
+        if not connections:
+            return []
+        processes = min(processes or multiprocessing.cpu_count(), len(connections))
+        spec = (command.cmd, command.capture, command.capture_limit)
+        shards = [(spec, [(position, _connection_spec(connection)) for position, connection in
+                          list(enumerate(connections))[shard::processes]], parallelism, timeout)
+                  for shard in xrange(processes)]
+        pool = multiprocessing.Pool(processes=processes, initializer=_init_shard_worker)
+        try:
+            outcomes = pool.map(_run_shard, shards)
+        finally:
+            pool.close()
+            pool.join()
+
+        results = [None] * len(connections)
+        failed = dict()
+        for shard_results, shard_errors in outcomes:
+            for position, result in shard_results:
+                result.connection = connections[position]
+                results[position] = result
+            for position, message in shard_errors:
+                failed[connections[position]] = ExecutorException(message)
+        if errors is not None:
+            errors.update(failed)
+            return [result for result in results if result is not None]
+        if failed:
+            raise DispatchError("execution failed on %s of %s connections" % (len(failed), len(connections)),
+                                results=results, errors=failed)
+        return results
+
+    def execute_rolling(self, command=None, batch_size=1, max_failure_rate=None, errors=None):
+        """
+        Executes command on every available connection in waves. Connections of one wave are dispatched
+        in parallel, the next wave starts as soon as all results of the previous one are available.
+        The command fails on the connection if it can't be dispatched or its exit code is not zero.
+        @param command: command to execute
+        @type command: str
+        @param batch_size: number of connections in one wave or a percentage of all connections, e.g. "10%"
+        @type batch_size: int | str
+        @param max_failure_rate: maximal ratio (0.0 - 1.0) of failed connections to processed connections,
+            when it is exceeded no further wave is started, None means no limit
+        @type max_failure_rate: float
+        @param errors: if provided, connections which could not be dispatched are stored into it with the raised exception
+        @type errors: dict
+        @return: list of result objects L{dtestlib.executor.networkobjects_tests.exec_result.ExecResult}
+            of dispatched connections
+        @rtype: list
+        @raise RollingAborted: if the failure rate exceeded the maximum before all connections were processed
+        """
+        connections = list(Connection)
+        batch_size = self._wave_size(batch_size, len(connections))
+        results = []
+        failures = 0
+        for start in xrange(0, len(connections), batch_size):
+            wave = connections[start:start + batch_size]
+            wave_errors = dict()
+            wave_results = self._dispatch(lambda connection: self.model.execute(command=command, connection=connection),
+                                          wave, errors=wave_errors)
+            self.wait_all(wave_results)
+            results.extend(wave_results)
+            if errors is not None:
+                errors.update(wave_errors)
+            failures += len(wave_errors) + len([result for result in wave_results if result.ecode != 0])
+            processed = start + len(wave)
+            if max_failure_rate is not None and processed < len(connections) and \
+                    float(failures) / processed > max_failure_rate:
+                raise RollingAborted("%s of %s processed connections failed" % (failures, processed),
+                                     results=results, skipped=connections[processed:])
+        return results
+
+    @staticmethod
+    def _wave_size(batch_size, count):
+        """
+        @param batch_size: number of connections or a percentage of them, see L{execute_rolling}
+        @type batch_size: int | str
+        @param count: number of all connections
+        @type count: int
+        @return: number of connections in one wave, at least one
+        @rtype: int
+        """
+        if isinstance(batch_size, basestring) and batch_size.endswith("%"):
+            batch_size = int(count * float(batch_size[:-1]) / 100)
+            return max(batch_size, 1)
+        if not isinstance(batch_size, (int, long)) or batch_size < 1:
+            raise ValueError("batch_size must be a positive number or a percentage")
+        return batch_size
+
+    def execute_farm(self, commands=(), connections=None, slots=1, errors=None):
+        """
+        Distributes independent commands among connections. Every connection runs at most C{slots} commands
+        at once and the next command is dispatched to whichever connection finished first, so slow hosts
+        do not hold back the fast ones. The generator dispatches commands while it is iterated.
+        If the command can't be dispatched due to the connection (see C{connection_errors} of the model),
+        the connection is removed from the farm and the command is dispatched to another connection.
+        Other failures are errors of the command itself, the command is skipped.
+        @param commands: commands to execute
+        @type commands: iterable
+        @param connections: connections to use, None means every available connection
+        @type connections: iterable
+        @param slots: number of commands running at once on one connection
+        @type slots: int
+        @param errors: if provided, connections removed from the farm and skipped commands are stored into it
+            with the raised exception
+        @type errors: dict
+        @return: generator of results in the order of their completion
+        @rtype: generator
+        @raise DispatchError: if all connections were removed from the farm before all commands were dispatched,
+            or at the end if some commands were skipped and errors are not collected
+        """
+        connections = list(Connection) if connections is None else list(connections)
+        if slots < 1:
+            raise ValueError("slots must be a positive number")
+        free = collections.deque(connections * slots)  # one item per free slot, connections are interleaved
+        pending = collections.deque(commands)
+        broken = dict()
+        failed = dict()  # command -> exception
+        finished = Queue.Queue()
+        running = 0
+        while pending or running:
+            while pending and free:
+                connection = free.popleft()
+                if connection in broken:
+                    continue
+                try:
+                    result = self.model.execute(command=pending[0], connection=connection)
+                except Exception as e:
+                    if isinstance(e, self.model.connection_errors):
+                        broken[connection] = e
+                        key = connection
+                    else:  # the command itself is wrong, the connection is used for the next one
+                        key = pending.popleft()
+                        failed[key] = e
+                        free.appendleft(connection)
+                    if errors is not None:
+                        errors[key] = e
+                    continue
+                pending.popleft()
+                result.add_done_callback(finished.put)
+                running += 1
+            if not running and not pending:  # the rest of commands failed
+                break
+            if not running:
+                raise DispatchError("%s commands left, no connection is usable" % len(pending), errors=broken)
+            result = finished.get()
+            running -= 1
+            free.append(result.connection)
+            yield result
+        if failed and errors is None:
+            raise DispatchError("%s commands could not be executed" % len(failed), errors=failed)
+
+    def execute_graph(self, nodes=(), errors=None):
+        """
+        Executes commands with dependencies, possibly spread over several connections, and waits for them.
+        Dependencies are given by C{depends_on} of the L{Command}. A command is executed as soon as all
+        its dependencies finished with zero exit code, so independent branches run in parallel.
+        Dependents of a failed command are not executed at all.
+        @param nodes: pairs (command, connection), command given by the string has no dependencies
+        @type nodes: iterable
+        @param errors: if provided, commands which could not be executed are stored into it with the raised
+            exception, otherwise L{DispatchError} is raised once the graph is finished
+        @type errors: dict
+        @return: list of results in the order of nodes, None for commands which were not executed
+        @rtype: list
+        @raise InvalidCommandValue: if a dependency is not part of the graph or dependencies form a cycle
+        @raise DispatchError: if some command could not be executed and errors are not collected
+        """
+        nodes = [(command if isinstance(command, Command) else self.create_command(command), connection)
+                 for command, connection in nodes]
+        index = dict((id(command), position) for position, (command, _) in enumerate(nodes))
+        dependents = [[] for _ in nodes]
+        waiting = [len(command.depends_on) for command, _ in nodes]  # number of unfinished dependencies
+        for position, (command, _) in enumerate(nodes):
+            for dependency in command.depends_on:
+                if id(dependency) not in index:
+                    raise InvalidCommandValue("dependency %s of %s is not in the graph" % (dependency.cmd, command.cmd))
+                dependents[index[id(dependency)]].append(position)
+        self._check_acyclic(dependents, waiting)
+
+        results = [None] * len(nodes)
+        failed = dict()
+        finished = Queue.Queue()
+        ready = [position for position, count in enumerate(waiting) if count == 0]
+        running = 0
+        while ready or running:
+            for position in ready:
+                command, connection = nodes[position]
+                try:
+                    results[position] = self.model.execute(command=command, connection=connection)
+                except Exception as e:
+                    failed[command] = e
+                    continue
+                results[position].add_done_callback(lambda result, position=position: finished.put(position))
+                running += 1
+            ready = []
+            if running:
+                position = finished.get()
+                running -= 1
+                if results[position].ecode == 0:
+                    for dependent in dependents[position]:
+                        waiting[dependent] -= 1
+                        if waiting[dependent] == 0:
+                            ready.append(dependent)
+
+        if errors is not None:
+            errors.update(failed)
+        elif failed:
+            raise DispatchError("%s of %s commands could not be executed" % (len(failed), len(nodes)),
+                                results=results, errors=failed)
+        return results
+
+    @staticmethod
+    def _check_acyclic(dependents, waiting):
+        """
+        Checks that the graph of dependencies has no cycle.
+        @param dependents: list of positions of dependent nodes for every node
+        @type dependents: list
+        @param waiting: number of dependencies of every node
+        @type waiting: list
+        @raise InvalidCommandValue: if dependencies form a cycle
+        """
+        waiting = list(waiting)
+        ready = [position for position, count in enumerate(waiting) if count == 0]
+        visited = 0
+        while ready:
+            position = ready.pop()
+            visited += 1
+            for dependent in dependents[position]:
+                waiting[dependent] -= 1
+                if waiting[dependent] == 0:
+                    ready.append(dependent)
+        if visited != len(waiting):
+            raise InvalidCommandValue("dependencies of commands form a cycle")
+
     def wait(self, results=[]):
-        # TODO naive approach
-        if len(results) > 0 and hasattr(results[0], "__iter__"):
-            for result_list in results:
-                self.wait(result_list)
-        else:
+        """
+        Waits till all results are available
+        @param results: list of results or list of lists of results (see L{execute_batch_everywhere})
+        @type results: list
+        @rtype: None
+        """
+        self.wait_all(results)
+
+    @staticmethod
+    def _flatten(results):
+        """
+        Flattens nested lists of results
+        @param results: list of results or list of lists of results
+        @type results: list
+        @return: list of results
+        @rtype: list
+        """
+        flat = []
+        for result in results:
+            if hasattr(result, "__iter__"):
+                flat.extend(Executor._flatten(result))
+            else:
+                flat.append(result)
+        return flat
+
+    def as_completed(self, results=(), timeout=None):
+        """
+        Iterates over results in the order of their completion
+        @param results: list of results or list of lists of results (see L{execute_batch_everywhere})
+        @type results: list
+        @param timeout: maximal time in seconds to wait for all results, None means no limit
+        @type timeout: float
+        @return: generator of available results
+        @rtype: generator
+        @raise WaitTimeout: if results are not available in time
+        """
+        results = self._flatten(results)
+        done = Queue.Queue()
+        for result in results:
+            result.add_done_callback(done.put)
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            for _ in xrange(len(results)):
+                try:
+                    if deadline is None:
+                        yield done.get()
+                    else:
+                        yield done.get(timeout=max(deadline - time.time(), 0))
+                except Queue.Empty:
+                    raise WaitTimeout("results were not available in %s seconds" % timeout)
+        finally:  # iteration ended early, callbacks of pending results are not needed anymore
             for result in results:
+                result.remove_done_callback(done.put)
+
+    def wait_any(self, results=(), timeout=None):
+        """
+        Waits till any of results is available
+        @param results: list of results or list of lists of results (see L{execute_batch_everywhere})
+        @type results: list
+        @param timeout: maximal time to wait in seconds, None means no limit
+        @type timeout: float
+        @return: first available result or None if no result is available in time
+        @rtype: L{dtestlib.executor.networkobjects_tests.exec_result.ExecResult}
+        """
+        completed = self.as_completed(results, timeout)
+        try:
+            for result in completed:
+                return result
+        except WaitTimeout:
+            pass
+        finally:
+            completed.close()
+        return None
+
+    def wait_all(self, results=(), timeout=None):
+        """
+        Waits till all results are available or the timeout expires
+        @param results: list of results or list of lists of results (see L{execute_batch_everywhere})
+        @type results: list
+        @param timeout: maximal time to wait in seconds, None means no limit
+        @type timeout: float
+        @return: tuple of sets (done, pending)
+        @rtype: tuple
+        """
+        results = self._flatten(results)
+        deadline = None if timeout is None else time.time() + timeout
+        for result in results:
+            if deadline is None:
                 result.wait_for_data()
+            elif not result.wait_for_data(max(deadline - time.time(), 0)):
+                break
+        done = set(result for result in results if result.result_available)
+        return done, set(results) - done
 
     def kill(self, command, sig=signal.SIGTERM):
         """
@@ -198,18 +611,111 @@ class Executor(object):
         """
         return self.model.create_connection(host=host, user=user)
 
-    def connect(self, connection=None):
+    def connect(self, connection=None, timeout=None):
         """
         Connects via underlying module using specified connection object
         @param connection: connection object
         @type connection: L{dtestlib.executor.networkobjects_tests.connection.Connection}
+        @param timeout: timeout in seconds of the connection establishment, None means the default of the model
+        @type timeout: float
         @return: None
         @rtype: None
         """
-        self.model.connect(connection=connection)
+        self.model.connect(connection=connection, timeout=timeout)
+
+    def connect_all(self, connections=None, parallelism=None, timeout=None):
+        """
+        Connects many connections concurrently. Failure of one connection does not affect the others.
+        @param connections: connections to connect, None means every available connection
+        @type connections: iterable
+        @param parallelism: maximal number of concurrent handshakes, None means L{dispatch_parallelism}
+        @type parallelism: int
+        @param timeout: timeout in seconds of the connection establishment, None means the default of the model
+        @type timeout: float
+        @return: mapping of connections to None if connected successfully or to the raised exception
+        @rtype: dict
+        """
+        connections = list(Connection) if connections is None else list(connections)
+        errors = dict()
+        self._dispatch(lambda connection: self.model.connect(connection=connection, timeout=timeout),
+                       connections, parallelism, errors)
+        return dict((connection, errors.get(connection)) for connection in connections)
 
     def get_connection(self, host=None, user=None):
         return self.model.get_connection(host=host, user=user)
 
     def close_connection(self, connection=None):
         return self.model.close_connection(connection=connection)
+
+
+def _init_shard_worker():
+    """
+    Initializer of the worker process of L{Executor.execute_sharded}. Connections and threads
+    inherited from the controller are not usable, the worker creates its own. Python 2 can only fork
+    the workers, so locks which could be held by threads of the controller at fork time are recreated.
+    """
+    logging._lock = threading.RLock()  # done by the interpreter itself since Python 3.7
+    for reference in logging._handlerList:
+        handler = reference()
+        if handler is not None:
+            handler.createLock()
+    Executor().model._reset_after_fork()  # inherited connections are detached before they are forgotten
+    for network_class in (Connection, Host, User):
+        if hasattr(network_class, "__pool__"):
+            network_class.__pool__.clear()
+
+
+def _connection_spec(connection):
+    """
+    Picklable settings of the connection, its host and its user, so the worker can create the same connection.
+    @type connection: Connection
+    @return: host, user and connection settings
+    @rtype: tuple
+    """
+    host, user = connection.host, connection.user
+    return ((host.address, host.port, host.transport_profile),
+            (user.username, user.password, user.key_filename, user.passphrase, user.allow_agent),
+            (connection.session_mode, connection.channel_pool_size))
+
+
+def _run_shard(shard):
+    """
+    Connects the share of connections, executes the command on them and waits for the results.
+    @param shard: command specification, connection specifications, parallelism and connection timeout
+    @type shard: tuple
+    @return: list of (position, reduced result) and list of (position, failure description)
+    @rtype: tuple
+    """
+    (cmd, capture, capture_limit), specs, parallelism, timeout = shard
+    executor = Executor()
+    positions = dict()
+    for position, ((address, port, transport_profile), user_spec, (session_mode, channel_pool_size)) in specs:
+        host = Host(address, port)
+        host.transport_profile = transport_profile
+        connection = executor.create_connection(host, User(*user_spec))
+        connection.session_mode = session_mode
+        connection.channel_pool_size = channel_pool_size
+        positions[connection] = position
+    report = executor.connect_all(positions.keys(), parallelism, timeout)
+    failed = [(positions[connection], "connect: %r" % error) for connection, error in report.items()
+              if error is not None]
+    connected = [connection for connection, error in report.items() if error is None]
+
+    def execute(connection):
+        command = executor.create_command(cmd, capture=capture, capture_limit=capture_limit)
+        return executor.model.execute(command=command, connection=connection)
+
+    dispatch_errors = dict()
+    results = executor._dispatch(execute, connected, parallelism, dispatch_errors)
+    failed.extend((positions[connection], "execute: %r" % error) for connection, error in dispatch_errors.items())
+    executor.wait_all(results)
+    for connection in positions:
+        try:
+            executor.close_connection(connection)
+        except Exception:
+            pass  # worker is going to end anyway
+    reduced = []
+    for result in results:
+        reduced.append((positions[result.connection], ReducedExecResult.from_result(result)))
+        result.close()  # e.g. temporary files of the spilled output
+    return reduced, failed
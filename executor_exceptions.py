@@ -39,6 +39,18 @@ class InvalidConnection(ConnectionException):
     pass
 
 
+class HandshakeThrottled(ConnectionException):
+    pass
+
+
+class DeadTransport(ConnectionException):
+    pass
+
+
+class SessionClosed(ConnectionException):
+    pass
+
+
 # ************** Command's Exceptions **************
 class CommandException(ExecutorException):
     pass
@@ -65,6 +77,10 @@ class InvalidPortValue(HostException):
     pass
 
 
+class InvalidTransportProfile(HostException):
+    pass
+
+
 # ************** User's Exceptions **************
 class UserException(ExecutorException):
     pass
@@ -87,6 +103,53 @@ class InvalidModelException(ModelException):
     pass
 
 
+class AgentError(ModelException):
+    pass
+
+
 # ************** Result's Exceptions **************
 class MissingFunctionDefinition(MissingDefinitionException):
     pass
+
+
+class WaitTimeout(ExecutorException):
+    pass
+
+
+# ************** Executor's Exceptions **************
+class DispatchError(ExecutorException):
+    """
+    Dispatch failed on some connections. Results of successful connections are still available.
+    """
+
+    def __init__(self, message, results=None, errors=None):
+        """
+        @param message: description of the failure
+        @type message: str
+        @param results: results of all connections, None for the failed ones
+        @type results: list
+        @param errors: mapping of failed connections to raised exceptions
+        @type errors: dict
+        """
+        super(DispatchError, self).__init__(message)
+        self.results = results if results is not None else []
+        self.errors = errors if errors is not None else {}
+
+
+class RollingAborted(ExecutorException):
+    """
+    Rolling execution was stopped because too many connections failed.
+    """
+
+    def __init__(self, message, results=None, skipped=None):
+        """
+        @param message: description of the failure
+        @type message: str
+        @param results: results of connections processed before the abort
+        @type results: list
+        @param skipped: connections which were not processed
+        @type skipped: list
+        """
+        super(RollingAborted, self).__init__(message)
+        self.results = results if results is not None else []
+        self.skipped = skipped if skipped is not None else []
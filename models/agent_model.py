@@ -0,0 +1,268 @@
+from . import logger
+
+__author__ = 'mlesko'
+
+import inspect
+import signal
+import threading
+
+import remote_agent
+from executor_exceptions import *
+from networkobjects.command import Command
+from paramiko_model import ParamikoModel
+from remote_agent import CODE, EXIT, ERROR, HEADER, KILL, READY, SPAWN, STARTED, STDERR, STDOUT
+
+
+class AgentSession(object):
+    """
+    Model side of the L{remote_agent} running on one channel. Commands of many results are multiplexed
+    over the channel, every message carries the id of its command (see the protocol in L{remote_agent}).
+    Messages submitted before the agent is ready are held back, so they are not consumed by its bootstrap,
+    they are sent by a separate thread once the agent reports it is ready.
+
+    Like L{ShellSession}, the session does not read the channel itself, the owner feeds it with received data.
+    """
+    source = inspect.getsource(remote_agent)
+
+    def __init__(self, channel, on_close=None):
+        """
+        @param channel: channel with the bootstrap command (see L{bootstrap}) executed, only its C{sendall} is used
+        @param on_close: function without arguments called once the session ends
+        """
+        self.channel = channel
+        self.closed = False
+        self.error = None
+        self.ready = False
+        self.__on_close = on_close
+        self.__lock = threading.Lock()
+        self.__counter = 0
+        self.__entries = dict()  # id -> SessionEntry
+        self.__backlog = []  # messages waiting for the agent, they are sent before any newer message
+        self.__buffer = ""
+
+    def __len__(self):
+        """
+        @return: number of unfinished commands
+        @rtype: int
+        """
+        return len(self.__entries)
+
+    @classmethod
+    def bootstrap(cls, python):
+        """
+        @param python: interpreter on the remote host
+        @type python: str
+        @return: command which reads the agent from the stdin and runs it
+        @rtype: str
+        """
+        return "%s -c 'import sys; exec(sys.stdin.read(%d))'" % (python, len(cls.source))
+
+    def start(self):
+        """
+        Sends the source of the agent.
+        @rtype: None
+        """
+        self.channel.sendall(self.source)
+
+    def __send(self, message):
+        if self.ready:
+            self.channel.sendall(message)
+        else:
+            self.__backlog.append(message)
+
+    def __flush_backlog(self):
+        while True:
+            with self.__lock:
+                backlog, self.__backlog = self.__backlog, []
+                if not backlog:
+                    self.ready = True
+                    return
+            try:
+                self.channel.sendall("".join(backlog))
+            except Exception as e:
+                self.fail(AgentError("messages could not be sent to the agent: %r" % e))
+                return
+
+    def submit(self, command, entry):
+        """
+        Asks the agent to spawn the command. Commands are not waited for, they run concurrently.
+        @param command: command to execute
+        @type command: str
+        @param entry: entry which receives the pid, output and exit code of the command
+        @type entry: SessionEntry
+        @raise Exception: if the session is closed or the command can't be written
+        """
+        if isinstance(command, unicode):
+            command = command.encode("utf-8")
+        with self.__lock:
+            if self.closed:
+                raise self.error
+            self.__counter += 1
+            entry.seq = self.__counter
+            self.__entries[entry.seq] = entry
+            try:
+                self.__send(HEADER.pack(SPAWN, entry.seq, len(command)) + command)
+            except Exception as e:
+                del self.__entries[entry.seq]
+                raise e
+
+    def kill(self, pid, sig=signal.SIGTERM):
+        """
+        Sends the signal to the process group of the command.
+        @param pid: process id of the command
+        @type pid: int
+        @param sig: signal to send
+        @type sig: int
+        @return: True if the command is running in the session
+        @rtype: bool
+        """
+        with self.__lock:
+            for seq, entry in self.__entries.items():
+                if entry.pid == pid:
+                    self.__send(HEADER.pack(KILL, seq, CODE.size) + CODE.pack(sig))
+                    return True
+        return False
+
+    def feed_stdout(self, data):
+        """
+        Processes messages received from the agent.
+        @type data: str
+        @rtype: None
+        """
+        updated = []
+        with self.__lock:
+            buf = self.__buffer + data
+            while len(buf) >= HEADER.size:
+                kind, seq, length = HEADER.unpack(buf[:HEADER.size])
+                if len(buf) < HEADER.size + length:
+                    break
+                payload = buf[HEADER.size:HEADER.size + length]
+                buf = buf[HEADER.size + length:]
+                if kind == READY:  # the backlog is not sent by the thread feeding the session
+                    flusher = threading.Thread(target=self.__flush_backlog, name="agent-backlog")
+                    flusher.daemon = True
+                    flusher.start()
+                    continue
+                entry = self.__entries.get(seq)
+                if entry is None:
+                    logger.debug("Agent message %s of unknown command %s dropped" % (kind, seq))
+                    continue
+                if kind == STARTED:
+                    entry.pid = CODE.unpack(payload)[0]
+                elif kind in (STDOUT, STDERR):
+                    entry._feed("stdout" if kind == STDOUT else "stderr", payload)
+                elif kind in (EXIT, ERROR):
+                    if kind == EXIT:
+                        entry.ecode = CODE.unpack(payload)[0]
+                    else:
+                        entry.error = AgentError("command could not be started: %s" % payload)
+                    entry._feed("stdout", eof=True)
+                    entry._feed("stderr", eof=True)
+                    del self.__entries[seq]
+                if entry not in updated:
+                    updated.append(entry)
+            self.__buffer = buf
+        for entry in updated:
+            self.__notify(entry)
+
+    def feed_stderr(self, data):
+        """
+        Standard error output of the agent itself, it is only logged.
+        @type data: str
+        @rtype: None
+        """
+        logger.debug("Agent: %s" % data.rstrip())
+
+    def fail(self, error):
+        """
+        Ends the session, unfinished commands fail with the error.
+        @param error: reason of the end
+        @type error: Exception
+        @rtype: None
+        """
+        with self.__lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.error = error
+            entries = [self.__entries[seq] for seq in sorted(self.__entries)]
+            self.__entries.clear()
+        logger.debug("Agent session ended: %r, %s commands failed" % (error, len(entries)))
+        for entry in entries:
+            entry.error = error
+            entry._feed("stdout", eof=True)
+            entry._feed("stderr", eof=True)
+            self.__notify(entry)
+        if self.__on_close is not None:
+            self.__on_close()
+
+    @staticmethod
+    def __notify(entry):
+        if entry.on_update is not None:
+            try:
+                entry.on_update()
+            except Exception:
+                logger.exception("Update of the agent command %s failed" % entry.seq)
+
+
+class AgentModel(ParamikoModel):
+    """
+    AgentModel class runs a small Python agent (see L{remote_agent}) on every connection and executes commands
+    through it. All commands of the connection are multiplexed over the one channel of the agent, so no channel
+    and no shell is started per command, and commands get their real pid.
+
+    Commands run concurrently, so exclusivity and priorities of commands make no difference. Killing
+    the command signals its whole process group.
+    Requires the Python interpreter (see L{agent_python}) on the remote host.
+    """
+    agent_python = "python"  # interpreter running the agent on the remote host
+
+    def execute(self, command=None, connection=None):
+        """
+        Execute command on the connection via its agent, the agent is started with the first command.
+        @param command: command to be executed
+        @type command: str | Command
+        @param connection: connection on which the command will be executed
+        @type connection: Connection
+        @return: result of the execution.
+        @rtype: ExecResult
+        @raise InvalidCommandValue: if command is not the L{Command} instance or an instance of the string
+        """
+        if not (isinstance(command, basestring) or isinstance(command, Command)):
+            raise InvalidCommandValue("command must be the string or an instance of the Command class")
+        conn = self._set_connection(connection)
+        if not isinstance(command, Command):
+            command = self.create_command(command)
+        command.connection = conn
+        return self.__execute_in_session__(command, conn)
+
+    def __start_session__(self, channel, on_close):
+        """
+        Starts the agent on the channel.
+        @param channel: opened channel
+        @type channel: paramiko.channel.Channel
+        @param on_close: function without arguments called once the session ends
+        @return: session of the agent
+        @rtype: AgentSession
+        """
+        channel.exec_command(AgentSession.bootstrap(self.agent_python))
+        session = AgentSession(channel, on_close=on_close)
+        session.start()
+        return session
+
+    def kill(self, command, sig=signal.SIGTERM):
+        """
+        Sends the signal to the command via the agent
+        @param command: command to be killed
+        @type command: L{dtestlib.executor.networkobjects_tests.command.Command}
+        @param sig: signal to send to the running process, see L{signal.py}
+        @type sig: int
+        @return: 0 if the signal was sent, 1 if the command is not running
+        @rtype: int
+        """
+        if not isinstance(command, Command):
+            raise InvalidCommandValue("cmd must be an instance of the Command class")
+        session = getattr(command.connection, "_shell_session", None)
+        if session is None or command.pid is None or not session.kill(command.pid, sig):
+            return 1
+        return 0
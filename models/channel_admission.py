@@ -0,0 +1,168 @@
+from . import logger
+
+__author__ = 'mlesko'
+
+import functools
+import heapq
+import itertools
+import threading
+
+from executor_exceptions import InvalidChannelException
+
+
+class ChannelAdmission(object):
+    """
+    Admission queue of one connection. It caps the number of channels opened at once (sshd refuses
+    sessions above its MaxSessions), commands above the limit are queued and dispatched as channels free up.
+    Queued tasks are admitted by their priority, tasks of the same priority in the order of submission.
+    Exclusive tasks are barriers: they wait till all previously submitted tasks are finished and no other
+    task is admitted till the exclusive one is finished, priority does not move a task across the barrier.
+    Only urgent tasks (see C{urgent_priority}) pass barriers, so e.g. the exclusive command can be killed.
+
+    A task is a function which opens the channel, it takes one argument telling whether the task
+    was queued (failure of the queued task can't be propagated to the submitter). The slot taken
+    by the task has to be returned by L{release} once its channel is finished. Queued tasks are started
+    by the runner, so the thread which releases the slot (typically a reactor thread) is not blocked
+    by opening the next channel.
+    """
+
+    def __init__(self, limit=None, runner=None, urgent_priority=None):
+        """
+        @param limit: maximal number of channels opened at once, None means no limit
+        @type limit: int
+        @param runner: function which runs the given task asynchronously, None means to run it in the releasing thread
+        @param urgent_priority: tasks with this or higher priority are not held back by exclusive tasks,
+            None means no task is urgent
+        @type urgent_priority: int
+        """
+        self.limit = limit
+        self.urgent_priority = urgent_priority
+        self.__runner = runner
+        self.__lock = threading.Lock()
+        self.__active = 0
+        self.__exclusive = False  # exclusive task is admitted
+        self.__queue = []  # heap of (epoch, exclusive, -priority, sequence number, task)
+        self.__counter = itertools.count()
+        self.__epoch = 0  # number of submitted barriers, tasks submitted after a barrier are admitted after it
+
+    def __len__(self):
+        """
+        @return: number of queued tasks
+        @rtype: int
+        """
+        with self.__lock:
+            return len(self.__queue)
+
+    @property
+    def active(self):
+        """
+        @return: number of taken slots
+        @rtype: int
+        """
+        return self.__active
+
+    def __urgent(self, priority):
+        return self.urgent_priority is not None and priority >= self.urgent_priority
+
+    def __admissible(self, entry):
+        _, exclusive, priority, _, _ = entry
+        if self.limit is not None and self.__active >= self.limit:
+            return False
+        if self.__exclusive:
+            return self.__urgent(-priority)
+        return not exclusive or self.__active == 0
+
+    def __admit(self):
+        """
+        Takes the slot for the first queued task if it can be admitted.
+        @return: task or None
+        """
+        if not self.__queue or not self.__admissible(self.__queue[0]):
+            return None
+        _, exclusive, _, _, task = heapq.heappop(self.__queue)
+        self.__active += 1
+        self.__exclusive = self.__exclusive or exclusive
+        return task
+
+    def submit(self, task, exclusive=False, priority=0):
+        """
+        Runs the task right away in the calling thread if it can be admitted, otherwise queues it.
+        Exceptions raised by the task which was run right away are propagated, its slot remains taken.
+        @param task: function taking the queued flag
+        @param exclusive: the task is a barrier
+        @type exclusive: bool
+        @param priority: tasks with higher priority are admitted first
+        @type priority: int
+        @return: True if the task was run right away, False if it was queued
+        @rtype: bool
+        """
+        with self.__lock:
+            # urgent tasks precede all epochs, the barrier is the last task of its epoch
+            epoch = -1 if self.__urgent(priority) and not exclusive else self.__epoch
+            heapq.heappush(self.__queue, (epoch, exclusive, -priority, next(self.__counter), task))
+            if exclusive:
+                self.__epoch += 1
+            admitted = self.__admit()
+            if admitted is None:
+                logger.debug("Channel admission postponed, %s tasks queued" % len(self.__queue))
+                return False
+        # nothing else could be admitted before, so the admitted task is the submitted one
+        admitted(False)
+        return True
+
+    def release(self, exclusive=False):
+        """
+        Returns the slot and starts queued tasks which can be admitted now.
+        @param exclusive: the finished task was exclusive
+        @type exclusive: bool
+        @rtype: None
+        """
+        with self.__lock:
+            self.__active -= 1
+            if exclusive:
+                self.__exclusive = False
+            tasks = self.__admit_all()
+        self.__run(tasks)
+
+    def resize(self, limit):
+        """
+        Changes the limit, queued tasks which can be admitted under the new limit are started.
+        @param limit: maximal number of channels opened at once, None means no limit
+        @type limit: int
+        @rtype: None
+        """
+        with self.__lock:
+            self.limit = limit
+            tasks = self.__admit_all()
+        self.__run(tasks)
+
+    def __admit_all(self):
+        tasks = []
+        task = self.__admit()
+        while task is not None:
+            tasks.append(task)
+            task = self.__admit()
+        return tasks
+
+    def __run(self, tasks):
+        for task in tasks:
+            if self.__runner is None:
+                task(True)
+            else:
+                self.__runner(functools.partial(task, True))
+
+
+class PendingChannel(object):
+    """
+    Placeholder of the channel which is opened when the command is admitted. It delegates everything
+    to the opened channel, so the result can be created and used before its channel exists.
+    """
+
+    def __init__(self):
+        self.channel = None
+
+    def __getattr__(self, item):
+        channel = self.__dict__.get("channel")
+        if channel is None:
+            raise InvalidChannelException("channel is not opened yet")
+        return getattr(channel, item)
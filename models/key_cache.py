@@ -0,0 +1,180 @@
+from . import logger
+
+__author__ = 'mlesko'
+
+import os
+import threading
+
+import paramiko
+
+
+class SharedAgent(object):
+    """
+    Keys of ssh-agent listed once and shared by all clients of the process. Client closes its agent
+    when it is closed, so closing is a no-op here, the connection to ssh-agent is kept for next clients.
+    Requests to ssh-agent of one connection can't be interleaved, so they are serialized by a lock.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__agent = None
+        self.__keys = None
+
+    def get_keys(self):
+        """
+        @return: keys of ssh-agent, they are listed on the first call
+        @rtype: tuple
+        """
+        with self.__lock:
+            if self.__keys is None:
+                agent = paramiko.Agent()
+                send = agent._send_message  # used by keys of the agent to sign
+                agent._send_message = lambda message: self.__send(send, message)
+                self.__agent = agent
+                self.__keys = agent.get_keys()
+                logger.debug("ssh-agent provides %s keys" % len(self.__keys))
+            return self.__keys
+
+    def __send(self, send, message):
+        with self.__lock:
+            return send(message)
+
+    def close(self):
+        pass
+
+    def _close(self):
+        """
+        Closes the connection to ssh-agent, keys are listed again by the next L{get_keys}.
+        @rtype: None
+        """
+        with self.__lock:
+            agent, self.__agent, self.__keys = self.__agent, None, None
+        if agent is not None:
+            agent.close()
+
+
+class KeyChain(object):
+    """
+    Source of keys given to the client in place of its ssh-agent, it offers keys of ssh-agent followed
+    by the additional keys, e.g. default keys of the user (see L{KeyCache.default_keys}).
+    """
+
+    def __init__(self, agent=None, keys=()):
+        """
+        @param agent: ssh-agent, None means no keys of ssh-agent are offered
+        @type agent: SharedAgent
+        @param keys: additional parsed keys
+        @type keys: list
+        """
+        self.agent = agent
+        self.keys = tuple(keys)
+
+    def get_keys(self):
+        """
+        @return: keys of ssh-agent and the additional keys
+        @rtype: tuple
+        """
+        return (tuple(self.agent.get_keys()) if self.agent is not None else ()) + self.keys
+
+    def close(self):
+        pass
+
+
+class KeyCache(object):
+    """
+    Process-wide cache of parsed private keys and the connection to ssh-agent, so connecting of many hosts
+    does not read, parse and decrypt the same key file again and again. A key file is parsed again
+    when it was modified. One connection to ssh-agent is shared by all threads (see L{SharedAgent}).
+    """
+    key_types = (paramiko.RSAKey, paramiko.ECDSAKey, paramiko.Ed25519Key, paramiko.DSSKey)
+    default_files = ("~/.ssh/id_rsa", "~/.ssh/id_dsa", "~/.ssh/id_ecdsa", "~/.ssh/id_ed25519")
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__keys = dict()  # (path, passphrase) -> (modification time, key, parse error)
+        self.__agent = SharedAgent()
+
+    def load(self, path, passphrase=None):
+        """
+        Provides the parsed private key. Failures of parsing are cached as well, till the file is modified.
+        @param path: path of the private key file
+        @type path: str
+        @param passphrase: passphrase of the encrypted key
+        @type passphrase: str
+        @return: private key
+        @rtype: paramiko.PKey
+        @raise paramiko.PasswordRequiredException: if the key is encrypted and the passphrase is missing
+        @raise paramiko.SSHException: if the file is not a supported private key
+        @raise IOError: if the file can't be read
+        """
+        path = os.path.realpath(os.path.expanduser(path))
+        mtime = os.stat(path).st_mtime
+        with self.__lock:  # concurrent connects parse the key only once
+            cached = self.__keys.get((path, passphrase))
+            if cached is None or cached[0] != mtime:
+                try:
+                    cached = (mtime, self.__parse(path, passphrase), None)
+                except paramiko.SSHException as e:  # e.g. encrypted key without the passphrase
+                    cached = (mtime, None, e)
+                self.__keys[(path, passphrase)] = cached
+            _, key, error = cached
+            if error is not None:
+                raise error
+            return key
+
+    def default_keys(self, passphrase=None):
+        """
+        Provides parsed keys of L{default_files} which exist, keys which can't be loaded are skipped.
+        @param passphrase: passphrase of encrypted keys
+        @type passphrase: str
+        @return: private keys
+        @rtype: list
+        """
+        keys = []
+        for path in self.default_files:
+            if not os.path.isfile(os.path.expanduser(path)):
+                continue
+            try:
+                keys.append(self.load(path, passphrase))
+            except (paramiko.SSHException, EnvironmentError) as e:
+                logger.debug("Default key %s skipped: %r" % (path, e))
+        return keys
+
+    def __parse(self, path, passphrase):
+        for key_type in self.key_types:
+            try:
+                key = key_type.from_private_key_file(path, password=passphrase)
+            except paramiko.PasswordRequiredException:
+                raise
+            except paramiko.SSHException:
+                continue
+            logger.debug("Parsed %s key %s" % (key.get_name(), path))
+            return key
+        raise paramiko.SSHException("%s is not a supported private key" % path)
+
+    def agent(self):
+        """
+        @return: ssh-agent shared by all clients
+        @rtype: SharedAgent
+        """
+        return self.__agent
+
+    def clear(self):
+        """
+        Drops parsed keys and closes connections to ssh-agent, e.g. when keys of ssh-agent were changed.
+        @rtype: None
+        """
+        with self.__lock:
+            self.__keys.clear()
+        self.__agent._close()
+
+    def _reset_after_fork(self):
+        """
+        Connection to ssh-agent is shared with the parent process, it is dropped without closing.
+        @rtype: None
+        """
+        self.__lock = threading.Lock()
+        self.__agent = SharedAgent()
+
+
+key_cache = KeyCache()
@@ -10,7 +10,16 @@ from networkobjects.host import Host
 from networkobjects.user import User
 from remote_execution_template import RemoteExecutionTemplate
 from networkobjects.connection import Connection
-from networkobjects.command import Command
+from networkobjects.command import Command, PRIORITY_HIGH, PRIORITY_NORMAL
+from stream_reactor import StreamReactor
+from channel_admission import ChannelAdmission, PendingChannel
+from rate_limiter import HandshakeLimiter
+from key_cache import KeyChain, key_cache
+from shell_session import SessionEntry, ShellSession
+from pid_filter import PidFilter
+from multiprocessing.pool import ThreadPool
+import pipes
+import threading
 import time
 import signal
 
@@ -23,10 +32,40 @@ class ParamikoModel(RemoteExecutionTemplate):
 
     @author mlesko
     """
+    connection_errors = RemoteExecutionTemplate.connection_errors + (paramiko.SSHException,)
     reconnect_ena = False
+    reconnect_attempts = 5  # reconnects of a dead transport before the command fails
+    reconnect_delay = 0.5  # seconds before the second reconnect, the delay is doubled with every next attempt
+    reconnect_max_delay = 30  # maximal seconds between reconnects
     auto_add_policy = True
+    record_pid = True  # commands are started by pid_command, so their pid is known and they can be killed
+    pid_command = 'echo $$; exec "$SHELL" -c %s'  # the login shell replaces itself by the quoted command
+    look_for_keys = True  # try keys from ~/.ssh of users without key_filename, they are parsed once by the key cache
     buffer_size = 10485760  # total number of bytes fetched from the stream  = 10 Mb --> per session
+    spill_threshold = 33554432  # output bytes of one stream kept in memory = 32 Mb, the rest goes to a temporary file
+    reactor_threads = 1  # number of threads multiplexing streams of all channels
+    connect_timeout = None  # seconds of every handshake phase, None means no limit
+    max_channels = 10  # channels opened at once per transport (sshd MaxSessions), None means no limit
+    transports_per_connection = 1  # SSH transports of one connection, channels are placed on the least loaded one
+    transport_profile = None  # TransportProfile of hosts without their own one, None means paramiko defaults
+    keepalive_interval = None  # seconds between keepalive packets of transports, None disables them
+    idle_timeout = None  # seconds after which a connection without commands is closed, None disables reaping
+    session_timeout = None  # seconds a command of the shell session may run, the session is restarted then
+    dispatch_threads = 4  # number of threads opening channels of queued commands
+    refill_threads = 1  # number of threads opening pre-opened channels (see Connection.channel_pool_size)
+    handshake_rate = None  # new connections per second of the whole process, None means no limit
+    handshake_burst = None  # new connections which may start at once, None means the rate
+    host_handshake_rate = None  # new connections per second to one host (or subnet), None means no limit
+    handshake_subnet_prefix = None  # IPv4 prefix length grouping hosts for host_handshake_rate, None means per host
     active_connection = None
+    __reactors__ = []
+    __reactor_lock = threading.Lock()
+    __reactor_counter = 0
+    __dispatch_pool__ = None
+    __refill_pool__ = None
+    __handshake_limiter__ = None
+    __reaper__ = None
+    __forked__ = []  # connections inherited from the parent process, they must never be collected in the child
 
     @classmethod
     def _set_connection(cls, connection=None):  # TODO possible refactoring to property
@@ -55,6 +94,165 @@ class ParamikoModel(RemoteExecutionTemplate):
             client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         return client
 
+    @classmethod
+    def __get_reactor__(cls):
+        """
+        Return a reactor which reads streams of the channel. Channels are spread among
+        L{reactor_threads} reactors in a round robin way, reactors are created lazily.
+        @return: reactor
+        @rtype: StreamReactor
+        """
+        with cls.__reactor_lock:
+            index = cls.__reactor_counter % max(cls.reactor_threads, 1)
+            cls.__reactor_counter += 1
+            if index >= len(cls.__reactors__):
+                cls.__reactors__.append(StreamReactor(name="paramiko-reactor-%s" % len(cls.__reactors__)))
+                index = len(cls.__reactors__) - 1
+            return cls.__reactors__[index]
+
+    @classmethod
+    def __get_admission__(cls, connection):
+        """
+        Return the admission queue of the connection, it is created lazily.
+        @param connection: connection on which commands are executed
+        @type connection: Connection
+        @return: admission queue of the connection
+        @rtype: ChannelAdmission
+        """
+        limit = None if cls.max_channels is None else cls.max_channels * max(cls.transports_per_connection, 1)
+        if limit is not None:  # pooled channels are opened sessions too
+            limit -= cls.__get_pool_size__(connection)
+        with cls.__reactor_lock:
+            admission = getattr(connection, "_channel_admission", None)
+            if admission is None:
+                admission = ChannelAdmission(limit=limit, runner=cls.__run_dispatch__, urgent_priority=PRIORITY_HIGH)
+                connection._channel_admission = admission
+        if admission.limit != limit:  # size of the channel pool was changed
+            admission.resize(limit)
+        return admission
+
+    @classmethod
+    def __get_pool_size__(cls, connection):
+        """
+        Return the number of pre-opened channels of the connection (see L{Connection.channel_pool_size}),
+        it is kept below the channel limit, so at least one command can run.
+        @param connection: connection with the pool
+        @type connection: Connection
+        @return: size of the pool
+        @rtype: int
+        """
+        size = max(connection.channel_pool_size or 0, 0)
+        if cls.max_channels is not None:
+            size = min(size, cls.max_channels * max(cls.transports_per_connection, 1) - 1)
+        return max(size, 0)
+
+    @classmethod
+    def __acquire_client__(cls, connection):
+        """
+        Return the least loaded client of the connection (see L{transports_per_connection}), its load is increased.
+        @param connection: connection on which the channel will be opened
+        @type connection: Connection
+        @return: client
+        @rtype: paramiko.SSHClient
+        """
+        with cls.__reactor_lock:
+            load = getattr(connection, "_client_load", None)
+            if load is None:
+                load = connection._client_load = dict()  # client -> number of channels
+            clients = [connection.client] + getattr(connection, "_extra_clients", [])
+            client = min(clients, key=lambda item: load.get(item, 0))
+            load[client] = load.get(client, 0) + 1
+            return client
+
+    @classmethod
+    def __release_client__(cls, connection, client):
+        """
+        Decrease the load of the client acquired by L{__acquire_client__}.
+        @rtype: None
+        """
+        with cls.__reactor_lock:
+            if client in connection._client_load:  # replaced clients are dropped by the reconnect
+                connection._client_load[client] -= 1
+
+    @classmethod
+    def __run_dispatch__(cls, task):
+        """
+        Runs the dispatch of the queued command in the background, pool of threads is created lazily.
+        @param task: function opening the channel
+        @rtype: None
+        """
+        with cls.__reactor_lock:
+            if cls.__dispatch_pool__ is None:
+                cls.__dispatch_pool__ = ThreadPool(processes=max(cls.dispatch_threads, 1))
+        cls.__dispatch_pool__.apply_async(task)
+
+    @classmethod
+    def __run_refill__(cls, task):
+        """
+        Runs the refill of a channel pool in the background. Refills have their own pool of threads,
+        so they do not delay dispatches of queued commands, the pool is created lazily.
+        @param task: function refilling the channel pool
+        @rtype: None
+        """
+        with cls.__reactor_lock:
+            if cls.__refill_pool__ is None:
+                cls.__refill_pool__ = ThreadPool(processes=max(cls.refill_threads, 1))
+        cls.__refill_pool__.apply_async(task)
+
+    @classmethod
+    def __get_handshake_limiter__(cls):
+        """
+        Return the limiter of new connections, it is recreated when the configuration is changed.
+        @return: limiter or None if no rate is limited
+        @rtype: HandshakeLimiter
+        """
+        config = (cls.handshake_rate, cls.handshake_burst, cls.host_handshake_rate, None, cls.handshake_subnet_prefix)
+        if cls.handshake_rate is None and cls.host_handshake_rate is None:
+            return None
+        with cls.__reactor_lock:
+            if cls.__handshake_limiter__ is None or cls.__handshake_limiter__.config != config:
+                cls.__handshake_limiter__ = HandshakeLimiter(*config)
+            return cls.__handshake_limiter__
+
+    @classmethod
+    def _reset_after_fork(cls):
+        """
+        Threads of reactors, the dispatch and refill pools do not exist in the forked process, they are recreated lazily.
+        Transports of inherited connections share their sockets with the parent process, so they are deactivated
+        and their sockets are closed in this process only, nothing is sent on the wire. Inherited connections are
+        kept referenced, so their channels are not closed by the garbage collector under locks held at fork time.
+        @rtype: None
+        """
+        cls.__forked__ = list(Connection)
+        for connection in cls.__forked__:
+            for client in [connection.client] + getattr(connection, "_extra_clients", []):
+                cls.__detach_transport__(client)
+        cls.__reactor_lock = threading.Lock()
+        cls.__reactors__ = []
+        cls.__reactor_counter = 0
+        cls.__dispatch_pool__ = None
+        cls.__refill_pool__ = None
+        cls.__handshake_limiter__ = None
+        cls.__reaper__ = None
+        cls.active_connection = None
+        key_cache._reset_after_fork()
+
+    @staticmethod
+    def __detach_transport__(client):
+        """
+        Makes the transport of the client inherited from the parent process unusable without sending anything.
+        @type client: paramiko.SSHClient
+        @rtype: None
+        """
+        try:
+            transport = client.get_transport()
+            if transport is None:
+                return
+            transport.active = False  # channels and the transport do not send messages once it is inactive
+            transport.sock.close()  # only the descriptor of this process, the parent keeps the connection
+        except Exception as e:
+            logger.debug("Inherited transport of %s could not be detached: %r" % (client, e))
+
     def create_connection(self, host, user):
         """
         Create connection. If connection already exists the creation is skipped.
@@ -78,12 +276,18 @@ class ParamikoModel(RemoteExecutionTemplate):
         ParamikoModel.active_connection = connection
         return connection
 
-    def connect(self, connection=None):
+    def connect(self, connection=None, timeout=None):
         """
         Connects via underlying module using specified connection object.
         If connection object was already connected connecting is skipped.
+        Private keys of users are parsed once per process and clients of one thread share the connection
+        to ssh-agent (see L{KeyCache}).
         @param connection: connection object to be used
         @type connection: Connection
+        @param timeout: timeout in seconds of every phase of the handshake (waiting for the handshake rate
+            limit, TCP connect, SSH banner and authentication), None means L{connect_timeout}
+        @type timeout: float
+        @raise HandshakeThrottled: if the handshake rate limit (see L{handshake_rate}) did not allow the connection in time
         @raise InvalidConnection: if connection is not instance of L{dtestlib.executor.networkobjects_tests.connection.Connection} class
         @return: None
         @rtype: None
@@ -95,8 +299,197 @@ class ParamikoModel(RemoteExecutionTemplate):
 
         if not _connection.connected:
             logger.debug(str(_connection) + " is connecting.")
-            _connection.client.connect(hostname=_connection.host.address, port=_connection.host.port,
-                                       username=_connection.user.username, password=_connection.user.password)
+            if timeout is None:
+                timeout = self.connect_timeout
+            self.__handshake__(_connection, _connection.client, timeout)
+            extra_clients = []
+            try:
+                for _ in xrange(self.transports_per_connection - 1):
+                    client = self.__create_initialized_client__()
+                    self.__handshake__(_connection, client, timeout)
+                    extra_clients.append(client)
+            except Exception:
+                for client in [_connection.client] + extra_clients:
+                    client.close()
+                raise
+            _connection._extra_clients = extra_clients
+            _connection.connected = True
+            _connection.last_used = time.time()
+            logger.debug(str(_connection) + " is connected.")
+            if self.idle_timeout is not None:
+                self.__start_reaper__()
+            if self.__get_pool_size__(_connection):
+                self.__run_refill__(lambda: self.__refill_channel_pool__(_connection))
+
+    def __handshake__(self, connection, client, timeout):
+        """
+        Connects the client to the host of the connection, respecting the handshake rate limit.
+        @param connection: connection which is connecting
+        @type connection: Connection
+        @param client: client to connect
+        @type client: paramiko.SSHClient
+        @param timeout: timeout in seconds of every phase of the handshake
+        @type timeout: float
+        @rtype: None
+        """
+        limiter = self.__get_handshake_limiter__()
+        if limiter is not None and not limiter.acquire(connection.host.address, timeout):
+            raise HandshakeThrottled("handshake rate limit did not allow %s in %s seconds" % (connection, timeout))
+        kwargs = dict()
+        profile = connection.host.transport_profile or self.transport_profile
+        if profile is not None:
+            kwargs["compress"] = bool(profile.compression)
+            kwargs["transport_factory"] = lambda sock, **options: self.__create_transport__(sock, profile, **options)
+        user = connection.user
+        pkey = None if user.key_filename is None else key_cache.load(user.key_filename, user.passphrase)
+        keys = []  # default keys are offered after keys of ssh-agent, as paramiko's look_for_keys does
+        if self.look_for_keys and pkey is None:
+            keys = key_cache.default_keys(user.passphrase if user.passphrase is not None else user.password)
+        if user.allow_agent or keys:
+            # the client lists keys of its agent, if it has none, it opens a new one
+            client._agent = KeyChain(key_cache.agent() if user.allow_agent else None, keys)
+        client.connect(hostname=connection.host.address, port=connection.host.port,
+                       username=user.username, password=user.password, pkey=pkey,
+                       allow_agent=user.allow_agent or bool(keys), look_for_keys=False,
+                       timeout=timeout, banner_timeout=timeout, auth_timeout=timeout, **kwargs)
+        if self.keepalive_interval is not None:
+            client.get_transport().set_keepalive(self.keepalive_interval)
+        if profile is not None:
+            logger.debug("%s negotiated %s" % (connection, self.__describe_transport__(client.get_transport())))
+
+    @staticmethod
+    def __create_transport__(sock, profile, **options):
+        """
+        Creates the transport tuned by the profile, algorithms unknown to paramiko are skipped.
+        @param sock: connected socket
+        @param profile: tuning of the transport
+        @type profile: TransportProfile
+        @param options: other arguments of the transport given by the client
+        @return: transport which is not started yet
+        @rtype: paramiko.Transport
+        """
+        if profile.window_size is not None:
+            options["default_window_size"] = profile.window_size
+        if profile.max_packet_size is not None:
+            options["default_max_packet_size"] = profile.max_packet_size
+        transport = paramiko.Transport(sock, **options)
+        security = transport.get_security_options()
+        for name in ("ciphers", "digests", "kex"):
+            preferred = getattr(profile, name)
+            if preferred is None:
+                continue
+            available = getattr(security, name)
+            unknown = [item for item in preferred if item not in available]
+            if unknown:
+                logger.debug("Unsupported %s of %r skipped: %s" % (name, profile, unknown))
+            preferred = [item for item in preferred if item in available]
+            setattr(security, name, preferred + [item for item in available if item not in preferred])
+        return transport
+
+    @staticmethod
+    def __describe_transport__(transport):
+        """
+        @param transport: connected transport
+        @type transport: paramiko.Transport
+        @return: negotiated parameters of the transport
+        @rtype: dict
+        """
+        return {
+            "server_version": transport.remote_version,
+            "host_key_type": transport.host_key_type,
+            "cipher": (transport.local_cipher, transport.remote_cipher),
+            "mac": (transport.local_mac, transport.remote_mac),
+            "compression": (transport.local_compression, transport.remote_compression),
+            "window_size": transport.default_window_size,
+            "max_packet_size": transport.default_max_packet_size,
+        }
+
+    def get_transport_info(self, connection=None):
+        """
+        Provides what was negotiated by the transports of the connection. Values of algorithms are tuples
+        of the outgoing and the incoming direction. The key exchange algorithm is not kept by paramiko.
+        @param connection: connected connection
+        @type connection: Connection
+        @return: list with a dictionary of negotiated parameters per transport (see L{transports_per_connection})
+        @rtype: list
+        """
+        _connection = self._set_connection(connection)
+        info = []
+        for client in [_connection.client] + getattr(_connection, "_extra_clients", []):
+            transport = client.get_transport()
+            if transport is None or not transport.is_active():
+                raise DeadTransport("transport of %s is not active" % _connection)
+            info.append(self.__describe_transport__(transport))
+        return info
+
+    def is_alive(self, connection=None):
+        """
+        Cheap health check of the connection, it checks only local state of its transports, nothing is sent.
+        @param connection: connection to be checked
+        @type connection: Connection
+        @return: True if all transports of the connection are active and authenticated
+        @rtype: bool
+        """
+        _connection = self._set_connection(connection)
+        for client in [_connection.client] + getattr(_connection, "_extra_clients", []):
+            transport = client.get_transport()
+            if transport is None or not transport.is_active() or not transport.is_authenticated():
+                return False
+        return True
+
+    def reap_idle_connections(self, idle_timeout=None):
+        """
+        Closes connected connections which have no running or queued command for longer than the idle timeout.
+        Closed connections are removed via L{close_connection}.
+        @param idle_timeout: idle time in seconds, None means L{idle_timeout}
+        @type idle_timeout: float
+        @return: closed connections
+        @rtype: list
+        """
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        if idle_timeout is None:
+            return []
+        reaped = []
+        now = time.time()
+        for connection in list(Connection):
+            admission = getattr(connection, "_channel_admission", None)
+            if not connection.connected or (admission is not None and (admission.active or len(admission))):
+                continue
+            session = getattr(connection, "_shell_session", None)
+            if session is not None and not session.closed and len(session):  # commands of the session bypass admission
+                continue
+            if connection.last_used is not None and now - connection.last_used <= idle_timeout:
+                continue
+            logger.debug("%s is idle, closing it" % connection)
+            try:
+                self.close_connection(connection)
+            except Exception:
+                logger.exception("Closing of idle %s failed" % connection)
+                continue
+            reaped.append(connection)
+        return reaped
+
+    def __start_reaper__(self):
+        """
+        Starts the background thread which closes idle connections, only one thread is started.
+        @rtype: None
+        """
+        with self.__reactor_lock:
+            if ParamikoModel.__reaper__ is not None:
+                return
+            ParamikoModel.__reaper__ = threading.Thread(target=self.__reap_forever__, name="paramiko-reaper")
+            ParamikoModel.__reaper__.daemon = True
+            ParamikoModel.__reaper__.start()
+
+    def __reap_forever__(self):
+        while self.idle_timeout is not None:
+            time.sleep(max(min(self.idle_timeout / 2.0, 60), 0.1))
+            try:
+                self.reap_idle_connections()
+            except Exception:
+                logger.exception("Reaping of idle connections failed")
+        ParamikoModel.__reaper__ = None
 
     def get_connection(self, host=None, user=None):
         """
@@ -110,10 +503,10 @@ class ParamikoModel(RemoteExecutionTemplate):
         @rtype: Connection
         """
         connection = super(ParamikoModel, self).get_connection(host, user)
-        # TODO reconsider what this is good for, or add counter of reconnects
-        if connection.client.get_transport() is not None:
-            if not connection.client.get_transport().is_authenticated() and self.reconnect_ena:
-                self.connect(connection)
+        # TODO add counter of reconnects
+        if self.reconnect_ena and connection.connected and not self.is_alive(connection):
+            logger.debug("%s is dead, reconnecting" % connection)
+            self.__reconnect__(connection, connection.client)
         ParamikoModel.active_connection = connection
         return connection
 
@@ -127,17 +520,23 @@ class ParamikoModel(RemoteExecutionTemplate):
         @return: None
         @rtype: None
         """
-        tmp_conn = ParamikoModel.active_connection
         try:
             _connection = self._set_connection(connection)
         except InvalidConnection:
             raise ConnectionCloseError("connection must be an instance of the Connection class")
-        if ParamikoModel.active_connection == tmp_conn:  # active connection was deleted
+        if _connection is ParamikoModel.active_connection:  # active connection was deleted
             ParamikoModel.active_connection = None
             logger.debug("close_connection set active_connection to None")
-        else:
-            ParamikoModel.active_connection = tmp_conn
+        session = getattr(_connection, "_shell_session", None)
+        if session is not None:
+            session.fail(SessionClosed("%s was closed" % _connection))
+            session.channel.close()
         _connection.client.close()
+        for client in getattr(_connection, "_extra_clients", []):
+            client.close()
+        _connection._extra_clients = []
+        _connection.connected = False
+        self.__drain_channel_pool__(_connection)
         logger.debug("Removing connection %s from %s" % (_connection, _connection.host))
         _connection.host.connections.remove(_connection)
         logger.debug("Connections left in host: %s" % _connection.host.connections)
@@ -166,46 +565,56 @@ class ParamikoModel(RemoteExecutionTemplate):
             raise InvalidCommandValue("command must be an instance of the Command class")
         if not isinstance(connection, Connection):
             raise InvalidConnection("connection can't be None")
+        command._record_pid = self.record_pid
         result = ExecResult(
             command=command,
-            receive_stdout_func=lambda output_data: self.__receive_stdout__(channel, output_data),
+            receive_stdout_func=lambda output_data: self.__receive_stdout__(
+                channel, PidFilter(command, output_data) if command._record_pid else output_data),
             receive_stderr_func=lambda output_data: self.__receive_stderr__(channel, output_data),
             exit_status_func=lambda: channel.recv_exit_status(),
-            connection=connection
+            connection=connection,
+            spill_threshold=self.spill_threshold
         )
         return result
 
     def kill(self, command, sig=signal.SIGTERM):  # TODO possible removal, unnecessary, wrapper do this
         """
-        Executes kill on given command with signal
+        Executes kill on given command with signal. The pid of the command started on a channel is printed
+        by L{pid_command}, of a compound command only the shell running it receives the signal.
         @param command: command to be killed
         @type command: L{dtestlib.executor.networkobjects_tests.command.Command}
         @param sig: signal to send to the running process, see L{signal.py}
         @type sig: int
         @return: ecode of kill command
         @rtype: int
+        @raise InvalidCommandValue: if pid of the command is not known, e.g. the command did not start yet,
+            it runs in the session mode or L{record_pid} is disabled
         """
         if not isinstance(command, Command):
             raise InvalidCommandValue("cmd must be an instance of the Command class")
+        if command.pid is None:
+            raise InvalidCommandValue("pid of the command is not known, it can't be killed")
 
-        command = Command('kill -%s %s' % (sig, command.pid))
+        target = command.connection  # the kill has to run where the killed command runs
+        command = Command('kill -%s %s' % (sig, command.pid), priority=PRIORITY_HIGH)
         tmp_con = ParamikoModel.active_connection
-        res = self.execute(command=command, connection=command.connection)
+        res = self.execute(command=command, connection=target)
         res.wait_for_data()
         ParamikoModel.active_connection = tmp_con  # restore previous active connection
         return res.ecode
 
-    def create_command(self, command):
+    def create_command(self, command, **kwargs):
         """
         Create an instance of L{Command} class.
         @param command: command to be executed
         @type command: Command
+        @param kwargs: optional attributes of the command, e.g. capture policy, see L{Command.__init__}
         @return: command
         @rtype: Command
         """
         if not isinstance(command, basestring):
             raise InvalidCommandValue("cmd must be instance of the string")
-        command = Command(command=command)
+        command = Command(command=command, **kwargs)
         command._kill_func = lambda sig: self.kill(command=command, sig=sig)
         return command
 
@@ -216,12 +625,13 @@ class ParamikoModel(RemoteExecutionTemplate):
             socket-like objects used for the actual transfer of data across the
             session.
         @type channel: paramiko.channel.Channel
-        @param output_data: list where an output will be stored
-        @type output_data: list
+        @param output_data: storage where received chunks of an output will be stored
+        @type output_data: OutputStorage
         @return: function for stdout manipulation
         @rtype: object reference
         """
-        return self.__read_from_stream__(lambda: channel.recv(self.buffer_size), output_data)
+        return self.__read_from_stream__(channel, lambda: channel.recv_ready(), lambda: channel.recv(self.buffer_size),
+                                         output_data)
 
     def __receive_stderr__(self, channel, output_data):
         """
@@ -230,45 +640,79 @@ class ParamikoModel(RemoteExecutionTemplate):
             socket-like objects used for the actual transfer of data across the
             session.
         @type channel: paramiko.channel.Channel
-        @param output_data: list where an output will be stored
-        @type output_data: list
+        @param output_data: storage where received chunks of an output will be stored
+        @type output_data: OutputStorage
         @return: function for stderr manipulation
         @rtype: object reference
         """
-        return self.__read_from_stream__(lambda: channel.recv_stderr(self.buffer_size),
-                                         output_data)
+        return self.__read_from_stream__(channel, lambda: channel.recv_stderr_ready(),
+                                         lambda: channel.recv_stderr(self.buffer_size), output_data)
 
-    def __read_from_stream__(self, stream_manipulation_func, output_data):
+    def __read_from_stream__(self, channel, ready_func, stream_manipulation_func, output_data):
         """
-        Universal approach how to use same functionality for different stream manipulation methods
+        Universal approach how to use same functionality for different stream manipulation methods.
+        Returned function reads only data which are already received, therefore it never blocks.
+        Received chunks are only appended, joining them is left to the result, so the accumulation is linear.
         @param channel: `Channels <.Channel>` are
             socket-like objects used for the actual transfer of data across the
             session.
         @type channel: paramiko.channel.Channel
-        @param ask_status_func: function used for checking the transfer status
+        @param ready_func: function used for checking whether there are data to be read
         @param stream_manipulation_func:  function provides transfer of the data
-        @param output_data: storage of the output data
-        @type output_data: list
-        @return: wrapped function
+        @param output_data: storage of the output data chunks
+        @type output_data: OutputStorage
+        @return: wrapped function returning True when the end of the stream was reached
         @rtype: object reference
         """
-        WAIT_FOR_DATA = 0.01  # in tests this was with best results
 
         def wrapper():
-            output_data.append('')
-            while True:
+            eof = channel.eof_received or channel.closed  # checked before reading, no data can be missed
+            while ready_func():
                 received = stream_manipulation_func()  # this has to be stream of bytes
                 if received == '':  # faster than len(string) == 0 comparing
-                    break
-                output_data[0] = "%s%s" % (output_data[0], received)
-                time.sleep(WAIT_FOR_DATA)
-            return output_data[0].splitlines()
+                    return True
+                output_data.append(received)
+            return eof
 
         return wrapper
 
+    def __on_channel_ready__(self, channel, result):
+        """
+        Called by the reactor whenever the channel has something to read.
+        @param channel: channel on which the command of the result is executed
+        @type channel: paramiko.channel.Channel
+        @param result: result fed by the channel
+        @type result: ExecResult
+        @return: state of the channel for the reactor
+        @rtype: int
+        """
+        if not result._fetch_streams():
+            return StreamReactor.POLL
+        if not channel.exit_status_ready():
+            return StreamReactor.LINGER
+        result._finalize()
+        return StreamReactor.DONE
+
+    def __watch_channel__(self, channel, result):
+        """
+        Hands the channel over to a reactor which feeds the result in the background.
+        @param channel: channel on which the command of the result is executed
+        @type channel: paramiko.channel.Channel
+        @param result: result to be fed by the channel
+        @type result: ExecResult
+        @rtype: None
+        """
+
+        def on_error(exc):
+            logger.debug("Reading of the command: %s failed: %r" % (result.cmd.cmd, exc))
+            result._finalize(exit_status=False, error=exc)
+
+        self.__get_reactor__().register(channel, lambda: self.__on_channel_ready__(channel, result), on_error)
+
     def execute_batch(self, commands=(), connection=None):
         """
-        Execute a batch of commands in a simultaneous way.
+        Execute a batch of commands in a simultaneous way. Exclusive commands are barriers executed
+        in the background (see L{execute}), so the method never waits for the commands.
         @param commands: list of commands. Command can be string or an instance of the class L{Command}
         @type commands: list | tuple
         @param connection: connection object on which a batch will be executed
@@ -281,35 +725,411 @@ class ParamikoModel(RemoteExecutionTemplate):
             raise InvalidCommandValue("Command can't be None")
         if not hasattr(commands, "__iter__"):
             raise InvalidCommandValue("Command needs to be an iterable")
-        result_list = []
-        for cmd in commands:
-            res = self.execute(command=cmd, connection=connection)
-            result_list.append(res)
-            if res.cmd.exclusive:
-                res.wait_for_data()
-        return result_list
+        return [self.execute(command=cmd, connection=connection) for cmd in commands]
 
     def execute(self, command=None, connection=None):
         """
-        Execute command on the connection
+        Execute command on the connection. If the connection has L{max_channels} channels opened,
+        the command is queued and executed once a channel is finished, queued commands are dispatched
+        by their priority. Exclusive command is queued till all commands executed before it are finished
+        and it postpones all following commands on the connection, except of L{PRIORITY_HIGH} ones,
+        till it is finished. The returned result is usable right away in all cases.
+        If L{Connection.session_mode} is set, the command is executed in the shell session of the connection
+        instead (see L{ShellSession}). Commands of the session run one by one in the order of execution,
+        so they are exclusive anyway, but priorities can't be applied and commands can't be killed.
         @param command: command to be executed
         @type command: str | Command
         @param connection: connection on which the command will be executed
         @type connection: Connection
         @return: result of the execution.
         @rtype: ExecResult
-        @raise InvalidCommandValue: if command is not the L{Command} instance or an instance of the string
+        @raise InvalidCommandValue: if command is not the L{Command} instance or an instance of the string,
+            or if the command has a priority in the session mode
         """
         if not (isinstance(command, basestring) or isinstance(command, Command)):
             raise InvalidCommandValue("command must be the string or an instance of the Command class")
         conn = self._set_connection(connection)
-        ssh_chnl = conn.client.get_transport().open_session()
         if not isinstance(command, Command):
             command = self.create_command(command)
-        command.time_stamp = time.time()
+        if conn.session_mode:
+            if command.priority != PRIORITY_NORMAL:
+                raise InvalidCommandValue("commands of the session mode are executed in order, priority can't be set")
+            command.connection = conn
+            return self.__execute_in_session__(command, conn)
         command.connection = conn
-        logger.debug("[%s]$ %s" % (conn.id, command.cmd))
-        ssh_chnl.exec_command(command.cmd)  # channel exec, not conn exec (see channel.py in paramiko)
-        exec_result = self._create_result(channel=ssh_chnl, command=command, connection=conn)
+        channel = PendingChannel()
+        exec_result = self._create_result(channel=channel, command=command, connection=conn)
+        admission = self.__get_admission__(conn)
+        placement = []  # client which carries the channel, filled by the dispatch
+
+        def release(result):
+            conn.last_used = time.time()
+            if placement:  # load of the client has to be updated before the next command is admitted
+                self.__release_client__(conn, placement[0])
+            admission.release(command.exclusive)
+
+        exec_result.add_done_callback(release)
         conn.incomplete_results.append(exec_result)
+        try:
+            admission.submit(lambda queued: self.__dispatch__(channel, exec_result, queued, placement),
+                             command.exclusive, command.priority)
+        except Exception as e:  # channel could not be opened right away, the caller is informed directly
+            conn.incomplete_results.remove(exec_result)
+            exec_result._finalize(exit_status=False, error=e)
+            raise
         return exec_result
+
+    def __execute_in_session__(self, command, connection):
+        """
+        Writes the command to the shell session of the connection, output of the session is demultiplexed
+        into the result. Commands of the session are executed one by one, so priorities and exclusivity
+        make no difference, and their pid is not known.
+        @param command: command to be executed
+        @type command: Command
+        @param connection: connection in the session mode
+        @type connection: Connection
+        @return: result of the execution
+        @rtype: ExecResult
+        """
+        entry = SessionEntry()
+        result = ExecResult(
+            command=command,
+            receive_stdout_func=entry.reader("stdout"),
+            receive_stderr_func=entry.reader("stderr"),
+            exit_status_func=lambda: entry.ecode,
+            connection=connection,
+            spill_threshold=self.spill_threshold
+        )
+        entry.on_update = lambda: self.__on_session_update__(result, entry)
+        result.add_done_callback(lambda _: setattr(connection, "last_used", time.time()))
+        connection.incomplete_results.append(result)
+        try:
+            session = self.__get_shell_session__(connection)
+            command.time_stamp = result.ts_start = time.time()
+            logger.debug("[%s]$ %s" % (connection.id, command.cmd))
+            session.submit(command.cmd, entry)
+        except Exception as e:
+            connection.incomplete_results.remove(result)
+            result._finalize(exit_status=False, error=e)
+            raise
+        connection.last_used = time.time()
+        return result
+
+    @staticmethod
+    def __on_session_update__(result, entry):
+        """
+        Called by the shell session whenever the entry of the result changes.
+        @type result: ExecResult
+        @type entry: SessionEntry
+        @rtype: None
+        """
+        if entry.pid is not None:
+            result.cmd.pid = entry.pid
+        if result._fetch_streams():
+            result._finalize(exit_status=entry.error is None, error=entry.error)
+
+    def __get_shell_session__(self, connection):
+        """
+        Provides the running shell session of the connection, a new one is started if there is none.
+        The channel of the session is not counted by the admission of the connection.
+        @param connection: connection in the session mode
+        @type connection: Connection
+        @return: shell session
+        @rtype: ShellSession
+        """
+        with self.__reactor_lock:
+            lock = getattr(connection, "_session_lock", None)
+            if lock is None:
+                lock = connection._session_lock = threading.Lock()
+        with lock:
+            session = getattr(connection, "_shell_session", None)
+            if session is not None and not session.closed:
+                return session
+            client, channel = self.__open_session__(connection)
+
+            def on_close():
+                channel.close()  # e.g. the session timed out, the reactor drops the channel
+                self.__release_client__(connection, client)
+
+            try:
+                session = self.__start_session__(channel, on_close)
+            except Exception:
+                self.__release_client__(connection, client)
+                raise
+            connection._shell_session = session
+            logger.debug("Shell session of %s started" % connection)
+            self.__get_reactor__().register(channel, lambda: self.__on_shell_ready__(channel, session), session.fail)
+            return session
+
+    def __start_session__(self, channel, on_close):
+        """
+        Starts the shell on the channel.
+        @param channel: opened channel
+        @type channel: paramiko.channel.Channel
+        @param on_close: function without arguments called once the session ends
+        @return: session running on the channel
+        @rtype: ShellSession
+        """
+        channel.exec_command(ShellSession.shell)
+        return ShellSession(channel, on_close=on_close, timeout=self.session_timeout)
+
+    def __on_shell_ready__(self, channel, session):
+        """
+        Called by the reactor whenever the channel of the shell session has something to read.
+        @param channel: channel running the shell
+        @type channel: paramiko.channel.Channel
+        @param session: session fed by the channel
+        @type session: ShellSession
+        @return: state of the channel for the reactor
+        @rtype: int
+        """
+        eof = channel.eof_received or channel.closed  # checked before reading, no data can be missed
+        for ready_func, recv_func, feed_func in ((channel.recv_ready, channel.recv, session.feed_stdout),
+                                                 (channel.recv_stderr_ready, channel.recv_stderr,
+                                                  session.feed_stderr)):
+            while ready_func():
+                received = recv_func(self.buffer_size)
+                if received == '':
+                    eof = True
+                    break
+                feed_func(received)
+        if not eof:
+            return StreamReactor.POLL
+        session.fail(SessionClosed("shell session of %s ended" % channel))
+        channel.close()
+        return StreamReactor.DONE
+
+    def __open_session__(self, connection):
+        """
+        Opens the channel on the least loaded transport of the connection. If the transport is dead and
+        L{reconnect_ena} is set, the connection is reconnected in the background (see L{__await_reconnect__}).
+        @param connection: connection on which the channel is opened
+        @type connection: Connection
+        @return: client carrying the channel (its load has to be released) and the channel
+        @rtype: tuple
+        @raise DeadTransport: if the transport is dead
+        """
+        pooled = self.__take_pooled_channel__(connection)
+        if pooled is not None:
+            return pooled
+        client = self.__acquire_client__(connection)
+        try:
+            transport = client.get_transport()
+            if transport is None or not transport.is_active():
+                raise DeadTransport("transport of %s is not active" % connection)
+            return client, transport.open_session()
+        except Exception as e:
+            self.__release_client__(connection, client)
+            transport = client.get_transport()
+            if transport is not None and transport.is_active():  # e.g. channel refused by the server
+                raise
+            connection.connected = False
+            if self.reconnect_ena:
+                self.__await_reconnect__(connection)
+            if isinstance(e, DeadTransport):
+                raise
+            raise DeadTransport("transport of %s is dead: %r" % (connection, e))
+
+    def __await_reconnect__(self, connection, retry=None, result=None):
+        """
+        Parks the dispatch till the connection is reconnected. The connection is reconnected with an exponential
+        backoff (see L{reconnect_attempts}) in its own thread, so neither the caller nor the dispatch pool waits.
+        @param connection: connection with the dead transport
+        @type connection: Connection
+        @param retry: function dispatching the command again once the connection is reconnected
+        @param result: result of the parked command, it fails if the connection can't be reconnected
+        @type result: ExecResult
+        @rtype: None
+        """
+        with self.__reactor_lock:
+            waiters = getattr(connection, "_reconnect_waiters", None)
+            start = waiters is None
+            if start:
+                waiters = connection._reconnect_waiters = []
+            if retry is not None:
+                waiters.append((retry, result))
+        if start:
+            thread = threading.Thread(target=self.__reconnect_with_backoff__, args=(connection,),
+                                      name="reconnect-%s" % connection.id)
+            thread.daemon = True
+            thread.start()
+
+    def __reconnect_with_backoff__(self, connection):
+        error = DeadTransport("reconnecting of %s is disabled" % connection)
+        for attempt in xrange(self.reconnect_attempts):
+            delay = min(self.reconnect_delay * 2 ** (attempt - 1), self.reconnect_max_delay) if attempt else 0
+            logger.debug("Reconnecting %s in %s seconds, attempt %s" % (connection, delay, attempt + 1))
+            time.sleep(delay)
+            try:
+                if not self.is_alive(connection):
+                    self.__reconnect__(connection, connection.client)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                logger.debug("Reconnecting of %s failed: %r" % (connection, e))
+        with self.__reactor_lock:
+            waiters, connection._reconnect_waiters = connection._reconnect_waiters, None
+        for retry, result in waiters:
+            if error is None:
+                self.__run_dispatch__(retry)
+            else:
+                result._finalize(exit_status=False,
+                                 error=DeadTransport("transport of %s is dead: %r" % (connection, error)))
+
+    def __take_pooled_channel__(self, connection):
+        """
+        Takes a pre-opened channel of the connection, the pool is refilled in the background.
+        Channels which were closed meanwhile are dropped.
+        @param connection: connection with the pool
+        @type connection: Connection
+        @return: client carrying the channel (its load has to be released) and the channel, None if the pool is empty
+        @rtype: tuple
+        """
+        if not self.__get_pool_size__(connection):
+            return None
+        taken = None
+        while taken is None:
+            with self.__reactor_lock:
+                pool = getattr(connection, "_channel_pool", None)
+                if not pool:
+                    break
+                client, channel = pool.pop(0)
+            transport = client.get_transport()
+            if channel.closed or transport is None or not transport.is_active():
+                self.__release_client__(connection, client)
+                continue
+            taken = client, channel
+        self.__run_refill__(lambda: self.__refill_channel_pool__(connection))
+        return taken
+
+    def __refill_channel_pool__(self, connection):
+        """
+        Opens channels till the pool of the connection is full. Only one refill of the connection runs at once.
+        @param connection: connection with the pool
+        @type connection: Connection
+        @rtype: None
+        """
+        with self.__reactor_lock:
+            if getattr(connection, "_pool_refilling", False):
+                return
+            connection._pool_refilling = True
+            pool = getattr(connection, "_channel_pool", None)
+            if pool is None:
+                pool = connection._channel_pool = []
+        try:
+            while connection.connected and len(pool) < self.__get_pool_size__(connection):
+                client = self.__acquire_client__(connection)
+                try:
+                    transport = client.get_transport()
+                    if transport is None or not transport.is_active():
+                        raise DeadTransport("transport of %s is not active" % connection)
+                    channel = transport.open_session()
+                except Exception as e:
+                    self.__release_client__(connection, client)
+                    logger.debug("Channel pool of %s could not be refilled: %r" % (connection, e))
+                    return
+                with self.__reactor_lock:
+                    if connection.connected and pool is getattr(connection, "_channel_pool", None):
+                        pool.append((client, channel))
+                        continue
+                self.__release_client__(connection, client)  # connection was closed meanwhile
+                channel.close()
+                return
+        finally:
+            connection._pool_refilling = False
+
+    def __drain_channel_pool__(self, connection):
+        """
+        Closes pre-opened channels of the connection.
+        @param connection: connection with the pool
+        @type connection: Connection
+        @rtype: None
+        """
+        with self.__reactor_lock:
+            pool, connection._channel_pool = getattr(connection, "_channel_pool", []), []
+        for client, channel in pool:
+            self.__release_client__(connection, client)
+            try:
+                channel.close()
+            except Exception:
+                pass  # transport is dead anyway
+
+    def __reconnect__(self, connection, dead_client):
+        """
+        Replaces clients of the connection by new ones and connects them. Connection is reconnected only once
+        if more dispatches detect the same dead client.
+        @param connection: connection to reconnect
+        @type connection: Connection
+        @param dead_client: client which was found dead
+        @type dead_client: paramiko.SSHClient
+        @rtype: None
+        """
+        with self.__reactor_lock:
+            lock = getattr(connection, "_reconnect_lock", None)
+            if lock is None:
+                lock = connection._reconnect_lock = threading.Lock()
+        with lock:
+            clients = [connection.client] + getattr(connection, "_extra_clients", [])
+            if dead_client not in clients:  # already reconnected by another dispatch
+                return
+            for client in clients:
+                try:
+                    client.close()
+                except Exception:
+                    pass  # client is dead anyway
+            self.__drain_channel_pool__(connection)
+            with self.__reactor_lock:
+                load = getattr(connection, "_client_load", {})
+                for client in clients:
+                    load.pop(client, None)
+            connection.client = ParamikoModel.__create_initialized_client__()
+            connection._extra_clients = []
+            connection.connected = False
+            self.connect(connection)
+
+    def __dispatch__(self, channel, result, queued=False, placement=None, retried=False):
+        """
+        Opens the channel and executes the command of the result on it. If the transport is dead and
+        L{reconnect_ena} is set, the command stays queued till the connection is reconnected.
+        @param channel: placeholder of the channel used by the result
+        @type channel: PendingChannel
+        @param result: result of the command
+        @type result: ExecResult
+        @param queued: the command was queued, failure is reported only by the result
+        @type queued: bool
+        @param placement: list which receives the client carrying the channel, its load is released by the caller
+        @type placement: list
+        @param retried: the command was already parked till the connection was reconnected
+        @type retried: bool
+        @rtype: None
+        """
+        command = result.cmd
+        conn = result.connection
+        client = None
+        try:
+            client, ssh_chnl = self.__open_session__(conn)
+            conn.last_used = time.time()
+            command.time_stamp = result.ts_start = time.time()
+            logger.debug("[%s]$ %s" % (conn.id, command.cmd))
+            # channel exec, not conn exec (see channel.py in paramiko)
+            ssh_chnl.exec_command(self.pid_command % pipes.quote(command.cmd) if command._record_pid else command.cmd)
+        except Exception as e:
+            if client is not None:
+                self.__release_client__(conn, client)
+            if isinstance(e, DeadTransport) and self.reconnect_ena and not retried:
+                logger.debug("Command: %s waits for the reconnect of %s" % (command.cmd, conn))
+                self.__await_reconnect__(conn, lambda: self.__dispatch__(channel, result, True, placement, True),
+                                         result)
+                return
+            if not queued:
+                raise
+            logger.debug("Queued command: %s failed: %r" % (command.cmd, e))
+            result._finalize(exit_status=False, error=e)
+            return
+        if placement is not None:
+            placement.append(client)
+        else:
+            result.add_done_callback(lambda _: self.__release_client__(conn, client))
+        channel.channel = ssh_chnl
+        self.__watch_channel__(ssh_chnl, result)
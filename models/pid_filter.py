@@ -0,0 +1,43 @@
+from . import logger
+
+__author__ = 'mlesko'
+
+
+class PidFilter(object):
+    """
+    Sink of the standard output of the command started with its pid printed first
+    (see L{dtestlib.executor.models.paramiko_model.ParamikoModel.record_pid}). The first line is consumed
+    and stored as the pid of the command, the rest of the output is passed to the storage.
+    """
+
+    def __init__(self, command, storage):
+        """
+        @param command: command which receives the pid
+        @type command: Command
+        @param storage: storage of the output of the command
+        @type storage: OutputStorage
+        """
+        self.command = command
+        self.storage = storage
+        self.__head = ""  # beginning of the pid line, None once the line was consumed
+
+    def append(self, data):
+        """
+        Store next chunk of the output, the pid line is not stored.
+        @param data: received chunk
+        @type data: str
+        @rtype: None
+        """
+        if self.__head is not None:
+            data = self.__head + data
+            end = data.find("\n")
+            if end < 0:
+                self.__head = data
+                return
+            self.__head = None
+            try:
+                self.command.pid = int(data[:end])
+            except ValueError:
+                logger.debug("Command: %s did not print its pid: %r" % (self.command.cmd, data[:end]))
+            data = data[end + 1:]
+        self.storage.append(data)
@@ -0,0 +1,136 @@
+from . import logger
+
+__author__ = 'mlesko'
+
+import socket
+import struct
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Token bucket limiting the rate of events. Tokens are refilled with the given rate up to the burst size,
+    every event consumes one token. Bucket is thread safe.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        @param rate: number of events per second
+        @type rate: float
+        @param burst: maximal number of events which may happen at once, None means the rate (at least one)
+        @type burst: int
+        """
+        if rate <= 0:
+            raise ValueError("rate must be a positive number")
+        self.rate = float(rate)
+        self.burst = max(burst if burst is not None else self.rate, 1)
+        self.__lock = threading.Lock()
+        self.__tokens = self.burst
+        self.__stamp = time.time()
+
+    def acquire(self, timeout=None):
+        """
+        Consumes one token, waits till the token is available.
+        @param timeout: maximal time to wait in seconds, None means no limit
+        @type timeout: float
+        @return: True if the token was consumed, False if the timeout expired
+        @rtype: bool
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self.__lock:
+                now = time.time()
+                self.__tokens = min(self.burst, self.__tokens + (now - self.__stamp) * self.rate)
+                self.__stamp = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return True
+                delay = (1 - self.__tokens) / self.rate
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            time.sleep(delay)
+
+    def release(self):
+        """
+        Returns the token consumed by L{acquire}, e.g. when the event did not happen at the end.
+        @rtype: None
+        """
+        with self.__lock:
+            self.__tokens = min(self.burst, self.__tokens + 1)
+
+
+class HandshakeLimiter(object):
+    """
+    Limits the rate of new connections globally and per host or subnet, so mass connecting does not hit
+    limits of the infrastructure (sshd MaxStartups, bastions).
+    """
+
+    def __init__(self, rate=None, burst=None, host_rate=None, host_burst=None, subnet_prefix=None):
+        """
+        @param rate: connections per second of the whole process, None means no limit
+        @type rate: float
+        @param burst: connections which may start at once, None means the rate
+        @type burst: int
+        @param host_rate: connections per second to one host or subnet, None means no limit
+        @type host_rate: float
+        @param host_burst: connections which may start at once to one host or subnet, None means the host rate
+        @type host_burst: int
+        @param subnet_prefix: length of the IPv4 prefix grouping hosts for the host rate, None means per host
+        @type subnet_prefix: int
+        """
+        self.config = (rate, burst, host_rate, host_burst, subnet_prefix)
+        self.__global = TokenBucket(rate, burst) if rate is not None else None
+        self.__host_rate = host_rate
+        self.__host_burst = host_burst
+        self.__subnet_prefix = subnet_prefix
+        self.__lock = threading.Lock()
+        self.__buckets = dict()  # host or subnet -> TokenBucket
+
+    def key(self, address):
+        """
+        @param address: address of the host
+        @type address: str
+        @return: subnet of the IPv4 address if subnet prefix is set, the address itself otherwise
+        @rtype: str
+        """
+        if self.__subnet_prefix is None:
+            return address
+        try:
+            packed = struct.unpack("!I", socket.inet_aton(address))[0]
+        except (socket.error, TypeError):  # host name
+            return address
+        mask = (0xffffffff << (32 - self.__subnet_prefix)) & 0xffffffff
+        return "%s/%s" % (socket.inet_ntoa(struct.pack("!I", packed & mask)), self.__subnet_prefix)
+
+    def acquire(self, address, timeout=None):
+        """
+        Waits till a new connection to the address is allowed.
+        @param address: address of the host
+        @type address: str
+        @param timeout: maximal time to wait in seconds, None means no limit
+        @type timeout: float
+        @return: True if the connection is allowed, False if the timeout expired
+        @rtype: bool
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        bucket = None
+        if self.__host_rate is not None:
+            key = self.key(address)
+            with self.__lock:
+                bucket = self.__buckets.get(key)
+                if bucket is None:
+                    bucket = self.__buckets[key] = TokenBucket(self.__host_rate, self.__host_burst)
+            if not bucket.acquire(timeout):
+                logger.debug("Handshake rate of %s exceeded" % key)
+                return False
+        if self.__global is not None:
+            if not self.__global.acquire(None if deadline is None else max(deadline - time.time(), 0)):
+                logger.debug("Global handshake rate exceeded")
+                if bucket is not None:  # the connection is not made, the host does not lose its token
+                    bucket.release()
+                return False
+        return True
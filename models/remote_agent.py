@@ -0,0 +1,135 @@
+"""
+Agent of the L{dtestlib.executor.models.agent_model.AgentModel}. The source of this module is sent to the remote host
+over the stdin of one channel and executed there, so it uses only the standard library and it runs on Python 2 and 3.
+
+Agent and the model exchange messages, every message is the L{HEADER} followed by the payload:
+    - L{READY}: agent is running, the model may send messages
+    - L{SPAWN}: execute the command (payload) in the shell, the id of the command is chosen by the model
+    - L{STARTED}: command was started, payload is its pid (L{CODE})
+    - L{STDOUT}, L{STDERR}: chunk of the output of the command
+    - L{EXIT}: command finished, payload is its exit code (L{CODE}), 128 + signal if it was killed
+    - L{KILL}: send the signal (L{CODE}) to the process group of the command
+    - L{ERROR}: command could not be started, payload is the description
+Agent kills all its commands and exits once its stdin is closed.
+"""
+import errno
+import os
+import select
+import signal
+import struct
+import subprocess
+
+__author__ = 'mlesko'
+
+HEADER = struct.Struct("!BII")  # message type, id of the command, length of the payload
+CODE = struct.Struct("!i")
+READY, SPAWN, STARTED, STDOUT, STDERR, EXIT, KILL, ERROR = range(8)
+READ_SIZE = 65536
+
+
+def send(kind, ident, payload=b""):
+    data = HEADER.pack(kind, ident, len(payload)) + payload
+    while data:
+        data = data[os.write(1, data):]
+
+
+class Agent(object):
+    def __init__(self):
+        self.processes = dict()  # id -> process
+        self.streams = dict()  # descriptor -> (id, message type, stream)
+        self.exiting = set()  # ids of processes with closed streams
+        self.devnull = open(os.devnull, "rb")
+        self.poller = select.poll() if hasattr(select, "poll") else None  # select is limited by FD_SETSIZE
+        self.watch(0)
+
+    def watch(self, descriptor):
+        if self.poller is not None:
+            self.poller.register(descriptor, select.POLLIN | select.POLLPRI)
+
+    def wait(self, timeout):
+        if self.poller is None:
+            return select.select([0] + list(self.streams), [], [], timeout)[0]
+        return [descriptor for descriptor, _ in self.poller.poll(None if timeout is None else timeout * 1000)]
+
+    def spawn(self, ident, command):
+        if str is not bytes:
+            command = command.decode("utf-8", "surrogateescape")
+        try:
+            process = subprocess.Popen(command, shell=True, stdin=self.devnull, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, close_fds=True, preexec_fn=os.setsid)
+        except (OSError, ValueError) as e:
+            send(ERROR, ident, str(e).encode("utf-8"))
+            return
+        self.processes[ident] = process
+        self.streams[process.stdout.fileno()] = (ident, STDOUT, process.stdout)
+        self.streams[process.stderr.fileno()] = (ident, STDERR, process.stderr)
+        self.watch(process.stdout.fileno())
+        self.watch(process.stderr.fileno())
+        send(STARTED, ident, CODE.pack(process.pid))
+
+    def kill(self, ident, sig):
+        process = self.processes.get(ident)
+        if process is not None:
+            try:
+                os.killpg(process.pid, sig)
+            except OSError:
+                pass  # already finished
+
+    def handle(self, kind, ident, payload):
+        if kind == SPAWN:
+            self.spawn(ident, payload)
+        elif kind == KILL:
+            self.kill(ident, CODE.unpack(payload)[0])
+
+    def read_stream(self, descriptor):
+        ident, kind, stream = self.streams[descriptor]
+        data = os.read(descriptor, READ_SIZE)
+        if data:
+            send(kind, ident, data)
+            return
+        del self.streams[descriptor]
+        if self.poller is not None:
+            self.poller.unregister(descriptor)
+        stream.close()
+        if not any(ident == other for other, _, _ in self.streams.values()):
+            self.exiting.add(ident)
+
+    def reap(self):
+        for ident in list(self.exiting):
+            code = self.processes[ident].poll()
+            if code is not None:
+                self.exiting.discard(ident)
+                del self.processes[ident]
+                send(EXIT, ident, CODE.pack(code if code >= 0 else 128 - code))
+
+    def run(self):
+        buf = b""
+        send(READY, 0)
+        while True:
+            try:
+                readable = self.wait(0.05 if self.exiting else None)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for descriptor in readable:
+                if descriptor != 0:
+                    self.read_stream(descriptor)
+                    continue
+                data = os.read(0, READ_SIZE)
+                if not data:
+                    for ident in list(self.processes):
+                        self.kill(ident, signal.SIGTERM)
+                    return
+                buf += data
+                while len(buf) >= HEADER.size:
+                    kind, ident, length = HEADER.unpack(buf[:HEADER.size])
+                    if len(buf) < HEADER.size + length:
+                        break
+                    self.handle(kind, ident, buf[HEADER.size:HEADER.size + length])
+                    buf = buf[HEADER.size + length:]
+            self.reap()
+
+
+if __name__ == "__main__":
+    Agent().run()
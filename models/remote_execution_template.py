@@ -16,16 +16,20 @@ class RemoteExecutionTemplate(object):
     __metaclass__ = SingletonWrapper
 
     # __meta_set__ = set()  # set used by metaclass to model registration
+    # exceptions of the execution which mean the connection is not usable, other ones are errors of the command
+    connection_errors = (ConnectionException, EnvironmentError, EOFError)
 
     def __init__(self):
         pass
 
-    def connect(self, connection):
+    def connect(self, connection, timeout=None):
         """
         Connects via underlying module using specified connection object.
         If connection object was already connected connecting is skipped.
         @param connection: connection object to be used
         @type connection: Connection
+        @param timeout: timeout in seconds of the connection establishment, None means no limit
+        @type timeout: float
         @warning: this method needs to be implemented in the child class
         @raise NotImplementedError:
         @return: None
@@ -33,6 +37,15 @@ class RemoteExecutionTemplate(object):
         """
         raise NotImplementedError
 
+    @classmethod
+    def _reset_after_fork(cls):
+        """
+        Drops the state inherited from the parent process, which is not usable in the forked process
+        (e.g. background threads). Child class with such state needs to override this method.
+        @rtype: None
+        """
+        pass
+
     def close_connection(self, connection=None):
         """
         Closes connection - invalidates it for further usage
@@ -0,0 +1,256 @@
+from . import logger
+
+__author__ = 'mlesko'
+
+import collections
+import pipes
+import threading
+import time
+import uuid
+
+from executor_exceptions import WaitTimeout
+
+
+class SessionEntry(object):
+    """
+    Output and exit code of one command executed by the L{ShellSession}. The session fills the entry
+    and calls L{on_update}, the result reads the entry via functions provided by L{reader}.
+    """
+
+    def __init__(self, on_update=None):
+        """
+        @param on_update: function without arguments called whenever the entry changes
+        """
+        self.seq = None  # sequence number of the command in the session
+        self.ecode = None
+        self.pid = None  # process id of the command, if the session knows it
+        self.error = None  # exception which ended the session before the command finished
+        self.on_update = on_update
+        self.__chunks = {"stdout": [], "stderr": []}
+        self.__eof = {"stdout": False, "stderr": False}
+
+    @property
+    def finished(self):
+        """
+        @return: True if both streams of the command ended
+        @rtype: bool
+        """
+        return self.__eof["stdout"] and self.__eof["stderr"]
+
+    def _feed(self, stream, data=None, eof=False):
+        if data:
+            self.__chunks[stream].append(data)
+        if eof:
+            self.__eof[stream] = True
+
+    def reader(self, stream):
+        """
+        Provides a reader function in the form used by the L{ExecResult}.
+        @param stream: "stdout" or "stderr"
+        @type stream: str
+        @return: function taking the output storage and returning the function which moves received data
+            into the storage and returns True when the stream ended
+        """
+
+        def receive(output_data):
+            def wrapper():
+                eof = self.__eof[stream]  # checked before reading, no data can be missed
+                chunks, self.__chunks[stream] = self.__chunks[stream], []
+                for chunk in chunks:
+                    output_data.append(chunk)
+                return eof
+
+            return wrapper
+
+        return receive
+
+
+class ShellSession(object):
+    """
+    Long-lived shell executing many commands, so no channel has to be opened per command.
+    Commands are written to the stdin of the shell and they are executed one by one, every command
+    is passed quoted to C{eval} in a subshell with stdin redirected from /dev/null, so even a malformed
+    command can't break the framing. Output of every command is terminated by a sentinel carrying
+    the sequence number of the command (and its exit code on the stdout).
+    Sentinels contain a random token, so they can't be confused with the output of commands.
+    If the running command exceeds the timeout of the session, the session fails, the owner starts a new one.
+
+    The session does not read the channel itself, the owner feeds it with received data via
+    L{feed_stdout} and L{feed_stderr}.
+    """
+    shell = "/bin/sh"
+
+    def __init__(self, channel, on_close=None, timeout=None):
+        """
+        @param channel: channel with running L{shell}, only its C{sendall} is used
+        @param on_close: function without arguments called once the session ends
+        @param timeout: seconds one command may run, None means no limit
+        @type timeout: float
+        """
+        self.channel = channel
+        self.timeout = timeout
+        self.token = "__executor_%s" % uuid.uuid4().hex
+        self.closed = False
+        self.error = None
+        self.__on_close = on_close
+        self.__lock = threading.Lock()
+        self.__counter = 0
+        self.__pending = {"stdout": collections.deque(), "stderr": collections.deque()}  # entries in FIFO order
+        self.__buffers = {"stdout": "", "stderr": ""}
+        self.__started = None  # time when the first unfinished command started
+        self.__watchdog = None  # timer checking the timeout of the running command
+
+    def __len__(self):
+        """
+        @return: number of unfinished commands
+        @rtype: int
+        """
+        return len(self.__pending["stdout"])
+
+    def frame(self, seq, command):
+        """
+        @return: shell script executing the command and printing its sentinels
+        @rtype: str
+        """
+        return "( eval %s\n) </dev/null; printf '%s %d %%d\\n' $?; printf '%s %d\\n' >&2\n" % (
+            pipes.quote(command), self.token, seq, self.token, seq)
+
+    def submit(self, command, entry):
+        """
+        Writes the command to the shell. Commands are not waited for, so they are pipelined.
+        @param command: command to execute
+        @type command: str
+        @param entry: entry which receives the output of the command
+        @type entry: SessionEntry
+        @raise Exception: if the session is closed or the command can't be written
+        """
+        with self.__lock:
+            if self.closed:
+                raise self.error
+            entry.seq = self.__counter
+            self.__counter += 1
+            if not self.__pending["stdout"]:
+                self.__started = time.time()
+            self.__pending["stdout"].append(entry)
+            self.__pending["stderr"].append(entry)
+            try:
+                self.channel.sendall(self.frame(entry.seq, command))
+            except Exception as e:
+                self.__pending["stdout"].pop()
+                self.__pending["stderr"].pop()
+                raise e
+            self.__arm()
+
+    def feed_stdout(self, data):
+        """
+        Processes data received on the standard output of the shell.
+        @type data: str
+        @rtype: None
+        """
+        self.__feed("stdout", data)
+
+    def feed_stderr(self, data):
+        """
+        Processes data received on the standard error output of the shell.
+        @type data: str
+        @rtype: None
+        """
+        self.__feed("stderr", data)
+
+    def __feed(self, stream, data):
+        updated = []
+        with self.__lock:
+            pending = self.__pending[stream]
+            buf = self.__buffers[stream] + data
+            while pending:
+                entry = pending[0]
+                marker = "%s %d%s" % (self.token, entry.seq, " " if stream == "stdout" else "\n")
+                position = buf.find(marker)
+                if position < 0:  # end of the buffer may be a beginning of the marker
+                    keep = min(len(marker) - 1, len(buf))
+                    entry._feed(stream, buf[:len(buf) - keep])
+                    buf = buf[len(buf) - keep:]
+                    updated.append(entry)
+                    break
+                entry._feed(stream, buf[:position])
+                buf = buf[position + len(marker):]
+                if stream == "stdout":
+                    end = buf.find("\n")
+                    if end < 0:  # exit code is not complete yet, the marker is kept
+                        buf = marker + buf
+                        updated.append(entry)
+                        break
+                    entry.ecode = int(buf[:end])
+                    buf = buf[end + 1:]
+                entry._feed(stream, eof=True)
+                pending.popleft()
+                if stream == "stdout":  # the next command starts once the previous one printed its exit code
+                    self.__started = time.time()
+                updated.append(entry)
+            else:
+                if buf:
+                    logger.debug("Shell session dropped unexpected output: %r" % buf[:80])
+                buf = ""
+            self.__buffers[stream] = buf
+            self.__arm()
+        for entry in updated:
+            self.__notify(entry)
+
+    def fail(self, error):
+        """
+        Ends the session, unfinished commands fail with the error.
+        @param error: reason of the end
+        @type error: Exception
+        @rtype: None
+        """
+        with self.__lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.error = error
+            if self.__watchdog is not None:
+                self.__watchdog.cancel()
+                self.__watchdog = None
+            entries = dict((entry.seq, entry) for entry in self.__pending["stdout"])
+            entries.update((entry.seq, entry) for entry in self.__pending["stderr"])
+            entries = [entries[seq] for seq in sorted(entries)]
+            self.__pending["stdout"].clear()
+            self.__pending["stderr"].clear()
+        logger.debug("Shell session ended: %r, %s commands failed" % (error, len(entries)))
+        for entry in entries:
+            entry.error = error
+            entry._feed("stdout", eof=True)
+            entry._feed("stderr", eof=True)
+            self.__notify(entry)
+        if self.__on_close is not None:
+            self.__on_close()
+
+    def __arm(self):
+        """
+        Starts the watchdog of the running command, if it is not running already. Must be called under the lock.
+        @rtype: None
+        """
+        if self.timeout is None or self.closed or self.__watchdog is not None or not self.__pending["stdout"]:
+            return
+        self.__watchdog = threading.Timer(max(self.__started + self.timeout - time.time(), 0), self.__check_timeout)
+        self.__watchdog.daemon = True
+        self.__watchdog.start()
+
+    def __check_timeout(self):
+        with self.__lock:
+            self.__watchdog = None
+            if self.closed or not self.__pending["stdout"]:
+                return
+            if time.time() < self.__started + self.timeout:  # the command started after the watchdog
+                self.__arm()
+                return
+            seq = self.__pending["stdout"][0].seq
+        self.fail(WaitTimeout("command %s of the shell session did not finish in %s seconds" % (seq, self.timeout)))
+
+    @staticmethod
+    def __notify(entry):
+        if entry.on_update is not None:
+            try:
+                entry.on_update()
+            except Exception:
+                logger.exception("Update of the shell session command %s failed" % entry.seq)
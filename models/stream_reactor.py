@@ -0,0 +1,169 @@
+from . import logger
+
+__author__ = 'mlesko'
+
+import errno
+import os
+import select
+import threading
+
+
+class StreamReactor(object):
+    """
+    Multiplexes many stream sources in one background thread. A source is any object
+    providing C{fileno()}, typically paramiko.channel.Channel. When the descriptor of the source
+    becomes readable, the callback mapped to the source is called from the reactor thread.
+
+    The callback must not block and it has to return one of:
+
+      - L{POLL}: source is still streaming, wait for the next readiness of its descriptor
+      - L{LINGER}: descriptor has nothing more to offer, but the source is not finished yet
+        (e.g. exit status did not arrive), callback is called every L{linger_interval} seconds
+      - L{DONE}: source is finished and it is removed from the reactor
+
+    If anything related to the source raises, the source is removed from the reactor
+    and its error callback is called with the exception.
+    """
+    POLL = 0
+    LINGER = 1
+    DONE = 2
+
+    linger_interval = 0.01  # seconds, used only when there is a lingering source
+
+    __READ_MASK = getattr(select, "POLLIN", 1) | getattr(select, "POLLPRI", 2) | getattr(select, "POLLHUP", 16) | \
+                  getattr(select, "POLLERR", 8)
+
+    def __init__(self, name="stream-reactor"):
+        """
+        Creates reactor and starts its thread.
+        @param name: name of the reactor thread
+        @type name: str
+        """
+        self.name = name
+        self.__lock = threading.Lock()
+        self.__pending = []  # sources waiting for registration, registration is done by the reactor thread only
+        self.__sources = dict()  # fd -> (callback, error_callback)
+        self.__lingering = []  # (callback, error_callback)
+        self.__wake_r, self.__wake_w = os.pipe()
+        if hasattr(select, "poll"):
+            self.__poller = select.poll()
+            self.__poller.register(self.__wake_r, self.__READ_MASK)
+        else:  # select.select fallback, limited by FD_SETSIZE
+            self.__poller = None
+        self.__thread = threading.Thread(target=self.__run, name=name)
+        self.__thread.daemon = True
+        self.__thread.start()
+        logger.debug("%s started" % name)
+
+    def __len__(self):
+        """
+        @return: number of sources handled by the reactor
+        @rtype: int
+        """
+        with self.__lock:
+            return len(self.__sources) + len(self.__lingering) + len(self.__pending)
+
+    def register(self, fileobj, callback, error_callback=None):
+        """
+        Adds source to the reactor. The callback is called once right after the registration,
+        so data which were already received are not stuck.
+        @param fileobj: object providing fileno()
+        @param callback: function without arguments returning L{POLL}, L{LINGER} or L{DONE}
+        @param error_callback: function called with an exception raised during source processing
+        @rtype: None
+        """
+        with self.__lock:
+            self.__pending.append((fileobj, callback, error_callback))
+            wake_up = len(self.__pending) == 1  # otherwise the reactor was already woken up
+        if wake_up:
+            os.write(self.__wake_w, b"x")
+
+    def __select(self, timeout):
+        """
+        Waits for readable descriptors.
+        @param timeout: timeout in seconds or None to wait infinitely
+        @return: list of tuples (fd, event mask)
+        @rtype: list
+        """
+        if self.__poller is not None:
+            return self.__poller.poll(None if timeout is None else timeout * 1000)
+        readable, _, _ = select.select([self.__wake_r] + self.__sources.keys(), [], [], timeout)
+        return [(fd, self.__READ_MASK) for fd in readable]
+
+    def __unregister(self, fd):
+        self.__sources.pop(fd, None)
+        if self.__poller is not None:
+            self.__poller.unregister(fd)
+
+    def __fail(self, error_callback, exc):
+        logger.debug("%s dropped source due to: %r" % (self.name, exc))
+        if error_callback is not None:
+            try:
+                error_callback(exc)
+            except Exception:
+                logger.exception("%s error callback failed" % self.name)
+
+    def __dispatch(self, callback, error_callback, fd=None):
+        """
+        Calls source callback and handles its state change.
+        @param fd: descriptor of the source, None for the lingering source
+        @rtype: None
+        """
+        try:
+            state = callback()
+        except Exception as e:
+            if fd is not None:
+                self.__unregister(fd)
+            self.__fail(error_callback, e)
+            return
+        if fd is not None:
+            if state == StreamReactor.POLL:
+                return
+            self.__unregister(fd)
+        if state != StreamReactor.DONE:  # source without descriptor can only linger
+            self.__lingering.append((callback, error_callback))
+
+    def __register_pending(self):
+        with self.__lock:
+            pending, self.__pending = self.__pending, []
+        for fileobj, callback, error_callback in pending:
+            try:
+                fd = fileobj.fileno()
+                if self.__poller is not None:
+                    self.__poller.register(fd, self.__READ_MASK)
+                elif not isinstance(fd, (int, long)):
+                    raise TypeError("fileno() must return an integer")
+            except Exception as e:
+                self.__fail(error_callback, e)
+                continue
+            self.__sources[fd] = (callback, error_callback)
+            self.__dispatch(callback, error_callback, fd)
+
+    def __run_lingering(self):
+        lingering, self.__lingering = self.__lingering, []
+        for callback, error_callback in lingering:
+            self.__dispatch(callback, error_callback)
+
+    def __run(self):
+        while True:
+            self.__register_pending()
+            self.__run_lingering()
+            timeout = self.linger_interval if self.__lingering else None
+            try:
+                events = self.__select(timeout)
+            except (select.error, IOError, OSError) as e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self.__wake_r:
+                    os.read(self.__wake_r, 4096)
+                    continue
+                source = self.__sources.get(fd)
+                if source is None:
+                    continue
+                if event & getattr(select, "POLLNVAL", 0):  # descriptor was closed by its owner
+                    self.__unregister(fd)
+                    self.__lingering.append(source)
+                    continue
+                self.__dispatch(source[0], source[1], fd)
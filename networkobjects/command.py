@@ -5,6 +5,18 @@ import executor_exceptions
 
 __author__ = 'mlesko'
 
+# capture policies - which part of the command output is kept in its result
+CAPTURE_ALL = "all"  # whole output
+CAPTURE_HEAD = "head"  # only first capture_limit bytes
+CAPTURE_TAIL = "tail"  # only last capture_limit bytes
+CAPTURE_DISCARD = "discard"  # nothing, output is only drained from the channel
+CAPTURE_POLICIES = (CAPTURE_ALL, CAPTURE_HEAD, CAPTURE_TAIL, CAPTURE_DISCARD)
+
+# priorities - commands with higher priority are dispatched first when the connection has no free channel
+PRIORITY_LOW = -10  # bulk work
+PRIORITY_NORMAL = 0
+PRIORITY_HIGH = 10  # control commands (kill, health probes), not held back even by exclusive commands
+
 
 # Create only via model for full functionality
 class Command(object):
@@ -13,7 +25,8 @@ class Command(object):
     creating command via provided API of L{dtestlib.executor.executor.Executor}
     """
 
-    def __init__(self, command=None, kill_func=None, exclusive=False):
+    def __init__(self, command=None, kill_func=None, exclusive=False, capture=CAPTURE_ALL, capture_limit=None,
+                 depends_on=(), priority=PRIORITY_NORMAL):
         """
         Initialize command
         @param command: command to be executed
@@ -21,18 +34,41 @@ class Command(object):
         @param kill_func: function that is mapped to "kill" the command
         @param exclusive: Flag that marks exclusive execution. It means no other commands no matter what will be processed  before this command is processed
         @type exclusive: bool
+        @param capture: capture policy of the output, one of L{CAPTURE_POLICIES}
+        @type capture: str
+        @param capture_limit: number of bytes of every stream kept by L{CAPTURE_HEAD} and L{CAPTURE_TAIL} policies
+        @type capture_limit: int
+        @param depends_on: commands which have to succeed before this command is executed, see
+            L{dtestlib.executor.executor.Executor.execute_graph}
+        @type depends_on: iterable
+        @param priority: dispatch priority of the command, e.g. L{PRIORITY_HIGH}
+        @type priority: int
         """
 
         if not isinstance(command, basestring):
             raise executor_exceptions.InvalidCommandValue("Command must be string")
+        if capture not in CAPTURE_POLICIES:
+            raise executor_exceptions.InvalidCommandValue("capture must be one of %s" % (CAPTURE_POLICIES,))
+        if capture in (CAPTURE_HEAD, CAPTURE_TAIL) and (not isinstance(capture_limit, (int, long)) or capture_limit < 0):
+            raise executor_exceptions.InvalidCommandValue("capture_limit must be non-negative integer")
+        depends_on = list(depends_on)
+        if not all(isinstance(dependency, Command) for dependency in depends_on):
+            raise executor_exceptions.InvalidCommandValue("dependencies must be instances of the Command class")
+        if not isinstance(priority, (int, long)):
+            raise executor_exceptions.InvalidCommandValue("priority must be integer")
 
         self.cmd = command
         self.stdin = None  # TODO ask about this zkraus
         self.time_stamp = None  # time should be filled right before execution #float (time.time())
         self.connection = None  # filled during execution
         self.pid = None  # filled during execution
+        self._record_pid = False  # the model starts the command with its pid printed first
         self._kill_func = kill_func  # kill is not mandatory during initialization due to possible problematic references in model. Please be sure what you are doing if you do not create Command via model method.
         self.exclusive = exclusive  # is this command exclusive - blocking - command? - such command blocks processing of another ones in the queue
+        self.capture = capture
+        self.capture_limit = capture_limit
+        self.depends_on = depends_on
+        self.priority = priority
 
     def kill(self, sig=signal.SIGTERM):
         """
@@ -69,6 +69,11 @@ class Connection(NetworkObject):
             self._close_f = None
             self._connect = None
             self.connected = False
+            self.last_used = None  # time of the last activity (connect, command start or end), filled by the model
+            # commands are executed one by one in a long-lived shell instead of a channel per command
+            self.session_mode = False
+            # number of session channels the model keeps opened in advance, so commands only send exec_command
+            self.channel_pool_size = 0
             super(Connection, self).__init__(self.id)
             logger.debug('Created %s' % self)
 
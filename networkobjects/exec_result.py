@@ -1,8 +1,9 @@
+import threading
 import time
-from multiprocessing.pool import ThreadPool
 
 from command import Command
 from connection import Connection
+from output_storage import LineSplitter, OutputStorage, strip_line_break
 import executor_exceptions
 from . import logger
 
@@ -17,7 +18,7 @@ class ExecResult(object):
 
     # TODO process_id, user_name(credentials), sys_prof (test_node object teoreticky),
     def __init__(self, command=None, exit_status_func=None, receive_stdout_func=None, receive_stderr_func=None,
-                 connection=None):
+                 connection=None, spill_threshold=None):
         """
         @param command: command that was executed and is associated with its result
         @type command: Command
@@ -26,6 +27,8 @@ class ExecResult(object):
         @param receive_stderr_func: function used for stderr receiving
         @param connection: connection object associated with the executed command and result
         @type connection: Connection
+        @param spill_threshold: size of the output in bytes after which it is moved to a temporary file, None disables it
+        @type spill_threshold: int
         """
         if not isinstance(command, Command):
             raise executor_exceptions.InvalidCommandValue("cmd must be an instance of the Command class")
@@ -35,26 +38,34 @@ class ExecResult(object):
             raise executor_exceptions.InvalidConnection("connection must be an instance of Connection class")
 
         self.connection = connection
-        self._stdout = []
+        self._stdout = []  # lines, filled when the result is available
         self._stderr = []
+        self.__stdout_storage = OutputStorage(spill_threshold, command.capture, command.capture_limit)
+        self.__stderr_storage = OutputStorage(spill_threshold, command.capture, command.capture_limit)
         self.ecode = None
+        self.error = None  # exception which prevented the execution or reading of the output
         self.ts_start = command.time_stamp  # float (time.time())
         self.stdin = command.stdin
         self.ts_stop = None
         self._exit_status_f = exit_status_func
         self.result_available = False
+        self.__available_event = threading.Event()  # set once the result is available
+        self.__streams_cond = threading.Condition()  # notified whenever new data arrived, used by line iterators
+        self.__done_callbacks = []  # guarded by __streams_cond
+        self.__finalizing = False  # guarded by __streams_cond, set by the first _finalize call
         self.cmd = self.__cmd_interconnect__(command)  # position dependent initialization!!
-        self.__fetch_streams(receive_stdout_func, receive_stderr_func)
+        # readers only fetch already received data, they are driven by the model (see _fetch_streams)
+        self.__stdout_reader = receive_stdout_func(self.__stdout_storage)
+        self.__stderr_reader = receive_stderr_func(self.__stderr_storage)
+        self.__stdout_eof = False
+        self.__stderr_eof = False
 
     @property
     def stdout(self):
         if self.result_available:
             return self._stdout
         else:
-            try:
-                return self._stdout[0].splitlines()
-            except IndexError:
-                return self._stdout
+            return self.__stdout_storage.lines()
 
     @stdout.setter
     def stdout(self, value):
@@ -65,15 +76,74 @@ class ExecResult(object):
         if self.result_available:
             return self._stderr
         else:
-            try:
-                return self._stderr[0].splitlines()
-            except IndexError:
-                return self._stderr
+            return self.__stderr_storage.lines()
 
     @stderr.setter
     def stderr(self, value):
         self._stderr = value
 
+    @property
+    def stdout_storage(self):
+        """
+        Storage of the standard output. Besides lines it provides slices and regular expression
+        search, which work without loading the spilled output into the memory.
+        @rtype: L{OutputStorage}
+        """
+        return self.__stdout_storage
+
+    @property
+    def stderr_storage(self):
+        """
+        Storage of the standard error output, see L{stdout_storage}.
+        @rtype: L{OutputStorage}
+        """
+        return self.__stderr_storage
+
+    def iter_stdout(self):
+        """
+        Iterate over lines of the standard output as they arrive. Only complete lines are yielded,
+        the last line is yielded when the result is available. The iterator holds only
+        the not yet completed line, so the output can be processed incrementally.
+        Only stored output is iterated, see capture policy of the L{Command}.
+        @return: generator of lines (without line breaks)
+        @rtype: generator
+        """
+        return self.__iter_lines(self.__stdout_storage)
+
+    def iter_stderr(self):
+        """
+        Iterate over lines of the standard error output as they arrive. See L{iter_stdout}.
+        @return: generator of lines (without line breaks)
+        @rtype: generator
+        """
+        return self.__iter_lines(self.__stderr_storage)
+
+    def __iter_lines(self, storage):
+        """
+        Generator of complete lines of the stream.
+        @param storage: storage of the stream
+        @type storage: OutputStorage
+        @return: generator of lines
+        @rtype: generator
+        """
+        splitter = LineSplitter()
+        position = 0  # position of the next data to process in the stream
+        while True:
+            with self.__streams_cond:
+                while not self.result_available and position >= storage.end:
+                    self.__streams_cond.wait()
+                available = self.result_available
+            data_position, data = storage.read_from(position, OutputStorage.BLOCK_SIZE)
+            if data_position != position:  # data were dropped by the tail capture, incomplete line is lost
+                splitter = LineSplitter()
+            position = data_position + len(data)
+            for line in splitter.feed(data):
+                yield strip_line_break(line)
+            if available and position >= storage.end:
+                break
+        for line in splitter.flush():
+            yield strip_line_break(line)
+
     def __cmd_interconnect__(self, cmd):
         """
         Assign result instance to command instance.
@@ -96,95 +166,112 @@ class ExecResult(object):
             return self.ts_stop - self.ts_start
         return None
 
-    def wait_for_data(self):  # API for user to actually wait on the place
+    def wait_for_data(self, timeout=None):  # API for user to actually wait on the place
         """
         Waits till all data from the execution of the associated command
         are available. In the reality data are always fetched on the background.
-        This method provide a way how to specify a waiting.
-        @rtype: None
+        This method provide a way how to specify a waiting. There is no time pooling,
+        the waiting thread is woken up right when the result is finalized.
+        @param timeout: maximal time to wait in seconds, None means to wait till the data are available
+        @type timeout: float
+        @return: True if the result is available
+        @rtype: bool
         """
-        # WAIT_FOR_DATA = 0.1
         logger.debug("RESULT wait_for_data available %s -> command: %s" % (self.result_available, self.cmd.cmd))
-        if not self.result_available:
-            # this is multithreading.pool.ApplyResult instance
-            self.__wait_thread.wait()  # waits till are data provided via mapped function
-
-    def _wait_for_data(self):  # automatically fetches data -- this is necessary for background client method
-        """
-        After an execution, data are automatically fetched on the background by a
-        special thread. This method uses a time pooling. This decision was made
-        due to numerous facts:
-
-          1. Data needs to be accessible before the commands execution ends.
-          2. Wait based on events (no time pooling) causes data stuck if there is
-             bigger output.
-          3. There is a need to fetch stderr & stdout simultaneously therefore
-             a threaded approach is used. For this purpose a multiprocessing module
-             is used which offers real threads. It enables Python to utilize
-             multiple CPU cores in parallel by running additional interpreters
-             as child processes. These child processes are separate from the
-             main interpreter, so their global interpreter locks are also separate.
-             Each child can fully utilize one CPU core. Each child has a link to
-             the main process where it receives instructions to do computation and returns
-             results. This basically provides independent data fetching.
-          3. Commands on this underlying layer are small and fast to execute.
+        self.__available_event.wait(timeout)
+        return self.result_available
 
-        @warning: This method is not for direct call.
+    def add_done_callback(self, func):
+        """
+        Register function called with this result once the result is available. If the result
+        is already available, the function is called right away. Callbacks are called from
+        the thread which finalizes the result, so they should be short.
+        @param func: function taking the result as its only argument
         @rtype: None
         """
-        WAIT_FOR_DATA = 0.01
-
-        # logger.debug("RESULT wait  available %s -> command: %s" % (self.result_available, self.cmd.cmd))
-        if not self.result_available:
+        with self.__streams_cond:
+            if not self.result_available:
+                self.__done_callbacks.append(func)
+                return
+        self.__call_done_callback(func)
 
-            # another approach causes the famous "stuck" during big inputs
-            while not (self.__stdout_async_r.ready() and self.__stderr_async_r.ready()):
-                # logger.debug("WAITING threads for command: %s" % self.cmd.cmd)
-                time.sleep(WAIT_FOR_DATA)
+    def remove_done_callback(self, func):
+        """
+        Unregister the function registered by L{add_done_callback}, which was not called yet.
+        @param func: registered function
+        @return: True if the function was removed
+        @rtype: bool
+        """
+        with self.__streams_cond:
+            if func in self.__done_callbacks:
+                self.__done_callbacks.remove(func)
+                return True
+        return False
 
-            self.result_available = True
-            self.ts_stop = time.time()  # float
-            # these are multithreading.pool.ApplyResult instances
-            self._stdout = self.__stdout_async_r.get()
-            self._stderr = self.__stderr_async_r.get()
-            self.ecode = self._exit_status_f()  # this can be a waiting operation, therefore status is received at the last place
-            logger.debug("Closing threads for command: %s" % self.cmd.cmd)
-            self.stdout_t.close()
-            logger.debug("Closed stdout thread")
-            self.stderr_t.close()
-            logger.debug("Closed stderr thread")
-            self.wait_thread.close()
-            logger.debug("Closed wait thread")
-            logger.debug("Joining threads for command: %s" % self.cmd.cmd)
-            self.stdout_t.join()
-            logger.debug("Joined stdout thread")
-            self.stderr_t.join()
-            logger.debug("Joined stderr thread")
-            # self.wait_thread.join()
-            # logger.debug("Joined wait thread")
-            logger.debug("Threads joined for command: %s" % self.cmd.cmd)
-
-    # This could be done better (more generic), but it would be not beneficial because no other unknown streams will be read
-    def __fetch_streams(self, stdout_func, stderr_func):
-        """
-        Fetches streams using threaded approach to prevent a stuck during big inputs.
-        This problem appears in paramiko package. But it is normal behavior of network
-        channel. Therefore, an universal approach was needed.
-        @param stdout_func: function for stdout receiving provided by model
-        @param stderr_func: function for stderr receiving provided by model
-        @warning: This method is not for direct call.
+    def close(self):
+        """
+        Frees the stored output (e.g. the temporary file of the spilled output), call it once the result
+        is not needed anymore. Lines of the in-memory output remain accessible via L{stdout} and L{stderr},
+        the spilled output is not available anymore.
         @rtype: None
         """
-        stdout_t = ThreadPool(processes=1)
-        stderr_t = ThreadPool(processes=1)
-        wait_thread = ThreadPool(processes=1)
+        self.__stdout_storage.release()
+        self.__stderr_storage.release()
 
-        self.stdout_t = stdout_t
-        self.stderr_t = stderr_t
-        self.wait_thread = wait_thread
+    def __call_done_callback(self, func):
+        try:
+            func(self)
+        except Exception:
+            logger.exception("Done callback of the command: %s failed" % self.cmd.cmd)
 
-        # method apply_async creates multithreading.pool.ApplyResult instances
-        self.__stdout_async_r = stdout_t.apply_async(func=stdout_func(self._stdout))
-        self.__stderr_async_r = stderr_t.apply_async(func=stderr_func(self._stderr))
-        self.__wait_thread = wait_thread.apply_async(
-            func=self._wait_for_data)  # THIS IS EXTREMELY NECESSARY for start_background
+    def _fetch_streams(self):
+        """
+        Fetches already received data of both streams via functions mapped by the model.
+        The model calls this method whenever the underlying channel signals the readiness,
+        so no thread is blocked per result. Data needs to be accessible before the command
+        execution ends, therefore they are stored right away.
+        @warning: This method is not for direct call.
+        @return: True if both streams reached their end
+        @rtype: bool
+        """
+        received = len(self.__stdout_storage) + len(self.__stderr_storage)
+        if not self.__stdout_eof:
+            self.__stdout_eof = self.__stdout_reader()
+        if not self.__stderr_eof:
+            self.__stderr_eof = self.__stderr_reader()
+        if received != len(self.__stdout_storage) + len(self.__stderr_storage):
+            with self.__streams_cond:
+                self.__streams_cond.notify_all()
+        return self.__stdout_eof and self.__stderr_eof
+
+    def _finalize(self, exit_status=True, error=None):
+        """
+        Makes the result available. Called by the model when streams are read completely,
+        only the first call of concurrent callers (e.g. reader and watchdog) finalizes the result.
+        @param exit_status: whether exit status should be received, it is False when reading of the streams failed
+        @type exit_status: bool
+        @param error: exception which caused the failure of the execution
+        @type error: Exception
+        @warning: This method is not for direct call.
+        @rtype: None
+        """
+        with self.__streams_cond:
+            if self.__finalizing:
+                return
+            self.__finalizing = True
+        self.ts_stop = time.time()  # float
+        self.__stdout_storage.close()
+        self.__stderr_storage.close()
+        self._stdout = self.__stdout_storage.lines()
+        self._stderr = self.__stderr_storage.lines()
+        self.error = error
+        if exit_status:
+            self.ecode = self._exit_status_f()
+        with self.__streams_cond:
+            self.result_available = True
+            self.__streams_cond.notify_all()
+            callbacks, self.__done_callbacks = self.__done_callbacks, []
+        self.__available_event.set()
+        for func in callbacks:
+            self.__call_done_callback(func)
+        logger.debug("Result of the command: %s is available" % self.cmd.cmd)
@@ -40,6 +40,7 @@ class Host(NetworkObject):
             self.port = port
             self.id = _id
             self.connections = set()  # list is not appropriate due to possible high redundancy of same connections
+            self.transport_profile = None  # TransportProfile of SSH transports, None means the default of the model
             super(Host, self).__init__(self.id)
             logger.debug('Created %s' % self)
 
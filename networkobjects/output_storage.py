@@ -0,0 +1,391 @@
+import array
+import bisect
+import mmap
+import re
+import tempfile
+import threading
+
+from command import CAPTURE_ALL, CAPTURE_DISCARD, CAPTURE_HEAD, CAPTURE_TAIL
+from . import logger
+
+__author__ = 'mlesko'
+
+
+def strip_line_break(line):
+    """
+    Remove line break from the end of the line produced by L{LineSplitter}
+    @type line: str
+    @rtype: str
+    """
+    return line.splitlines()[0] if line else line
+
+
+class LineSplitter(object):
+    """
+    Splits a stream fed by chunks into lines in the same way as str.splitlines does for the whole stream.
+    Lines are returned with their line breaks, only the incomplete line is held.
+    """
+
+    def __init__(self):
+        self.pending = []  # chunks of the incomplete line, joined once the line is complete
+
+    def feed(self, data):
+        """
+        @param data: next chunk of the stream
+        @type data: str
+        @return: complete lines including line breaks
+        @rtype: list
+        """
+        if len(data.splitlines(True)) <= 1 and not data.endswith(("\n", "\r")) and \
+                not (self.pending and self.pending[-1].endswith("\r")):  # no line break, the line continues
+            if data:
+                self.pending.append(data)
+            return []
+        self.pending.append(data)
+        lines = "".join(self.pending).splitlines(True)
+        # line ending with '\r' may continue with '\n' in the next chunk
+        self.pending = [lines.pop()] if lines and not lines[-1].endswith("\n") else []
+        return lines
+
+    def flush(self):
+        """
+        End of the stream, the incomplete line is complete now.
+        @return: last line if there is any
+        @rtype: list
+        """
+        pending, self.pending = "".join(self.pending), []
+        return [pending] if pending else []
+
+
+class OutputStorage(object):
+    """
+    Storage of the output of one stream. Received chunks are kept in the memory and joined only once.
+    If a spill threshold is set and the output exceeds it, the whole output is moved to a temporary file
+    and following chunks are appended to the file. Spilled output is accessed through mmap, therefore
+    it is not loaded into the heap, only an index of lines is built when lines are requested.
+
+    What is stored is given by the capture policy (see L{networkobjects.command}): whole output, only its first
+    or last C{capture_limit} bytes or nothing at all. Data which are not stored are dropped right away,
+    L{received} still counts them.
+
+    Storage supports slices (C{storage[10:20]}), L{read}, L{lines} and regular expression L{search}.
+    """
+    BLOCK_SIZE = 1048576  # bytes read at once when spilled output is scanned
+
+    def __init__(self, spill_threshold=None, capture=CAPTURE_ALL, capture_limit=None):
+        """
+        @param spill_threshold: size in bytes after which the output is moved to a temporary file, None disables it
+        @type spill_threshold: int
+        @param capture: capture policy, one of L{CAPTURE_POLICIES}
+        @type capture: str
+        @param capture_limit: number of bytes kept by the head and tail capture policies
+        @type capture_limit: int
+        """
+        self.spill_threshold = spill_threshold if capture != CAPTURE_TAIL else None  # tail is always bounded
+        self.capture = capture
+        self.capture_limit = capture_limit
+        self.received = 0  # number of all received bytes, including dropped ones
+        self.closed = False  # no more data will be appended
+        self.__lock = threading.RLock()
+        self.__start = 0  # stream position of the first stored byte, only tail capture moves it
+        self.__end = 0  # stream position after the last stored byte
+        self.__chunks = []
+        self.__offsets = []  # stream position of every chunk
+        self.__lines = (None, None)  # ((start, end), lines) cache of the in-memory output
+        self.__file = None
+        self.__mmap = None
+
+    def __len__(self):
+        return self.__end - self.__start
+
+    def __getitem__(self, item):
+        size = len(self)
+        if isinstance(item, slice):
+            indices = xrange(*item.indices(size))
+            if not indices:
+                return ""
+            first, last = min(indices[0], indices[-1]), max(indices[0], indices[-1])
+            data = self.read(first, last - first + 1)  # only the covered range is read
+            return data if item.step in (None, 1) else data[indices[0] - first::item.step]
+        if item < 0:
+            item += size
+        if not 0 <= item < size:
+            raise IndexError("storage index out of range")
+        return self.read(item, 1)
+
+    def __str__(self):
+        return "%s object: %s of %s bytes%s" % (self.__class__.__name__, len(self), self.received,
+                                                " (spilled)" if self.spilled else "")
+
+    @property
+    def spilled(self):
+        """
+        @return: True if the output was moved to the temporary file
+        @rtype: bool
+        """
+        return self.__file is not None
+
+    @property
+    def end(self):
+        """
+        @return: stream position after the last stored byte
+        @rtype: int
+        """
+        return self.__end
+
+    @property
+    def truncated(self):
+        """
+        @return: True if some received data were not stored due to the capture policy
+        @rtype: bool
+        """
+        return self.received != len(self)
+
+    def append(self, data):
+        """
+        Store next chunk of the output according to the capture policy.
+        @param data: received chunk
+        @type data: str
+        @rtype: None
+        """
+        if not data:
+            return
+        with self.__lock:
+            self.received += len(data)
+            if self.capture == CAPTURE_DISCARD:
+                return
+            if self.capture == CAPTURE_HEAD:
+                data = data[:max(self.capture_limit - self.__end, 0)]
+                if not data:
+                    return
+            if self.__file is not None:
+                self.__file.write(data)
+                self.__end += len(data)
+                return
+            self.__offsets.append(self.__end)
+            self.__chunks.append(data)
+            self.__end += len(data)
+            if self.capture == CAPTURE_TAIL:
+                self.__trim()
+            elif self.spill_threshold is not None and len(self) > self.spill_threshold:
+                self.__spill()
+
+    def close(self):
+        """
+        Marks the end of the output. In-memory chunks are joined into one.
+        @rtype: None
+        """
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.flush()
+            elif len(self.__chunks) > 1:
+                self.__chunks = ["".join(self.__chunks)]
+                self.__offsets = [self.__start]
+            self.closed = True
+
+    def release(self):
+        """
+        Frees the stored output, the temporary file and its mapping are closed. Storage is empty afterwards.
+        @rtype: None
+        """
+        with self.__lock:
+            if self.__mmap is not None:
+                self.__mmap.close()
+                self.__mmap = None
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+            self.__chunks = []
+            self.__offsets = []
+            self.__lines = (None, None)
+            self.__start = self.__end
+            self.closed = True
+
+    def __trim(self):
+        """
+        Drop the oldest data exceeding the capture limit, storage works as a ring buffer.
+        """
+        while len(self) > self.capture_limit:
+            excess = len(self) - self.capture_limit
+            if len(self.__chunks[0]) <= excess:
+                self.__start += len(self.__chunks[0])
+                del self.__chunks[0], self.__offsets[0]
+            else:
+                self.__chunks[0] = self.__chunks[0][excess:]
+                self.__offsets[0] += excess
+                self.__start += excess
+
+    def __spill(self):
+        self.__file = tempfile.TemporaryFile(prefix="executor-output-")
+        for chunk in self.__chunks:
+            self.__file.write(chunk)
+        self.__chunks = []
+        self.__offsets = []
+        self.__lines = (None, None)
+        logger.debug("Output of %s bytes was spilled to the temporary file" % len(self))
+
+    def __map(self):
+        """
+        @return: mmap of the whole spilled output
+        @rtype: mmap.mmap
+        """
+        if self.__mmap is None or len(self.__mmap) != self.__end:
+            self.__file.flush()
+            if self.__mmap is not None:  # the output grew, the old mapping is replaced
+                self.__mmap.close()
+            self.__mmap = mmap.mmap(self.__file.fileno(), self.__end, access=mmap.ACCESS_READ)
+        return self.__mmap
+
+    def read(self, offset=0, size=None):
+        """
+        Read part of the stored output.
+        @param offset: position of the first byte in the stored output
+        @type offset: int
+        @param size: maximal number of bytes, None means till the end of the output
+        @type size: int
+        @return: data
+        @rtype: str
+        """
+        with self.__lock:
+            return self.__read(self.__start + offset, size)
+
+    def read_from(self, position, size=None):
+        """
+        Read the output at the given position of the stream. If the data at the position were
+        already dropped (tail capture), reading continues with the first stored byte.
+        @param position: position in the whole stream
+        @type position: int
+        @param size: maximal number of bytes, None means till the end of the output
+        @type size: int
+        @return: position of the returned data and the data
+        @rtype: tuple
+        """
+        with self.__lock:
+            position = max(position, self.__start)
+            return position, self.__read(position, size)
+
+    def __read(self, position, size):
+        end = self.__end if size is None else min(self.__end, position + size)
+        if position >= end:
+            return ""
+        if self.__file is not None:
+            return self.__map()[position:end]
+        first = bisect.bisect_right(self.__offsets, position) - 1
+        last = bisect.bisect_left(self.__offsets, end)
+        start = position - self.__offsets[first]
+        return "".join(self.__chunks[first:last])[start:start + end - position]
+
+    def getvalue(self):
+        """
+        @return: whole stored output, note that the spilled output is loaded into the heap
+        @rtype: str
+        """
+        return self.read()
+
+    def search(self, pattern, flags=0):
+        """
+        Search regular expression in the output. Spilled output is searched directly in the mmap.
+        @param pattern: regular expression
+        @type pattern: str
+        @param flags: flags of the L{re} module
+        @return: iterator of match objects
+        @rtype: iterator
+        """
+        with self.__lock:
+            if self.__file is not None:
+                data = self.__map() if self.__end > 0 else ""
+            else:
+                data = "".join(self.__chunks)
+        return re.finditer(pattern, data, flags)
+
+    def lines(self):
+        """
+        Lines of the output stored so far. In-memory output provides a list, the spilled
+        output provides L{MappedLines} which reads lines from the temporary file on demand.
+        @return: lines without line breaks
+        @rtype: list | MappedLines
+        """
+        with self.__lock:
+            if self.__file is not None:
+                return MappedLines(self, len(self))
+            stored, lines = self.__lines
+            if stored != (self.__start, self.__end):
+                lines = "".join(self.__chunks).splitlines()
+                self.__lines = ((self.__start, self.__end), lines)
+            return lines
+
+
+class MappedLines(object):
+    """
+    Read-only sequence of lines of the spilled L{OutputStorage}. Only offsets of lines are held in the memory,
+    lines themselves are read from the storage when they are accessed.
+    """
+
+    def __init__(self, storage, size):
+        """
+        @param storage: storage of the output
+        @type storage: OutputStorage
+        @param size: size of the output covered by these lines
+        @type size: int
+        """
+        self.__storage = storage
+        self.__size = size
+        self.__starts = None  # offsets of lines, built on the first random access
+
+    def __iter_raw(self):
+        """
+        @return: generator of lines with line breaks
+        @rtype: generator
+        """
+        splitter = LineSplitter()
+        offset = 0
+        while offset < self.__size:
+            data = self.__storage.read(offset, min(OutputStorage.BLOCK_SIZE, self.__size - offset))
+            if not data:  # storage was released
+                break
+            offset += len(data)
+            for line in splitter.feed(data):
+                yield line
+        for line in splitter.flush():
+            yield line
+
+    def __index(self):
+        if self.__starts is None:
+            starts = array.array('L')
+            offset = 0
+            for line in self.__iter_raw():
+                starts.append(offset)
+                offset += len(line)
+            starts.append(offset)  # end of the last line
+            self.__starts = starts
+        return self.__starts
+
+    def __iter__(self):
+        for line in self.__iter_raw():
+            yield strip_line_break(line)
+
+    def __len__(self):
+        return len(self.__index()) - 1
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[index] for index in xrange(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("line index out of range")
+        starts = self.__index()
+        return strip_line_break(self.__storage.read(starts[item], starts[item + 1] - starts[item]))
+
+    def __eq__(self, other):
+        if isinstance(other, MappedLines):
+            other = list(other)
+        if not isinstance(other, (list, tuple)):
+            return False
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<%s of %s bytes>" % (self.__class__.__name__, self.__size)
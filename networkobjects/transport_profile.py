@@ -0,0 +1,60 @@
+__author__ = 'mlesko'
+
+import executor_exceptions
+
+
+class TransportProfile(object):
+    """
+    Tuning of the SSH transport applied by the model at connect time. Listed algorithms are preferred
+    in the given order, algorithms which are not listed remain available after them. None means
+    the default of the underlying module.
+
+    E.g. hosts behind WAN links benefit from the compression and a bigger window, while LAN hosts
+    want the cheapest cipher:
+        - C{TransportProfile(compression=True, window_size=16 * 1024 * 1024)}
+        - C{TransportProfile(ciphers=["aes128-ctr"], digests=["hmac-sha1"])}
+    """
+
+    def __init__(self, ciphers=None, digests=None, kex=None, compression=None, window_size=None,
+                 max_packet_size=None):
+        """
+        @param ciphers: preferred ciphers
+        @type ciphers: list
+        @param digests: preferred MACs
+        @type digests: list
+        @param kex: preferred key exchange algorithms
+        @type kex: list
+        @param compression: compression of the transport
+        @type compression: bool
+        @param window_size: size of the window of channels in bytes
+        @type window_size: int
+        @param max_packet_size: maximal size of the packet of channels in bytes
+        @type max_packet_size: int
+        @raise InvalidTransportProfile: if any of values is not valid
+        """
+        self.ciphers = self.__check_algorithms("ciphers", ciphers)
+        self.digests = self.__check_algorithms("digests", digests)
+        self.kex = self.__check_algorithms("kex", kex)
+        if compression is not None and not isinstance(compression, bool):
+            raise executor_exceptions.InvalidTransportProfile("compression must be bool")
+        self.compression = compression
+        self.window_size = self.__check_size("window_size", window_size)
+        self.max_packet_size = self.__check_size("max_packet_size", max_packet_size)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__,
+                           ", ".join("%s=%r" % item for item in sorted(self.__dict__.items()) if item[1] is not None))
+
+    @staticmethod
+    def __check_algorithms(name, algorithms):
+        if algorithms is None:
+            return None
+        if isinstance(algorithms, basestring) or not all(isinstance(item, basestring) for item in algorithms):
+            raise executor_exceptions.InvalidTransportProfile("%s must be a list of algorithm names" % name)
+        return tuple(algorithms)
+
+    @staticmethod
+    def __check_size(name, size):
+        if size is not None and (not isinstance(size, (int, long)) or size <= 0):
+            raise executor_exceptions.InvalidTransportProfile("%s must be positive integer" % name)
+        return size
@@ -8,40 +8,58 @@ from . import logger
 class User(NetworkObject):
     """
     Represents an User associated which is authorized for remote control.
-    Contains necessary authentication data. In further releases it may be
-    updated for more ways how to provide identification.
+    Contains necessary authentication data: the password, the private key and the usage of ssh-agent.
+    The model tries the private key first, then keys of ssh-agent and the password at last.
     """
 
-    def __new__(cls, username="root", password=None):  # this is due to proper id generation in network object
+    # this is due to proper id generation in network object
+    def __new__(cls, username="root", password=None, key_filename=None, passphrase=None, allow_agent=True):
         """
-        Hos is created and identified by a user and his password.
+        Hos is created and identified by a user, his password and his key and agent settings.
         If user already exists in the container of the class, creation and initialization
         of a new one is omitted and the existing one is returned.
         @param username: username for authentication
         @type username: str
         @param password: password for login
         @type password: str
+        @param key_filename: path of the private key, see L{__init__}
+        @type key_filename: str
+        @param passphrase: passphrase of the private key
+        @type passphrase: str
+        @param allow_agent: use keys of ssh-agent
+        @type allow_agent: bool
         @return: User instance
         @rtype: User
         """
-        cls.__check_parameters(username=username)
-        return super(User, cls).__new__(cls, username=username, password=password)
+        cls.__check_parameters(username=username, key_filename=key_filename)
+        return super(User, cls).__new__(cls, username=username, password=password, key_filename=key_filename,
+                                        passphrase=passphrase, allow_agent=allow_agent)
 
-    def __init__(self, username="root", password=None):
+    def __init__(self, username="root", password=None, key_filename=None, passphrase=None, allow_agent=True):
         """
 
-        Hos is created and identified by a user and his password.
+        Hos is created and identified by a user, his password and his key and agent settings.
         If user already exists in the container of the class, initialization
         of a new one is omitted and the existing one is returned.
         @param username: username for authentication
         @type username: str
         @param password: password for login
         @type password: str
+        @param key_filename: path of the private key, parsed keys are cached by the model
+        @type key_filename: str
+        @param passphrase: passphrase of the private key
+        @type passphrase: str
+        @param allow_agent: use keys of ssh-agent
+        @type allow_agent: bool
         """
-        _id = User.generate_id(username=username, password=password)
+        _id = User.generate_id(username=username, password=password, key_filename=key_filename, passphrase=passphrase,
+                               allow_agent=allow_agent)
         if not hasattr(User, "__pool__") or not User.__pool__.has_key(_id):  # do init only if it is new object
             self.username = username
             self.password = password
+            self.key_filename = key_filename
+            self.passphrase = passphrase
+            self.allow_agent = allow_agent
             self.id = _id
             self.connections = set()  # list is not appropriate due to possible high redundancy of same connections
             super(User, self).__init__(self.id)
@@ -51,21 +69,28 @@ class User(NetworkObject):
         return "%s object: %s with connection list:\n%s" % (self.__class__.__name__, self.id, self.connections)
 
     @classmethod
-    def __check_parameters(cls, username):
+    def __check_parameters(cls, username, key_filename=None):
         if not isinstance(username, basestring):
             raise executor_exceptions.InvalidUsernameExeption("username must be string")
+        if key_filename is not None and not isinstance(key_filename, basestring):
+            raise executor_exceptions.InvalidUserException("key_filename must be string")
 
     @classmethod
-    def generate_id(cls, username, password):
+    def generate_id(cls, username, password, key_filename=None, passphrase=None, allow_agent=True):
         """
-        Generates ID from username and password.
+        Generates ID from username, password and key and agent settings. Users with the default key and agent
+        settings are identified by the username and the password only.
         @type username: str
         @type password: str
+        @type key_filename: str
+        @type passphrase: str
+        @type allow_agent: bool
         @return: generated ID
         @rtype: str
         """
-        cls.__check_parameters(username=username)
-        return User._generate_id(username=username, password=password)
+        cls.__check_parameters(username=username, key_filename=key_filename)
+        return User._generate_id(username=username, password=password, key_filename=key_filename,
+                                 passphrase=passphrase, allow_agent=allow_agent)
 
     @classmethod
     def _generate_id(cls, *args, **kwargs):
@@ -76,7 +101,11 @@ class User(NetworkObject):
             if kwargs != {}:
                 username = kwargs.get("username")  # "or" is not used here due to possible None value in dict
                 password = kwargs.get("password")
+                keys = (kwargs.get("key_filename"), kwargs.get("passphrase"), kwargs.get("allow_agent", True))
             else:
                 username = args[0]
                 password = args[1]
-            return "%s:%s" % (username, password)
+                keys = tuple(args[2:5]) + (None, None, True)[len(args[2:5]):]
+            if keys == (None, None, True):
+                return "%s:%s" % (username, password)
+            return "%s:%s:%s:%s:%s" % ((username, password) + keys)
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+import threading
 import time
 
 import pytest
@@ -9,7 +10,9 @@ from models.paramiko_model import ParamikoModel
 from networkobjects.command import Command
 from networkobjects.connection import Connection
 from networkobjects.exec_result import ExecResult
+from networkobjects.exec_result_reduced import ReducedExecResult
 from networkobjects.host import Host
+from networkobjects.transport_profile import TransportProfile
 from networkobjects.user import User
 from ..executor import Executor
 from executor_exceptions import *
@@ -259,3 +262,356 @@ def test_close_connection(executor):
 def test_close_connection_raises_close_error(executor):
     with pytest.raises(ConnectionCloseError):
         executor.close_connection()
+
+
+def create_results(count):
+    conn = Connection(host=Host(), user=User(), client="empty")
+    reader = Mock(return_value=Mock(return_value=True))
+    return [ExecResult(Command("test%s" % x), Mock(return_value=0), reader, reader, conn) for x in xrange(count)]
+
+
+@pytest.mark.timeout(5)
+def test_as_completed_yields_in_completion_order(executor):
+    first, second, third = create_results(3)
+    third._finalize()
+    threading.Timer(0.05, first._finalize).start()
+    threading.Timer(0.1, second._finalize).start()
+    assert list(executor.as_completed([[first, second], [third]])) == [third, first, second]
+
+
+@pytest.mark.timeout(5)
+def test_as_completed_raises_wait_timeout(executor):
+    first, second = create_results(2)
+    first._finalize()
+    completed = executor.as_completed([first, second], timeout=0.05)
+    assert next(completed) == first
+    with pytest.raises(WaitTimeout):
+        next(completed)
+
+
+@pytest.mark.timeout(5)
+def test_wait_any(executor):
+    first, second = create_results(2)
+    assert executor.wait_any([first, second], timeout=0.05) is None
+    threading.Timer(0.05, second._finalize).start()
+    assert executor.wait_any([[first], [second]]) == second
+    assert first._ExecResult__done_callbacks == []  # callbacks of waits which ended are removed
+
+
+@pytest.mark.timeout(5)
+def test_wait_all(executor):
+    first, second = create_results(2)
+    first._finalize()
+    done, pending = executor.wait_all([[first], [second]], timeout=0.05)
+    assert done == {first}
+    assert pending == {second}
+    second._finalize()
+    done, pending = executor.wait_all([first, second])
+    assert done == {first, second}
+    assert pending == set()
+
+
+def create_connections(executor, count):
+    return [executor.create_connection(Host(address=str(x)), User()) for x in xrange(count)]
+
+
+@pytest.mark.timeout(5)
+def test_execute_everywhere_dispatches_in_parallel(monkeypatch, executor):
+    connections = create_connections(executor, 6)
+    lock = threading.Lock()
+    in_flight = [0, 0]  # current, maximum
+
+    def execute(command=None, connection=None):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.1)
+        with lock:
+            in_flight[0] -= 1
+        return connection
+
+    monkeypatch.setattr(executor.model, "execute", execute)
+    assert executor.execute_everywhere("test", parallelism=3) == list(Connection)
+    assert in_flight[1] == 3
+    assert sorted(connections) == sorted(Connection)
+
+
+def test_execute_everywhere_collects_errors(monkeypatch, executor):
+    connections = create_connections(executor, 3)
+    failing = connections[1]
+
+    def execute(command=None, connection=None):
+        if connection == failing:
+            raise ConnectionException("broken")
+        return connection
+
+    monkeypatch.setattr(executor.model, "execute", execute)
+    errors = {}
+    results = executor.execute_everywhere("test", errors=errors)
+    assert failing not in results and len(results) == 2
+    assert errors.keys() == [failing]
+    assert isinstance(errors[failing], ConnectionException)
+
+    with pytest.raises(DispatchError) as exc_info:
+        executor.execute_everywhere("test")
+    assert exc_info.value.errors.keys() == [failing]
+    assert exc_info.value.results == [None if conn == failing else conn for conn in Connection]
+
+
+def test_execute_batch_everywhere(monkeypatch, executor):
+    create_connections(executor, 3)
+    monkeypatch.setattr(executor.model, "execute_batch",
+                        lambda commands=(), connection=None: [(cmd, connection) for cmd in commands])
+    results = executor.execute_batch_everywhere(iter(["a", "b"]), parallelism=2)
+    assert results == [[("a", conn), ("b", conn)] for conn in Connection]
+
+
+def test_connect_all_reports_failures(monkeypatch, executor):
+    connections = create_connections(executor, 4)
+    failing = connections[2]
+    timeouts = []
+
+    def connect(connection=None, timeout=None):
+        timeouts.append(timeout)
+        if connection == failing:
+            raise ConnectionException("refused")
+        connection.connected = True
+
+    monkeypatch.setattr(executor.model, "connect", connect)
+    report = executor.connect_all(parallelism=2, timeout=3)
+    assert sorted(report.keys()) == sorted(connections)
+    assert isinstance(report.pop(failing), ConnectionException)
+    assert all(error is None and conn.connected for conn, error in report.items())
+    assert not failing.connected
+    assert timeouts == [3] * 4
+
+    assert executor.connect_all(connections=[connections[0]]) == {connections[0]: None}
+
+
+def graph_model_execute(started, failing=(), broken=()):
+    """
+    Execute which finishes commands in the background, commands in failing end with ecode 1
+    """
+
+    def execute(command=None, connection=None):
+        if command.cmd in broken:
+            raise ConnectionException("channel refused")
+        started.append(command.cmd)
+        command.time_stamp = time.time()
+        ecode = 1 if command.cmd in failing else 0
+        result = ExecResult(command, Mock(return_value=ecode), Mock(), Mock(), connection)
+        threading.Timer(0.05, result._finalize).start()
+        return result
+
+    return execute
+
+
+@pytest.mark.timeout(5)
+def test_execute_graph_respects_dependencies(monkeypatch, executor):
+    conn_a, conn_b, conn_c = create_connections(executor, 3)
+    started = []
+    monkeypatch.setattr(executor.model, "execute", graph_model_execute(started))
+    broker = Command("broker")
+    client_b = Command("client_b", depends_on=[broker])
+    client_c = Command("client_c", depends_on=[broker])
+    report = Command("report", depends_on=[client_b, client_c])
+
+    results = executor.execute_graph([(report, conn_a), (client_b, conn_b), (client_c, conn_c), (broker, conn_a)])
+    assert started[0] == "broker"
+    assert sorted(started[1:3]) == ["client_b", "client_c"]
+    assert started[3] == "report"
+    assert [result.cmd for result in results] == [report, client_b, client_c, broker]
+    assert results[0].ts_start >= max(results[1].ts_stop, results[2].ts_stop)
+
+
+@pytest.mark.timeout(5)
+def test_execute_graph_skips_dependents_of_failed_command(monkeypatch, executor):
+    conn = create_connections(executor, 1)[0]
+    started = []
+    monkeypatch.setattr(executor.model, "execute", graph_model_execute(started, failing=["setup"], broken=["other"]))
+    setup = Command("setup")
+    test = Command("test", depends_on=[setup])
+    cleanup = Command("cleanup", depends_on=[test])
+    other = Command("other")
+    after_other = Command("after_other", depends_on=[other])
+
+    errors = {}
+    results = executor.execute_graph([(setup, conn), (test, conn), (cleanup, conn), (other, conn),
+                                      (after_other, conn), ("independent", conn)], errors=errors)
+    assert sorted(started) == ["independent", "setup"]
+    assert results[0].ecode == 1
+    assert results[1:5] == [None] * 4
+    assert errors.keys() == [other]
+
+    with pytest.raises(DispatchError):
+        executor.execute_graph([(other, conn)])
+
+
+def test_execute_graph_raises_invalid_graph(executor):
+    conn = create_connections(executor, 1)[0]
+    first = Command("first")
+    second = Command("second", depends_on=[first])
+    first.depends_on.append(second)
+    with pytest.raises(InvalidCommandValue):
+        executor.execute_graph([(first, conn), (second, conn)])
+    with pytest.raises(InvalidCommandValue):
+        executor.execute_graph([(Command("third", depends_on=[Command("missing")]), conn)])
+
+
+def rolling_model_execute(waves, failing=()):
+    """
+    Execute recording connections of every wave, a wave ends when all its results are finalized
+    """
+
+    def execute(command=None, connection=None):
+        if connection in failing:
+            raise ConnectionException("channel refused")
+        result = ExecResult(Command(command), Mock(return_value=0), Mock(), Mock(), connection)
+        if not waves or all(result.result_available for result in waves[-1]):
+            waves.append([])
+        waves[-1].append(result)
+        threading.Timer(0.02, result._finalize).start()
+        return result
+
+    return execute
+
+
+@pytest.mark.timeout(5)
+def test_execute_rolling_runs_in_waves(monkeypatch, executor):
+    create_connections(executor, 10)
+    waves = []
+    monkeypatch.setattr(executor.model, "execute", rolling_model_execute(waves))
+    results = executor.execute_rolling("restart", batch_size="30%")
+    assert [len(wave) for wave in waves] == [3, 3, 3, 1]
+    assert [result.connection for result in results] == list(Connection)
+
+
+@pytest.mark.timeout(5)
+def test_execute_rolling_aborts_on_failure_rate(monkeypatch, executor):
+    connections = create_connections(executor, 6)
+    waves = []
+    order = list(Connection)
+    monkeypatch.setattr(executor.model, "execute", rolling_model_execute(waves, failing=order[:1]))
+    errors = {}
+    with pytest.raises(RollingAborted) as exc_info:
+        executor.execute_rolling("restart", batch_size=2, max_failure_rate=0.25, errors=errors)
+    assert len(waves) == 1
+    assert errors.keys() == order[:1]
+    assert exc_info.value.results == waves[0]
+    assert exc_info.value.skipped == order[2:]
+
+    del waves[:]
+    assert len(executor.execute_rolling("restart", batch_size=2, max_failure_rate=0.5)) == len(connections) - 1
+
+
+@pytest.mark.parametrize("batch_size", [0, "x%", None])
+def test_execute_rolling_raises_invalid_batch_size(executor, batch_size):
+    create_connections(executor, 1)
+    with pytest.raises(ValueError):
+        executor.execute_rolling("restart", batch_size=batch_size)
+
+
+def sharded_model_execute(command=None, connection=None):
+    if connection.host.address == "2":
+        raise ConnectionException("channel refused")
+    output = "%s on %s\n" % (command.cmd, connection.host.address)
+    reader = Mock(side_effect=lambda storage: (storage.append(output), Mock(return_value=True))[1])
+    result = ExecResult(command, Mock(return_value=0), reader, reader, connection)
+    result._finalize()
+    return result
+
+
+@pytest.mark.timeout(20)
+def test_execute_sharded(monkeypatch, executor):
+    connections = create_connections(executor, 5)
+    monkeypatch.setattr(executor.model, "connect", Mock())
+    monkeypatch.setattr(executor.model, "execute", sharded_model_execute)
+    errors = {}
+    results = executor.execute_sharded(executor.create_command("uptime", capture="head", capture_limit=6),
+                                       processes=2, errors=errors)
+    order = [conn for conn in Connection if conn.host.address != "2"]
+    assert [result.connection for result in results] == order
+    assert [result.stdout for result in results] == [["uptime"]] * 4
+    assert all(isinstance(result, ReducedExecResult) and result.ecode == 0 for result in results)
+    assert [conn.host.address for conn in errors.keys()] == ["2"]
+    assert sorted(Connection) == sorted(connections)  # controller connections are untouched
+
+
+def settings_model_execute(command=None, connection=None):
+    host, user = connection.host, connection.user
+    output = "%r %r %s %s\n" % ((user.username, user.key_filename, user.passphrase, user.allow_agent),
+                                 host.transport_profile, connection.session_mode, connection.channel_pool_size)
+    reader = Mock(side_effect=lambda storage: (storage.append(output), Mock(return_value=True))[1])
+    result = ExecResult(command, Mock(return_value=0), reader, reader, connection)
+    result._finalize()
+    return result
+
+
+@pytest.mark.timeout(20)
+def test_execute_sharded_keeps_connection_settings(monkeypatch, executor):
+    host = Host("sharded")
+    host.transport_profile = TransportProfile(compression=True)
+    connection = executor.create_connection(host, User("key_user", key_filename="/k", passphrase="p",
+                                                       allow_agent=False))
+    connection.session_mode = True
+    connection.channel_pool_size = 2
+    monkeypatch.setattr(executor.model, "connect", Mock())
+    monkeypatch.setattr(executor.model, "execute", settings_model_execute)
+    result, = executor.execute_sharded("uptime", processes=1)
+    assert result.stdout == ["('key_user', '/k', 'p', False) TransportProfile(compression=True) True 2"]
+
+
+def farm_model_execute(delays, broken=()):
+    """
+    Execute finishing commands after the delay of their connection
+    """
+
+    def execute(command=None, connection=None):
+        if connection in broken:
+            raise ConnectionException("channel refused")
+        if command is None:
+            raise InvalidCommandValue("Command can't be None")
+        result = ExecResult(Command(command), Mock(return_value=0), Mock(), Mock(), connection)
+        threading.Timer(delays[connection], result._finalize).start()
+        return result
+
+    return execute
+
+
+@pytest.mark.timeout(5)
+def test_execute_farm_prefers_free_connections(monkeypatch, executor):
+    slow, fast = create_connections(executor, 2)
+    monkeypatch.setattr(executor.model, "execute", farm_model_execute({slow: 0.5, fast: 0.01}))
+    results = list(executor.execute_farm(["job%s" % x for x in xrange(10)], slots=2))
+    assert sorted(result.cmd.cmd for result in results) == ["job%s" % x for x in xrange(10)]
+    assert len([result for result in results if result.connection == slow]) == 2
+    assert results[-1].connection == slow
+
+
+@pytest.mark.timeout(5)
+def test_execute_farm_drops_broken_connection(monkeypatch, executor):
+    broken, working = create_connections(executor, 2)
+    monkeypatch.setattr(executor.model, "execute", farm_model_execute({working: 0.01}, broken=[broken]))
+    errors = {}
+    results = list(executor.execute_farm(["job%s" % x for x in xrange(4)], errors=errors))
+    assert [result.connection for result in results] == [working] * 4
+    assert errors.keys() == [broken]
+
+    monkeypatch.setattr(executor.model, "execute", farm_model_execute({}, broken=[broken, working]))
+    with pytest.raises(DispatchError) as exc_info:
+        list(executor.execute_farm(["job"]))
+    assert sorted(exc_info.value.errors.keys()) == sorted([broken, working])
+
+
+@pytest.mark.timeout(5)
+def test_execute_farm_skips_invalid_command(monkeypatch, executor):
+    first, second = create_connections(executor, 2)
+    monkeypatch.setattr(executor.model, "execute", farm_model_execute({first: 0.01, second: 0.01}))
+    errors = {}
+    results = list(executor.execute_farm(["job0", None, "job1"], errors=errors))
+    assert sorted(result.cmd.cmd for result in results) == ["job0", "job1"]
+    assert errors.keys() == [None] and isinstance(errors[None], InvalidCommandValue)
+
+    with pytest.raises(DispatchError) as exc_info:
+        list(executor.execute_farm([None]))
+    assert exc_info.value.errors.keys() == [None]
@@ -0,0 +1,130 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+from mock import Mock
+
+from executor_exceptions import AgentError
+from models.agent_model import AgentModel, AgentSession
+from models.remote_agent import CODE, ERROR, EXIT, HEADER, READY, SPAWN, STARTED, STDOUT
+from models.shell_session import SessionEntry
+from networkobjects.host import Host
+from networkobjects.user import User
+
+
+class AgentChannel(object):
+    """
+    Channel running the bootstrap command locally, its descriptor is always readable
+    """
+
+    def __init__(self):
+        self.stdout = ""
+        self.stderr = ""
+        self.eof_received = False
+        self.closed = False
+        self.process = None
+        self.__lock = threading.Lock()
+        self.__read_fd, write_fd = os.pipe()
+        os.write(write_fd, "x")
+
+    def fileno(self):
+        return self.__read_fd
+
+    def exec_command(self, command):
+        self.process = subprocess.Popen(command.replace("python", sys.executable, 1), shell=True,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        for stream, name in ((self.process.stdout, "stdout"), (self.process.stderr, "stderr")):
+            threading.Thread(target=self.__pump, args=(stream, name)).start()
+
+    def __pump(self, stream, name):
+        for data in iter(lambda: os.read(stream.fileno(), 4096), ""):
+            with self.__lock:
+                setattr(self, name, getattr(self, name) + data)
+
+    def recv_ready(self):
+        return len(self.stdout) > 0
+
+    def recv_stderr_ready(self):
+        return len(self.stderr) > 0
+
+    def recv(self, nbytes):
+        with self.__lock:
+            data, self.stdout = self.stdout[:nbytes], self.stdout[nbytes:]
+            return data
+
+    def recv_stderr(self, nbytes):
+        with self.__lock:
+            data, self.stderr = self.stderr[:nbytes], self.stderr[nbytes:]
+            return data
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def close(self):
+        self.closed = True
+        self.process.stdin.close()
+
+
+def message(kind, seq, payload=""):
+    return HEADER.pack(kind, seq, len(payload)) + payload
+
+
+@pytest.mark.timeout(5)
+def test_agent_session_holds_messages_till_ready():
+    senders = []
+    sent = threading.Event()
+    channel = Mock()
+    channel.sendall.side_effect = lambda data: (senders.append(threading.current_thread()), sent.set())
+    session = AgentSession(channel)
+    session.start()
+    entry = SessionEntry()
+    session.submit("echo a", entry)
+    assert channel.sendall.call_count == 1  # only the source of the agent
+    sent.clear()
+    session.feed_stdout(message(READY, 0))
+    assert sent.wait(2)
+    channel.sendall.assert_called_with(message(SPAWN, entry.seq, "echo a"))
+    assert senders[-1] is not threading.current_thread()  # the feeding thread does not send the backlog
+
+
+def test_agent_session_demultiplexes_messages():
+    session = AgentSession(Mock())
+    first, second = SessionEntry(), SessionEntry()
+    session.submit("first", first)
+    session.submit("second", second)
+    data = message(READY, 0) + message(STARTED, first.seq, CODE.pack(42)) + message(STDOUT, second.seq, "b") + \
+        message(STDOUT, first.seq, "a") + message(EXIT, first.seq, CODE.pack(3)) + message(ERROR, second.seq, "fork")
+    for char in data:  # messages split to many chunks
+        session.feed_stdout(char)
+    assert (first.pid, first.ecode, first.finished) == (42, 3, True)
+    assert second.finished and isinstance(second.error, AgentError)
+    assert len(session) == 0
+
+
+@pytest.mark.timeout(10)
+def test_execute_via_agent():
+    model = AgentModel()
+    conn = model.create_connection(host=Host("1.2.3.4"), user=User("agent_user"))
+    channel = AgentChannel()
+    transport_mock = Mock()
+    transport_mock.open_session.return_value = channel
+    conn.client.get_transport = Mock(return_value=transport_mock)
+
+    results = [model.execute(command="echo %s; echo err%s >&2; exit %s" % (x, x, x), connection=conn)
+               for x in xrange(3)]
+    sleeper = model.execute(command="sleep 100", connection=conn)
+    for x, result in enumerate(results):
+        assert result.wait_for_data(5)
+        assert (result.stdout, result.stderr, result.ecode) == (["%s" % x], ["err%s" % x], x)
+        assert result.cmd.pid > 0
+    assert transport_mock.open_session.call_count == 1
+    while sleeper.cmd.pid is None:
+        assert not sleeper.wait_for_data(0.01)
+    assert sleeper.cmd.kill() == 0
+    assert sleeper.wait_for_data(5)
+    assert sleeper.ecode == 128 + 15
+    channel.close()
+    assert channel.process.wait() == 0
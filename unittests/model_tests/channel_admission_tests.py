@@ -0,0 +1,118 @@
+import pytest
+
+from executor_exceptions import InvalidChannelException
+from models.channel_admission import ChannelAdmission, PendingChannel
+
+
+def test_submit_runs_task_till_limit():
+    admission = ChannelAdmission(limit=2)
+    started = []
+    for x in xrange(4):
+        admission.submit(lambda queued, x=x: started.append((x, queued)))
+    assert started == [(0, False), (1, False)]
+    assert admission.active == 2
+    assert len(admission) == 2
+
+    admission.release()
+    assert started[-1] == (2, True)
+    assert admission.active == 2
+    admission.release()
+    admission.release()
+    admission.release()
+    assert started[-1] == (3, True)
+    assert admission.active == 0
+    assert len(admission) == 0
+
+
+def test_resize_admits_queued_tasks():
+    admission = ChannelAdmission(limit=1)
+    started = []
+    for x in xrange(3):
+        admission.submit(lambda queued, x=x: started.append(x))
+    admission.resize(2)
+    assert started == [0, 1]
+    assert admission.limit == 2 and len(admission) == 1
+
+
+def test_submit_without_limit():
+    admission = ChannelAdmission()
+    for _ in xrange(100):
+        assert admission.submit(lambda queued: None)
+    assert admission.active == 100
+
+
+def test_release_uses_runner():
+    runs = []
+    admission = ChannelAdmission(limit=1, runner=runs.append)
+    started = []
+    admission.submit(started.append)
+    assert not admission.submit(started.append)
+    admission.release()
+    assert started == [False]
+    runs[0]()
+    assert started == [False, True]
+
+
+def test_pending_channel_delegates_to_opened_channel():
+    channel = PendingChannel()
+    with pytest.raises(InvalidChannelException):
+        channel.recv_ready()
+    channel.channel = type("Channel", (object,), {"recv_ready": lambda self: True})()
+    assert channel.recv_ready()
+
+
+def test_exclusive_task_is_barrier():
+    admission = ChannelAdmission(limit=5)
+    started = []
+    admission.submit(lambda queued: started.append("a"))
+    admission.submit(lambda queued: started.append("barrier"), exclusive=True)
+    admission.submit(lambda queued: started.append("b"))
+    assert started == ["a"]
+
+    admission.release()  # a finished
+    assert started == ["a", "barrier"]
+    assert admission.active == 1
+    admission.release(exclusive=True)  # barrier finished
+    assert started == ["a", "barrier", "b"]
+
+
+def test_queued_tasks_are_admitted_by_priority():
+    admission = ChannelAdmission(limit=1)
+    started = []
+    admission.submit(lambda queued: started.append("running"))
+    admission.submit(lambda queued: started.append("bulk1"), priority=-10)
+    admission.submit(lambda queued: started.append("normal"))
+    admission.submit(lambda queued: started.append("bulk2"), priority=-10)
+    admission.submit(lambda queued: started.append("probe"), priority=10)
+    for _ in xrange(4):
+        admission.release()
+    assert started == ["running", "probe", "normal", "bulk1", "bulk2"]
+
+
+def test_urgent_task_is_not_held_by_barrier():
+    admission = ChannelAdmission(limit=5, urgent_priority=10)
+    started = []
+    admission.submit(lambda queued: started.append("barrier"), exclusive=True)
+    admission.submit(lambda queued: started.append("normal"))
+    admission.submit(lambda queued: started.append("kill"), priority=10)
+    assert started == ["barrier", "kill"]
+
+    admission.release(exclusive=True)  # barrier finished, kill still running
+    assert started == ["barrier", "kill", "normal"]
+    assert admission.active == 2
+
+
+def test_priority_does_not_pass_queued_barrier():
+    admission = ChannelAdmission(limit=5, urgent_priority=10)
+    started = []
+    admission.submit(lambda queued: started.append("a"))
+    admission.submit(lambda queued: started.append("barrier"), exclusive=True)
+    admission.submit(lambda queued: started.append("high"), priority=5)
+    admission.submit(lambda queued: started.append("urgent"), priority=10)
+    assert started == ["a", "urgent"]
+
+    admission.release()  # a finished
+    admission.release()  # urgent finished
+    assert started == ["a", "urgent", "barrier"]
+    admission.release(exclusive=True)
+    assert started == ["a", "urgent", "barrier", "high"]
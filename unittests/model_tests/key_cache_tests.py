@@ -0,0 +1,93 @@
+import os
+import threading
+
+import paramiko
+import pytest
+from mock import Mock
+
+from models.key_cache import KeyCache
+
+
+@pytest.fixture(scope="module")
+def key_file(tmpdir_factory):
+    path = str(tmpdir_factory.mktemp("keys").join("id_rsa"))
+    paramiko.RSAKey.generate(1024).write_private_key_file(path, password="secret")
+    return path
+
+
+def test_key_cache_parses_key_once(monkeypatch, key_file):
+    cache = KeyCache()
+    parse = Mock(wraps=paramiko.RSAKey.from_private_key_file)
+    monkeypatch.setattr(paramiko.RSAKey, "from_private_key_file", parse)
+    key = cache.load(key_file, "secret")
+    assert isinstance(key, paramiko.RSAKey)
+    assert cache.load(key_file, "secret") is key
+    assert parse.call_count == 1
+
+    stat = os.stat(key_file)
+    os.utime(key_file, (stat.st_atime, stat.st_mtime + 10))  # modified key is parsed again
+    assert cache.load(key_file, "secret") is not key
+    assert parse.call_count == 2
+
+
+def test_key_cache_caches_failures(monkeypatch, tmpdir):
+    cache = KeyCache()
+    not_key = tmpdir.join("not_key")
+    not_key.write("garbage")
+    parse = Mock(side_effect=paramiko.SSHException("not a key"))
+    for key_type in cache.key_types:
+        monkeypatch.setattr(key_type, "from_private_key_file", parse)
+    for _ in xrange(3):
+        with pytest.raises(paramiko.SSHException):
+            cache.load(str(not_key))
+    assert parse.call_count == len(cache.key_types)  # the file is parsed only once
+
+    stat = os.stat(str(not_key))
+    os.utime(str(not_key), (stat.st_atime, stat.st_mtime + 10))  # modified file is parsed again
+    with pytest.raises(paramiko.SSHException):
+        cache.load(str(not_key))
+    assert parse.call_count == 2 * len(cache.key_types)
+
+
+def test_key_cache_raises(tmpdir, key_file):
+    cache = KeyCache()
+    with pytest.raises(paramiko.PasswordRequiredException):
+        cache.load(key_file)
+    not_key = tmpdir.join("not_key")
+    not_key.write("garbage")
+    with pytest.raises(paramiko.SSHException):
+        cache.load(str(not_key))
+
+
+def test_key_cache_shares_agent_between_threads(monkeypatch):
+    cache = KeyCache()
+    agent = Mock(get_keys=Mock(return_value=("key",)))
+    send = agent._send_message
+    create_agent = Mock(return_value=agent)
+    monkeypatch.setattr(paramiko, "Agent", create_agent)
+    shared = cache.agent()
+    others = []
+    thread = threading.Thread(target=lambda: others.append(cache.agent()))
+    thread.start()
+    thread.join()
+    assert others == [shared]  # new threads do not open their own connections to ssh-agent
+    assert shared.get_keys() == ("key",)
+    agent._send_message("sign")  # requests of keys go through the lock of the shared agent
+    send.assert_called_with("sign")
+    shared.close()  # closed by the client, the connection is kept
+    assert shared.get_keys() == ("key",)
+    assert create_agent.call_count == 1
+    cache.clear()
+    agent.close.assert_called_with()
+    shared.get_keys()
+    assert create_agent.call_count == 2
+
+
+def test_key_cache_loads_existing_default_keys(monkeypatch, tmpdir, key_file):
+    cache = KeyCache()
+    broken = tmpdir.join("id_broken")
+    broken.write("garbage")
+    monkeypatch.setattr(cache, "default_files", (key_file, str(broken), str(tmpdir.join("missing"))))
+    keys = cache.default_keys("secret")
+    assert len(keys) == 1 and isinstance(keys[0], paramiko.RSAKey)
+    assert cache.default_keys("secret")[0] is keys[0]  # parsed only once
@@ -1,14 +1,22 @@
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import threading
 import time
 
 import pytest
 from mock import Mock
 
 from executor_exceptions import *
+from models.key_cache import key_cache
 from models.paramiko_model import ParamikoModel
-from networkobjects.command import Command
+from networkobjects.command import Command, PRIORITY_HIGH, PRIORITY_LOW
 from networkobjects.connection import Connection
 from networkobjects.exec_result import ExecResult
 from networkobjects.host import Host
+from networkobjects.transport_profile import TransportProfile
 from networkobjects.user import User
 
 connection = None
@@ -17,6 +25,7 @@ user = None
 client = None
 invalid_cmd = None
 func_mock = None
+pid_prefix = ParamikoModel.pid_command % ""
 
 
 @pytest.fixture
@@ -65,6 +74,26 @@ def test_connect_raises_invalid_connection(model):
         model.connect(None)
 
 
+def test_connect_marks_connection_connected(monkeypatch, model):
+    model_conn = model.create_connection(host, user)
+    monkeypatch.setattr(model_conn, "client", Mock())
+    model.connect(model_conn, timeout=5)
+    assert model_conn.connected
+    kwargs = model_conn.client.connect.call_args[1]
+    assert kwargs["timeout"] == kwargs["banner_timeout"] == kwargs["auth_timeout"] == 5
+
+    model.connect(model_conn)  # already connected
+    assert model_conn.client.connect.call_count == 1
+
+
+def test_connect_failure_keeps_connection_disconnected(monkeypatch, model):
+    model_conn = model.create_connection(host, user)
+    monkeypatch.setattr(model_conn, "client", Mock(connect=Mock(side_effect=IOError("refused"))))
+    with pytest.raises(IOError):
+        model.connect(model_conn)
+    assert not model_conn.connected
+
+
 # here are not used "host" and "user" objects from reset, because during test_data construction they are both None
 test_data = [(Host(), User(username="tester"), ConnectionNotFound),
              (Host(), None, InvalidUserException),
@@ -95,6 +124,16 @@ def test_close_connection(model):
     assert model_conn not in Connection
 
 
+def test_close_connection_keeps_other_active_connection(model):
+    idle = model.create_connection(Host("idle"), user)
+    active = model.create_connection(host, user)
+    assert ParamikoModel.active_connection == active
+    model.close_connection(idle)
+    assert ParamikoModel.active_connection is active
+    model.close_connection(active)
+    assert ParamikoModel.active_connection is None
+
+
 def test_close_connection_raises_close_error(model):
     with pytest.raises(ConnectionCloseError):
         model.close_connection()
@@ -141,6 +180,7 @@ def test_kill(monkeypatch, model):
     command_to_kill = model.create_command("test")
     command_to_kill.pid = 2555
     command_to_kill.connection = connection
+    other = model.create_connection(host=Host("other"), user=user)  # active connection is not the target
     time_val = time.time()
     transport_mock = Mock(spec=["open_session"])
     time_mock = Mock(return_value=time_val)
@@ -153,6 +193,8 @@ def test_kill(monkeypatch, model):
     ecode = model.kill(command=command_to_kill)
     assert ecode == None
     assert len(connection.incomplete_results) == 1
+    assert other.incomplete_results == []
+    assert ParamikoModel.active_connection == other
     res = connection.incomplete_results.pop()
     model_kill_cmd = model.create_command("kill -15 2555")
     assert res.cmd.cmd == model_kill_cmd.cmd
@@ -248,3 +290,550 @@ def test_execute_cmd(monkeypatch, model, cmd):
     assert model_res.cmd.time_stamp == cmd_to_compare.time_stamp
     assert model_res.cmd.connection == cmd_to_compare.connection
     assert model_res.connection == conn
+
+
+class FakeChannel(object):
+    """
+    Channel with already received output, its descriptor is always readable
+    """
+
+    def __init__(self, stdout="", stderr="", ecode=0):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.ecode = ecode
+        self.eof_received = True
+        self.closed = False
+        self.command = None
+        self.__read_fd, write_fd = os.pipe()
+        os.write(write_fd, "x")
+
+    def fileno(self):
+        return self.__read_fd
+
+    def exec_command(self, command):
+        if command.startswith(pid_prefix):  # the model prints the pid of the command first
+            command = shlex.split(command[len(pid_prefix):])[0]
+            self.stdout = "4242\n" + self.stdout
+        self.command = command
+
+    def recv_ready(self):
+        return len(self.stdout) > 0
+
+    def recv_stderr_ready(self):
+        return len(self.stderr) > 0
+
+    def recv(self, nbytes):
+        data, self.stdout = self.stdout[:nbytes], self.stdout[nbytes:]
+        return data
+
+    def recv_stderr(self, nbytes):
+        data, self.stderr = self.stderr[:nbytes], self.stderr[nbytes:]
+        return data
+
+    def exit_status_ready(self):
+        return True
+
+    def recv_exit_status(self):
+        return self.ecode
+
+
+@pytest.mark.timeout(5)
+def test_execute_reads_streams_in_background(monkeypatch, model):
+    conn = model.create_connection(host=host, user=user)
+    channel = FakeChannel(stdout="line1\nline2\n", stderr="err\n", ecode=3)
+    transport_mock = Mock()
+    transport_mock.open_session.return_value = channel
+    monkeypatch.setattr(conn.client, "get_transport", Mock(return_value=transport_mock))
+
+    result = model.execute(command="test_cmd", connection=conn)
+    result.wait_for_data()
+    assert channel.command == "test_cmd"
+    assert result.stdout == ["line1", "line2"]
+    assert result.stderr == ["err"]
+    assert result.ecode == 3
+
+
+def gated_transport(gate, opened, failing=()):
+    """
+    Transport opening channels which finish once the gate is set
+    """
+
+    def open_session():
+        if len(opened) in failing:
+            opened.append(None)
+            raise IOError("administratively prohibited")
+        channel = FakeChannel(stdout="out\n")
+        channel.exit_status_ready = gate.is_set
+        opened.append(channel)
+        return channel
+
+    return Mock(open_session=Mock(side_effect=open_session))
+
+
+@pytest.mark.timeout(5)
+def test_execute_queues_commands_above_channel_limit(monkeypatch, model):
+    monkeypatch.setattr(ParamikoModel, "max_channels", 2)
+    conn = model.create_connection(host=host, user=user)
+    gate = threading.Event()
+    opened = []
+    monkeypatch.setattr(conn.client, "get_transport", Mock(return_value=gated_transport(gate, opened)))
+
+    results = [model.execute(command="cmd%s" % x, connection=conn) for x in xrange(5)]
+    assert len(opened) == 2
+    assert not any(result.result_available for result in results)
+    assert results[4].stdout == []  # queued result is usable
+
+    gate.set()
+    assert all(result.wait_for_data(2) for result in results)
+    assert sorted(channel.command for channel in opened) == ["cmd%s" % x for x in xrange(5)]
+    assert all(result.stdout == ["out"] and result.ecode == 0 for result in results)
+    assert conn._channel_admission.active == 0
+
+
+@pytest.mark.timeout(5)
+def test_execute_reports_failure_of_queued_command(monkeypatch, model):
+    monkeypatch.setattr(ParamikoModel, "max_channels", 1)
+    conn = model.create_connection(host=host, user=user)
+    gate = threading.Event()
+    monkeypatch.setattr(conn.client, "get_transport", Mock(return_value=gated_transport(gate, [], failing=(1,))))
+
+    first = model.execute(command="first", connection=conn)
+    failed = model.execute(command="second", connection=conn)
+    last = model.execute(command="third", connection=conn)
+    gate.set()
+    assert failed.wait_for_data(2) and last.wait_for_data(2)
+    assert isinstance(failed.error, IOError)
+    assert failed.ecode is None
+    assert first.error is None and last.ecode == 0
+
+
+def test_execute_raises_when_channel_can_not_be_opened(monkeypatch, model):
+    conn = model.create_connection(host=host, user=user)
+    monkeypatch.setattr(conn.client, "get_transport",
+                        Mock(return_value=gated_transport(threading.Event(), [], failing=(0,))))
+    with pytest.raises(IOError):
+        model.execute(command="cmd", connection=conn)
+    assert conn.incomplete_results == []
+    assert conn._channel_admission.active == 0
+
+
+@pytest.mark.timeout(5)
+def test_execute_batch_does_not_wait_for_exclusive_command(monkeypatch, model):
+    conn = model.create_connection(host=host, user=user)
+    gate = threading.Event()
+    opened = []
+    monkeypatch.setattr(conn.client, "get_transport", Mock(return_value=gated_transport(gate, opened)))
+
+    results = model.execute_batch(commands=["first", Command("barrier", exclusive=True), "last"], connection=conn)
+    assert [channel.command for channel in opened] == ["first"]
+
+    gate.set()
+    assert all(result.wait_for_data(2) for result in results)
+    assert [channel.command for channel in opened] == ["first", "barrier", "last"]
+    assert results[1].ts_start >= results[0].ts_stop
+    assert results[2].ts_start >= results[1].ts_stop
+
+
+@pytest.mark.timeout(5)
+def test_execute_dispatches_high_priority_command_first(monkeypatch, model):
+    monkeypatch.setattr(ParamikoModel, "max_channels", 1)
+    conn = model.create_connection(host=host, user=user)
+    gate = threading.Event()
+    opened = []
+    monkeypatch.setattr(conn.client, "get_transport", Mock(return_value=gated_transport(gate, opened)))
+
+    results = [model.execute(command=cmd, connection=conn) for cmd in
+               ["running", Command("bulk", priority=PRIORITY_LOW), Command("probe", priority=PRIORITY_HIGH)]]
+    gate.set()
+    assert all(result.wait_for_data(2) for result in results)
+    assert [channel.command for channel in opened] == ["running", "probe", "bulk"]
+
+
+def test_connect_respects_handshake_rate(monkeypatch, model):
+    monkeypatch.setattr(ParamikoModel, "host_handshake_rate", 1)
+    first = model.create_connection(Host("10.0.0.1"), user)
+    second = model.create_connection(Host("10.0.0.1"), User("other"))
+    for conn in (first, second):
+        monkeypatch.setattr(conn, "client", Mock())
+    model.connect(first, timeout=0.01)
+    with pytest.raises(HandshakeThrottled):
+        model.connect(second, timeout=0.01)
+    assert not second.client.connect.called
+
+
+@pytest.mark.timeout(5)
+def test_execute_places_channels_on_least_loaded_transport(monkeypatch, model):
+    monkeypatch.setattr(ParamikoModel, "transports_per_connection", 2)
+    monkeypatch.setattr(ParamikoModel, "max_channels", 1)
+    gate = threading.Event()
+    opened = {"primary": [], "extra": []}
+    primary_client, extra_client = Mock(), Mock()
+    primary_client.get_transport.return_value = gated_transport(gate, opened["primary"])
+    extra_client.get_transport.return_value = gated_transport(gate, opened["extra"])
+    monkeypatch.setattr(ParamikoModel, "__create_initialized_client__",
+                        Mock(side_effect=[primary_client, extra_client]))
+    conn = model.create_connection(host=host, user=user)
+
+    model.connect(conn)
+    assert conn.client.connect.called and extra_client.connect.called
+    results = [model.execute(command="cmd%s" % x, connection=conn) for x in xrange(4)]
+    assert (len(opened["primary"]), len(opened["extra"])) == (1, 1)  # limit applies per transport
+    gate.set()
+    assert all(result.wait_for_data(2) for result in results)
+    assert len(opened["primary"]) + len(opened["extra"]) == 4
+    assert conn._client_load == {primary_client: 0, extra_client: 0}
+
+    model.close_connection(conn)
+    assert extra_client.close.called
+
+
+def test_connect_sets_keepalive(monkeypatch, model):
+    monkeypatch.setattr(ParamikoModel, "keepalive_interval", 30)
+    conn = model.create_connection(host=host, user=user)
+    monkeypatch.setattr(conn, "client", Mock())
+    model.connect(conn)
+    conn.client.get_transport.return_value.set_keepalive.assert_called_with(30)
+    assert conn.last_used is not None
+
+
+def test_reap_idle_connections(monkeypatch, model):
+    idle = model.create_connection(host=Host("idle"), user=user)
+    busy = model.create_connection(host=Host("busy"), user=user)
+    fresh = model.create_connection(host=Host("fresh"), user=user)
+    for conn in (idle, busy, fresh):
+        monkeypatch.setattr(conn, "client", Mock())
+        conn.connected = True
+        conn.last_used = time.time() - 100
+    fresh.last_used = time.time()
+    model.__get_admission__(busy).submit(lambda queued: None)
+
+    assert model.reap_idle_connections(idle_timeout=10) == [idle]
+    assert idle.client.close.called
+    assert idle not in Connection
+    assert busy in Connection and fresh in Connection
+    assert ParamikoModel.active_connection is fresh  # reaping does not reset the active connection
+    assert model.reap_idle_connections() == []  # reaping is disabled by default
+
+
+def test_reset_after_fork_detaches_inherited_transports(monkeypatch, model):
+    conn = model.create_connection(host=host, user=user)
+    monkeypatch.setattr(conn, "client", Mock())
+    transport = conn.client.get_transport.return_value
+    transport.active = True
+    try:
+        model._reset_after_fork()
+        assert transport.active is False
+        assert transport.sock.close.called
+        assert not transport.sock.send.called and not transport.close.called  # nothing is sent on the wire
+        assert not conn.client.close.called
+        assert ParamikoModel.__forked__ == [conn]  # inherited connections are never collected
+    finally:
+        ParamikoModel.__forked__ = []
+
+
+def test_execute_raises_dead_transport(monkeypatch, model):
+    conn = model.create_connection(host=host, user=user)
+    conn.connected = True
+    monkeypatch.setattr(conn, "client", Mock())
+    conn.client.get_transport.return_value.is_active.return_value = False
+    with pytest.raises(DeadTransport):
+        model.execute(command="cmd", connection=conn)
+    assert not conn.connected
+    assert not conn.client.get_transport.return_value.open_session.called
+
+
+def test_get_connection_reconnects_dead_connection(monkeypatch, model):
+    monkeypatch.setattr(ParamikoModel, "reconnect_ena", True)
+    conn = model.create_connection(host=host, user=user)
+    dead_client, extra_client, new_client = Mock(), Mock(), Mock()
+    monkeypatch.setattr(conn, "client", dead_client)
+    monkeypatch.setattr(ParamikoModel, "__create_initialized_client__", Mock(return_value=new_client))
+    conn._extra_clients = [extra_client]
+    conn.connected = True
+    dead_client.get_transport.return_value.is_active.return_value = False
+    assert model.get_connection(host=host, user=user) == conn
+    assert dead_client.close.called and extra_client.close.called  # old transports do not leak
+    assert conn.client is new_client
+    assert new_client.connect.called
+    assert conn.connected
+
+
+@pytest.mark.timeout(5)
+def test_execute_reconnects_dead_transport(monkeypatch, model):
+    monkeypatch.setattr(ParamikoModel, "reconnect_ena", True)
+    monkeypatch.setattr(ParamikoModel, "reconnect_delay", 0.01)
+    conn = model.create_connection(host=host, user=user)
+    dead_client, failing_client, new_client = Mock(), Mock(), Mock()
+    dead_client.get_transport.return_value.is_active.return_value = False
+    failing_client.connect.side_effect = IOError("host is rebooting")
+    failing_client.get_transport.return_value = None
+    new_client.get_transport.return_value.open_session.return_value = FakeChannel(stdout="up\n")
+    monkeypatch.setattr(conn, "client", dead_client)
+    monkeypatch.setattr(ParamikoModel, "__create_initialized_client__", Mock(side_effect=[failing_client, new_client]))
+
+    result = model.execute(command="uptime", connection=conn)
+    assert result.wait_for_data(2)
+    assert result.stdout == ["up"]
+    assert dead_client.close.called and failing_client.close.called
+    assert conn.client == new_client
+    assert conn.connected
+
+
+@pytest.mark.timeout(5)
+def test_execute_gives_up_reconnecting(monkeypatch, model):
+    monkeypatch.setattr(ParamikoModel, "reconnect_ena", True)
+    monkeypatch.setattr(ParamikoModel, "reconnect_attempts", 2)
+    monkeypatch.setattr(ParamikoModel, "reconnect_delay", 0.01)
+    conn = model.create_connection(host=host, user=user)
+    monkeypatch.setattr(conn, "client", Mock(get_transport=Mock(return_value=None)))
+    new_client = Mock(get_transport=Mock(return_value=None), connect=Mock(side_effect=IOError("down")))
+    create_client = Mock(return_value=new_client)
+    monkeypatch.setattr(ParamikoModel, "__create_initialized_client__", create_client)
+    result = model.execute(command="uptime", connection=conn)  # the caller does not wait for the reconnect
+    assert result.wait_for_data(2)
+    assert isinstance(result.error, DeadTransport)
+    assert create_client.call_count == 2
+
+
+def test_reconnect_runs_outside_of_the_caller(monkeypatch, model):
+    monkeypatch.setattr(ParamikoModel, "reconnect_ena", True)
+    conn = model.create_connection(host=host, user=user)
+    dead_client = Mock(get_transport=Mock(return_value=None))
+    monkeypatch.setattr(conn, "client", dead_client)
+    conn._client_load = {dead_client: 0}
+    connected = threading.Event()
+    new_client = Mock()
+    new_client.connect.side_effect = lambda *args, **kwargs: connected.wait(2)
+    new_client.get_transport.return_value.open_session.return_value = FakeChannel(stdout="up\n")
+    monkeypatch.setattr(ParamikoModel, "__create_initialized_client__", Mock(return_value=new_client))
+
+    result = model.execute(command="uptime", connection=conn)
+    assert not result.result_available  # queued till the transport is back
+    connected.set()
+    assert result.wait_for_data(2)
+    assert result.stdout == ["up"]
+    assert dead_client not in conn._client_load  # load of the replaced client is dropped
+
+
+class ShellChannel(FakeChannel):
+    """
+    Channel running a local shell, its descriptor is always readable
+    """
+
+    def __init__(self):
+        super(ShellChannel, self).__init__()
+        self.eof_received = False
+        self.__lock = threading.Lock()
+        self.shell = None
+        self.pumps = []
+
+    def exec_command(self, command):
+        self.command = command
+        # bash as the login shell replaces itself by a simple command, the printed pid is the one of the command
+        self.shell = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE, env=dict(os.environ, SHELL="/bin/bash"))
+        for stream, name in ((self.shell.stdout, "stdout"), (self.shell.stderr, "stderr")):
+            self.pumps.append(threading.Thread(target=self.__pump, args=(stream, name)))
+            self.pumps[-1].start()
+
+    def __pump(self, stream, name):
+        for line in iter(stream.readline, ""):
+            with self.__lock:
+                setattr(self, name, getattr(self, name) + line)
+
+    def recv(self, nbytes):
+        with self.__lock:
+            return super(ShellChannel, self).recv(nbytes)
+
+    def recv_stderr(self, nbytes):
+        with self.__lock:
+            return super(ShellChannel, self).recv_stderr(nbytes)
+
+    def sendall(self, data):
+        self.shell.stdin.write(data)
+        self.shell.stdin.flush()
+
+    def close(self):
+        self.closed = True
+        self.shell.stdin.close()
+
+
+@pytest.mark.timeout(10)
+def test_execute_in_session_mode(monkeypatch, model):
+    conn = model.create_connection(host=host, user=user)
+    conn.session_mode = True
+    channel = ShellChannel()
+    transport_mock = Mock()
+    transport_mock.open_session.return_value = channel
+    monkeypatch.setattr(conn.client, "get_transport", Mock(return_value=transport_mock))
+
+    results = [model.execute(command="echo %s; echo err%s >&2; exit %s" % (x, x, x), connection=conn)
+               for x in xrange(3)]
+    for x, result in enumerate(results):
+        assert result.wait_for_data(5)
+        assert (result.stdout, result.stderr, result.ecode) == (["%s" % x], ["err%s" % x], x)
+    assert transport_mock.open_session.call_count == 1
+    channel.close()
+
+
+def test_session_mode_rejects_priorities_and_kill(model):
+    conn = model.create_connection(host=host, user=user)
+    conn.session_mode = True
+    with pytest.raises(InvalidCommandValue):
+        model.execute(command=Command("uptime", priority=PRIORITY_LOW), connection=conn)
+    with pytest.raises(InvalidCommandValue):  # pid of commands of the session is not known
+        model.kill(model.create_command("sleep 100"))
+
+
+@pytest.mark.timeout(10)
+def test_reap_keeps_connection_with_running_session_command(monkeypatch, model):
+    conn = model.create_connection(host=host, user=user)
+    conn.session_mode = True
+    conn.connected = True
+    channel = ShellChannel()
+    transport_mock = Mock()
+    transport_mock.open_session.return_value = channel
+    monkeypatch.setattr(conn.client, "get_transport", Mock(return_value=transport_mock))
+
+    result = model.execute(command="sleep 0.5; echo done", connection=conn)
+    time.sleep(0.1)
+    assert model.reap_idle_connections(idle_timeout=0.05) == []  # the command outlives the idle timeout
+    assert result.wait_for_data(5)
+    assert (result.stdout, result.ecode, result.error) == (["done"], 0, None)
+    assert conn in Connection
+    channel.close()
+
+
+class ProcessChannel(ShellChannel):
+    """
+    Channel running a local command, it finishes with the command
+    """
+
+    def exec_command(self, command):
+        super(ProcessChannel, self).exec_command(command)
+        threading.Thread(target=self.__wait_for_eof).start()
+
+    def __wait_for_eof(self):
+        for pump in self.pumps:
+            pump.join()
+        self.eof_received = True
+
+    def exit_status_ready(self):
+        return self.shell.poll() is not None
+
+    def recv_exit_status(self):
+        return self.shell.wait()
+
+
+@pytest.mark.timeout(10)
+def test_kill_running_command(monkeypatch, model):
+    conn = model.create_connection(host=host, user=user)
+    transport_mock = Mock()
+    transport_mock.open_session.side_effect = lambda: ProcessChannel()
+    monkeypatch.setattr(conn.client, "get_transport", Mock(return_value=transport_mock))
+
+    result = model.execute(command=model.create_command("sleep 100", exclusive=True), connection=conn)
+    while result.cmd.pid is None:
+        time.sleep(0.01)
+    assert result.cmd.kill() == 0  # the kill is not blocked by the running exclusive command
+    assert result.wait_for_data(5)
+    assert (result.stdout, result.ecode) == ([], -signal.SIGTERM)
+
+
+@pytest.mark.timeout(5)
+def test_execute_uses_pre_opened_channels(monkeypatch, model):
+    monkeypatch.setattr(ParamikoModel, "max_channels", 4)
+    conn = model.create_connection(host=host, user=user)
+    conn.channel_pool_size = 2
+    conn.connected = True
+    gate = threading.Event()
+    gate.set()
+    opened = []
+    monkeypatch.setattr(conn.client, "get_transport", Mock(return_value=gated_transport(gate, opened)))
+
+    assert model.execute(command="first", connection=conn).wait_for_data(2)
+    while len(conn._channel_pool) < 2:
+        time.sleep(0.01)
+    assert len(opened) == 3
+    pooled = [channel for _, channel in conn._channel_pool]
+    assert model.execute(command="second", connection=conn).wait_for_data(2)
+    assert pooled[0].command == "second"
+    assert conn._channel_admission.limit == 2  # pooled channels count to the channel limit
+    while len(conn._channel_pool) < 2:
+        time.sleep(0.01)
+
+    model.close_connection(conn)
+    assert conn._channel_pool == []
+    assert sum(conn._client_load.values()) == 0
+
+
+@pytest.mark.timeout(5)
+def test_channel_pool_is_refilled_outside_of_dispatch_threads(monkeypatch, model):
+    monkeypatch.setattr(ParamikoModel, "max_channels", 4)
+    dispatch = Mock()
+    monkeypatch.setattr(ParamikoModel, "__run_dispatch__", dispatch)
+    conn = model.create_connection(host=host, user=user)
+    conn.connected = True
+    gate = threading.Event()
+    gate.set()
+    opened = []
+    monkeypatch.setattr(conn.client, "get_transport", Mock(return_value=gated_transport(gate, opened)))
+    assert model.__get_admission__(conn).limit == 4
+    conn.channel_pool_size = 2
+    assert model.__get_admission__(conn).limit == 2  # the limit follows the size of the pool
+
+    assert model.execute(command="first", connection=conn).wait_for_data(2)
+    while len(conn._channel_pool) < 2:
+        time.sleep(0.01)
+    assert not dispatch.called
+
+
+def test_connect_applies_transport_profile(monkeypatch, model):
+    profile = TransportProfile(ciphers=["aes256-ctr", "unknown-cipher"], compression=True, window_size=1048576)
+    conn = model.create_connection(host=Host("tuned"), user=user)
+    conn.host.transport_profile = profile
+    monkeypatch.setattr(conn, "client", Mock())
+    model.connect(conn)
+    kwargs = conn.client.connect.call_args[1]
+    assert kwargs["compress"] is True
+
+    sock, other = socket.socketpair()
+    transport = kwargs["transport_factory"](sock, gss_kex=False, gss_deleg_creds=True, disabled_algorithms=None)
+    try:
+        assert transport.get_security_options().ciphers[0] == "aes256-ctr"
+        assert "aes128-ctr" in transport.get_security_options().ciphers
+        assert transport.default_window_size == 1048576
+    finally:
+        sock.close()
+        other.close()
+
+    conn.client.get_transport.return_value.local_cipher = "aes256-ctr"
+    assert model.get_transport_info(conn)[0]["cipher"][0] == "aes256-ctr"
+
+
+def test_connect_uses_cached_key_and_agent(monkeypatch, model):
+    key = Mock()
+    load = Mock(return_value=key)
+    monkeypatch.setattr(key_cache, "load", load)
+    key_user = User("key_user", key_filename="~/.ssh/id_ed25519", passphrase="secret")
+    conn = model.create_connection(host=host, user=key_user)
+    monkeypatch.setattr(conn, "client", Mock())
+    model.connect(conn)
+    load.assert_called_with("~/.ssh/id_ed25519", "secret")
+    kwargs = conn.client.connect.call_args[1]
+    assert (kwargs["pkey"], kwargs["allow_agent"], kwargs["look_for_keys"]) == (key, True, False)
+    assert conn.client._agent.agent is key_cache.agent() and conn.client._agent.keys == ()
+
+
+def test_connect_offers_cached_default_keys(monkeypatch, model):
+    key = Mock()
+    default_keys = Mock(return_value=[key])
+    monkeypatch.setattr(key_cache, "default_keys", default_keys)
+    conn = model.create_connection(host=host, user=User("default_key_user", password="pass", allow_agent=False))
+    monkeypatch.setattr(conn, "client", Mock())
+    model.connect(conn)
+    default_keys.assert_called_with("pass")  # paramiko uses the password as the passphrase too
+    kwargs = conn.client.connect.call_args[1]
+    assert (kwargs["pkey"], kwargs["allow_agent"], kwargs["look_for_keys"]) == (None, True, False)
+    assert conn.client._agent.agent is None
+    assert conn.client._agent.get_keys() == (key,)
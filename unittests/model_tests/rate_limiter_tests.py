@@ -0,0 +1,47 @@
+import time
+
+import pytest
+
+from models.rate_limiter import HandshakeLimiter, TokenBucket
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=100, burst=2)
+    start = time.time()
+    for _ in xrange(6):
+        assert bucket.acquire()
+    assert time.time() - start >= 0.035  # burst of 2, the rest is limited to 100 per second
+
+
+def test_token_bucket_acquire_timeout():
+    bucket = TokenBucket(rate=1)
+    assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0.01)
+
+
+def test_token_bucket_raises_invalid_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+
+
+def test_handshake_limiter_per_subnet():
+    limiter = HandshakeLimiter(host_rate=1, subnet_prefix=24)
+    assert limiter.key("10.0.1.17") == "10.0.1.0/24"
+    assert limiter.key("example.com") == "example.com"
+    assert limiter.acquire("10.0.1.17", timeout=0)
+    assert not limiter.acquire("10.0.1.18", timeout=0)  # same subnet
+    assert limiter.acquire("10.0.2.18", timeout=0)
+
+
+def test_handshake_limiter_global():
+    limiter = HandshakeLimiter(rate=1)
+    assert limiter.acquire("first", timeout=0)
+    assert not limiter.acquire("second", timeout=0)
+
+
+def test_handshake_limiter_returns_host_token():
+    limiter = HandshakeLimiter(rate=20, burst=1, host_rate=1)
+    assert limiter.acquire("first", timeout=0)
+    assert not limiter.acquire("second", timeout=0)  # global rate exceeded, token of the host is returned
+    time.sleep(0.06)
+    assert limiter.acquire("second", timeout=0)
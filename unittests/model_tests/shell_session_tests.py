@@ -0,0 +1,107 @@
+import subprocess
+import threading
+import time
+
+import pytest
+
+from executor_exceptions import SessionClosed, WaitTimeout
+from models.shell_session import SessionEntry, ShellSession
+
+
+class FakeChannel(object):
+    """
+    Channel recording the written script
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+def collect(entry, stream):
+    storage = []
+    entry.reader(stream)(storage)()
+    return "".join(storage)
+
+
+def test_session_demultiplexes_output():
+    session = ShellSession(FakeChannel())
+    first, second = SessionEntry(), SessionEntry()
+    session.submit("echo a", first)
+    session.submit("echo b", second)
+    assert len(session) == 2
+    output = "a\n%s 0 0\nb%s 1 7\n" % (session.token, session.token)
+    for char in output:  # markers split to many chunks
+        session.feed_stdout(char)
+    session.feed_stderr("err%s 0\n%s 1\n" % (session.token, session.token))
+    assert (first.finished, first.ecode, collect(first, "stdout"), collect(first, "stderr")) == (True, 0, "a\n", "err")
+    assert (second.finished, second.ecode, collect(second, "stdout")) == (True, 7, "b")
+    assert len(session) == 0
+
+
+def test_session_notifies_entries():
+    session = ShellSession(FakeChannel())
+    updates = []
+    entry = SessionEntry(on_update=lambda: updates.append(entry.finished))
+    session.submit("true", entry)
+    session.feed_stdout("%s 0 0\n" % session.token)
+    session.feed_stderr("%s 0\n" % session.token)
+    assert updates == [False, True]
+
+
+def test_session_fail_finishes_pending_entries():
+    closed = []
+    session = ShellSession(FakeChannel(), on_close=lambda: closed.append(True))
+    entry = SessionEntry()
+    session.submit("sleep 100", entry)
+    session.fail(SessionClosed("test"))
+    assert entry.finished and isinstance(entry.error, SessionClosed)
+    assert closed == [True]
+    with pytest.raises(SessionClosed):
+        session.submit("true", SessionEntry())
+
+
+@pytest.mark.timeout(10)
+def test_session_frames_commands_for_shell():
+    shell = subprocess.Popen([ShellSession.shell], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+    channel = FakeChannel()
+    channel.sendall = lambda data: (shell.stdin.write(data), shell.stdin.flush())
+    session = ShellSession(channel)
+    commands = ["printf 'no line break'", "echo err >&2; exit 3", "cat", "echo 'unbalanced", "echo still alive"]
+    entries = [SessionEntry() for _ in commands]
+    for command, entry in zip(commands, entries):
+        session.submit(command, entry)
+    shell.stdin.close()
+    readers = [threading.Thread(target=lambda: [session.feed_stdout(line) for line in iter(shell.stdout.readline, "")]),
+               threading.Thread(target=lambda: [session.feed_stderr(line) for line in iter(shell.stderr.readline, "")])]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    shell.wait()
+    assert all(entry.finished for entry in entries)
+    ecodes = [entry.ecode for entry in entries]
+    assert ecodes[:3] == [0, 3, 0] and ecodes[4] == 0
+    assert ecodes[3] != 0  # malformed command fails alone, it does not swallow following sentinels
+    assert [collect(entry, "stdout") for entry in entries] == ["no line break", "", "", "", "still alive\n"]
+    assert collect(entries[1], "stderr") == "err\n"
+
+
+@pytest.mark.timeout(5)
+def test_session_fails_when_command_exceeds_timeout():
+    closed = threading.Event()
+    session = ShellSession(FakeChannel(), on_close=closed.set, timeout=0.2)
+    first, second = SessionEntry(), SessionEntry()
+    session.submit("true", first)
+    session.submit("sleep 100", second)
+    time.sleep(0.15)
+    session.feed_stdout("%s 0 0\n" % session.token)  # the timeout of the second command starts now
+    session.feed_stderr("%s 0\n" % session.token)
+    time.sleep(0.1)
+    assert not session.closed
+    assert closed.wait(2)
+    assert first.error is None and first.ecode == 0
+    assert isinstance(second.error, WaitTimeout)
@@ -0,0 +1,87 @@
+import os
+import threading
+
+import pytest
+
+from models.stream_reactor import StreamReactor
+
+
+@pytest.fixture(scope="module")
+def reactor():
+    return StreamReactor(name="test-reactor")
+
+
+class PipeSource(object):
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+
+    def fileno(self):
+        return self.read_fd
+
+    def feed(self, data):
+        os.write(self.write_fd, data)
+
+    def read(self):
+        return os.read(self.read_fd, 4096)
+
+
+@pytest.mark.timeout(5)
+def test_register_calls_callback_on_readiness(reactor):
+    source = PipeSource()
+    received = []
+    done = threading.Event()
+
+    def callback():
+        data = source.read()
+        received.append(data)
+        if data.endswith("end"):
+            done.set()
+            return StreamReactor.DONE
+        return StreamReactor.POLL
+
+    source.feed("start")
+    reactor.register(source, callback)
+    source.feed("end")
+    assert done.wait(2)
+    assert "".join(received) == "startend"
+
+
+@pytest.mark.timeout(5)
+def test_linger_calls_callback_till_done(reactor):
+    source = PipeSource()
+    calls = []
+    done = threading.Event()
+
+    def callback():
+        calls.append(None)
+        if len(calls) < 3:
+            return StreamReactor.LINGER
+        done.set()
+        return StreamReactor.DONE
+
+    reactor.register(source, callback)
+    assert done.wait(2)
+    assert len(calls) == 3
+
+
+test_data = [("invalid_source", None), (PipeSource(), ValueError("callback failure"))]
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize("source, exception", test_data, ids=["invalid_source", "callback_raises"])
+def test_error_callback(reactor, source, exception):
+    errors = []
+    done = threading.Event()
+
+    def callback():
+        raise exception
+
+    def error_callback(exc):
+        errors.append(exc)
+        done.set()
+
+    reactor.register(source, callback, error_callback)
+    assert done.wait(2)
+    assert len(errors) == 1
+    if exception is not None:
+        assert errors[0] is exception
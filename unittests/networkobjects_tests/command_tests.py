@@ -13,3 +13,22 @@ def test_kill_raises_missing_function_definition():
     with pytest.raises(MissingFunctionDefinition):
         cmd = Command(command="cmd")
         cmd.kill()
+
+
+test_data = [dict(capture="invalid"), dict(capture="head"), dict(capture="tail", capture_limit=-1)]
+
+
+@pytest.mark.parametrize("kwargs", test_data, ids=["invalid_policy", "missing_limit", "negative_limit"])
+def test_command_init_raises_invalid_capture(kwargs):
+    with pytest.raises(InvalidCommandValue):
+        Command(command="cmd", **kwargs)
+
+
+def test_command_init_raises_invalid_dependency():
+    with pytest.raises(InvalidCommandValue):
+        Command("test", depends_on=["first"])
+
+
+def test_command_init_raises_invalid_priority():
+    with pytest.raises(InvalidCommandValue):
+        Command("test", priority="high")
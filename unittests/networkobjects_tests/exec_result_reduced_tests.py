@@ -0,0 +1,28 @@
+import pickle
+
+from mock import Mock
+
+from networkobjects.command import Command
+from networkobjects.connection import Connection
+from networkobjects.exec_result import ExecResult
+from networkobjects.exec_result_reduced import ReducedExecResult
+from networkobjects.host import Host
+from networkobjects.user import User
+
+
+def test_reduced_exec_result_is_picklable():
+    conn = Connection(host=Host(), user=User(), client="empty")
+    reader = Mock(side_effect=lambda storage: (storage.append("out\n"), Mock(return_value=True))[1])
+    result = ExecResult(Command("test"), Mock(return_value=3), reader, reader, conn)
+    result._finalize()
+    reduced = ReducedExecResult.from_result(result)
+    assert reduced.connection == conn
+
+    reduced = pickle.loads(pickle.dumps(reduced))
+    assert (reduced.cmd, reduced.stdout, reduced.stderr, reduced.ecode) == ("test", ["out"], ["out"], 3)
+    assert reduced.time == result.time
+    assert reduced.connection is None
+    assert reduced.wait_for_data()
+    done = []
+    reduced.add_done_callback(done.append)
+    assert done == [reduced]
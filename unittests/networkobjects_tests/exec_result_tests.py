@@ -1,3 +1,4 @@
+import threading
 import time
 
 import pytest
@@ -53,19 +54,151 @@ def test_time_property_returns(monkeypatch, exec_result, ts_start, ts_stop, expe
     assert exec_result.time == expected_result
 
 
+def mock_reader(output):
+    # exec result calls these functions with its own storage, reader fills it and reports the end of the stream
+    def receive_func(output_data):
+        def reader():
+            output_data.append(output)
+            return True
+
+        return reader
+
+    return receive_func
+
+
 @pytest.mark.timeout(5)
 def test_wait_for_data(monkeypatch):
     stop_t = time.time()
-    # exec result calls these functions with its own arguments, that is why is there lambda
-    mock_stdout = Mock(return_value=lambda: "std_out")
-    mock_stderr = Mock(return_value=lambda: "std_err")
     mock_exit_func = Mock(return_value="0")
     mock_time = Mock(return_value=stop_t)
     monkeypatch.setattr(time, "time", mock_time)
     conn = model.create_connection(Host(), User())
-    result = ExecResult(Command("test"), mock_exit_func, mock_stdout, mock_stderr, conn)
+    result = ExecResult(Command("test"), mock_exit_func, mock_reader("std_out"), mock_reader("std_err"), conn)
+    assert result._fetch_streams()
+    result._finalize()
     result.wait_for_data()
     assert result.ts_stop == stop_t
-    assert result._stdout == mock_stdout()()
-    assert result._stderr == mock_stderr()()
+    assert result._stdout == ["std_out"]
+    assert result._stderr == ["std_err"]
     assert result.ecode == mock_exit_func()
+
+
+@pytest.mark.timeout(5)
+def test_wait_for_data_blocks_till_finalized():
+    conn = model.create_connection(Host(), User())
+    result = ExecResult(Command("test"), Mock(return_value=0), mock_reader("out"), mock_reader("err"), conn)
+    result._fetch_streams()
+    timer = threading.Timer(0.1, result._finalize)
+    timer.start()
+    result.wait_for_data()
+    assert result.result_available
+    assert result.ecode == 0
+
+
+def test_finalize_without_exit_status():
+    mock_exit_func = Mock()
+    conn = model.create_connection(Host(), User())
+    result = ExecResult(Command("test"), mock_exit_func, mock_reader("out"), mock_reader("err"), conn)
+    result._finalize(exit_status=False)
+    assert result.result_available
+    assert result.ecode is None
+    assert not mock_exit_func.called
+
+
+def test_stdout_partial_view_joins_chunks():
+    conn = model.create_connection(Host(), User())
+    receive_stdout = Mock(side_effect=lambda output_data: Mock(return_value=False))
+    result = ExecResult(Command("test"), Mock(return_value=0), receive_stdout, mock_reader("err"), conn)
+    result.stdout_storage.append("li")
+    result.stdout_storage.append("ne1\nli")
+    assert result.stdout == ["line1", "li"]
+    result.stdout_storage.append("ne2\n")
+    assert result.stdout == ["line1", "line2"]
+    result._finalize()
+    assert result.stdout == ["line1", "line2"]
+
+
+@pytest.mark.timeout(5)
+def test_wait_for_data_timeout():
+    conn = model.create_connection(Host(), User())
+    result = ExecResult(Command("test"), Mock(return_value=0), mock_reader("out"), mock_reader("err"), conn)
+    assert not result.wait_for_data(timeout=0.05)
+    result._finalize()
+    assert result.wait_for_data(timeout=0.05)
+
+
+@pytest.mark.timeout(5)
+def test_iter_stdout_yields_lines_as_they_arrive():
+    conn = model.create_connection(Host(), User())
+    receive_stdout = Mock(side_effect=lambda output_data: Mock(return_value=False))
+    result = ExecResult(Command("test"), Mock(return_value=0), receive_stdout, mock_reader("err"), conn)
+    lines = result.iter_stdout()
+    result.stdout_storage.append("line1\nli")
+    result.stdout_storage.append("ne2\r")
+    result._fetch_streams()
+    assert next(lines) == "line1"
+    result.stdout_storage.append("\nline3\n")
+    result.stdout_storage.append("last")
+    result._fetch_streams()
+    assert next(lines) == "line2"
+    assert next(lines) == "line3"
+    threading.Timer(0.1, result._finalize).start()
+    assert list(lines) == ["last"]
+
+
+def test_iter_stderr_after_result_available():
+    conn = model.create_connection(Host(), User())
+    result = ExecResult(Command("test"), Mock(return_value=0), mock_reader("out"), mock_reader("e1\ne2"), conn)
+    result._fetch_streams()
+    result._finalize()
+    assert list(result.iter_stderr()) == ["e1", "e2"]
+
+
+@pytest.mark.timeout(5)
+def test_spilled_output():
+    conn = model.create_connection(Host(), User())
+    result = ExecResult(Command("test"), Mock(return_value=0), mock_reader("line1\nline2\nline3"), mock_reader(""),
+                        conn, spill_threshold=8)
+    result._fetch_streams()
+    result._finalize()
+    assert result.stdout_storage.spilled
+    assert not result.stderr_storage.spilled
+    assert result.stdout == ["line1", "line2", "line3"]
+    assert list(result.iter_stdout()) == ["line1", "line2", "line3"]
+    result.close()  # the temporary file is freed
+    assert not result.stdout_storage.spilled
+    assert list(result.stdout) == []
+
+
+def test_add_done_callback():
+    conn = model.create_connection(Host(), User())
+    result = ExecResult(Command("test"), Mock(return_value=0), mock_reader("out"), mock_reader("err"), conn)
+    before, after, removed = Mock(), Mock(), Mock()
+    result.add_done_callback(before)
+    result.add_done_callback(removed)
+    assert result.remove_done_callback(removed)
+    assert not result.remove_done_callback(removed)
+    assert not before.called
+    result._finalize()
+    before.assert_called_once_with(result)
+    assert not removed.called
+    result.add_done_callback(after)
+    after.assert_called_once_with(result)
+
+
+@pytest.mark.timeout(5)
+def test_concurrent_finalize_runs_once():
+    conn = model.create_connection(Host(), User())
+    exit_status = Mock(side_effect=lambda: time.sleep(0.1) or 0)
+    result = ExecResult(Command("test"), exit_status, mock_reader("out"), mock_reader("err"), conn)
+    callback = Mock()
+    result.add_done_callback(callback)
+    result._fetch_streams()
+    finalizers = [threading.Thread(target=result._finalize) for _ in xrange(4)]
+    for finalizer in finalizers:
+        finalizer.start()
+    for finalizer in finalizers:
+        finalizer.join()
+    assert exit_status.call_count == 1
+    callback.assert_called_once_with(result)
+    assert (result.stdout, result.ecode) == (["out"], 0)
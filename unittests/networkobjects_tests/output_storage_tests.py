@@ -0,0 +1,111 @@
+import os
+
+import pytest
+
+from networkobjects.command import CAPTURE_DISCARD, CAPTURE_HEAD, CAPTURE_TAIL
+from networkobjects.output_storage import LineSplitter, MappedLines, OutputStorage
+
+test_data = [None, 4]
+
+
+def create_storage(spill_threshold, chunks):
+    storage = OutputStorage(spill_threshold=spill_threshold)
+    for chunk in chunks:
+        storage.append(chunk)
+    return storage
+
+
+@pytest.mark.parametrize("spill_threshold", test_data, ids=["memory", "spilled"])
+def test_storage_read(spill_threshold):
+    storage = create_storage(spill_threshold, ["abc", "def", "ghi"])
+    assert len(storage) == 9
+    assert storage.spilled == (spill_threshold is not None)
+    assert storage.getvalue() == "abcdefghi"
+    assert storage.read(2, 5) == "cdefg"
+    assert storage.read(7) == "hi"
+    assert storage.read(9) == ""
+    assert storage[1:4] == "bcd"
+    assert storage[-1] == "i"
+    for item in (slice(None, None, -1), slice(7, 1, -2), slice(1, None, 3), slice(2, 2, -1)):
+        assert storage[item] == "abcdefghi"[item]
+
+
+@pytest.mark.parametrize("spill_threshold", test_data, ids=["memory", "spilled"])
+def test_storage_lines(spill_threshold):
+    storage = create_storage(spill_threshold, ["line1\nli", "ne2\r", "\nline3"])
+    storage.close()
+    lines = storage.lines()
+    assert isinstance(lines, MappedLines if spill_threshold else list)
+    assert lines == ["line1", "line2", "line3"]
+    assert len(lines) == 3
+    assert lines[1] == "line2"
+    assert lines[-1] == "line3"
+    assert lines[1:] == ["line2", "line3"]
+
+
+@pytest.mark.parametrize("spill_threshold", test_data, ids=["memory", "spilled"])
+def test_storage_search(spill_threshold):
+    storage = create_storage(spill_threshold, ["error: 1\n", "ok\n", "error: 2\n"])
+    assert [match.group(1) for match in storage.search(r"error: (\d)")] == ["1", "2"]
+
+
+def test_storage_spills_when_threshold_exceeded():
+    storage = create_storage(10, ["12345"])
+    assert not storage.spilled
+    storage.append("678901")
+    assert storage.spilled
+    storage.append("2")
+    assert storage.getvalue() == "123456789012"
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="descriptors are counted via /proc")
+def test_storage_release_closes_file_and_mappings():
+    before = len(os.listdir("/proc/self/fd"))
+    storage = OutputStorage(spill_threshold=4)
+    for x in xrange(20):  # every read of the grown output maps it again
+        storage.append("line %s\n" % x)
+        assert storage.read(0, 4) == "line"
+    assert storage.spilled
+    assert len(os.listdir("/proc/self/fd")) <= before + 2  # the file and one mapping
+    storage.release()
+    assert len(os.listdir("/proc/self/fd")) == before
+    assert not storage.spilled and len(storage) == 0
+
+
+test_data = [(None, CAPTURE_HEAD, "1234"), (4, CAPTURE_HEAD, "1234"), (None, CAPTURE_TAIL, "7890"),
+             (None, CAPTURE_DISCARD, "")]
+
+
+@pytest.mark.parametrize("spill_threshold, capture, expected", test_data,
+                         ids=["head", "head_spilled", "tail", "discard"])
+def test_storage_capture(spill_threshold, capture, expected):
+    storage = OutputStorage(spill_threshold=spill_threshold, capture=capture, capture_limit=4)
+    for chunk in ["12", "345", "6", "7890"]:
+        storage.append(chunk)
+    assert storage.getvalue() == expected
+    assert storage.received == 10
+    assert storage.truncated
+
+
+def test_storage_tail_read_from_dropped_position():
+    storage = OutputStorage(capture=CAPTURE_TAIL, capture_limit=4)
+    storage.append("line1\nline2\n")
+    assert storage.end == 12
+    assert storage.read_from(0) == (8, "ne2\n")
+    assert storage.lines() == ["ne2"]
+
+
+test_data = [(["a\nb", "c\n"], ["a\n", "bc\n"], []),
+             (["a", "b", "", "c\nd"], ["abc\n"], ["d"]),
+             (["a\r", "\nb\r"], ["a\r\n"], ["b\r"]),
+             (["a\rb"], ["a\r"], ["b"])]
+
+
+@pytest.mark.parametrize("chunks, lines, rest", test_data, ids=["split_line", "long_line", "crlf_split", "cr"])
+def test_line_splitter(chunks, lines, rest):
+    splitter = LineSplitter()
+    output = []
+    for chunk in chunks:
+        output.extend(splitter.feed(chunk))
+    assert output == lines
+    assert splitter.flush() == rest
@@ -0,0 +1,26 @@
+import pytest
+
+from networkobjects.transport_profile import TransportProfile
+from executor_exceptions import *
+
+test_data = [dict({"ciphers": "aes128-ctr"}),
+             dict({"digests": [1]}),
+             dict({"compression": "yes"}),
+             dict({"window_size": 0}),
+             dict({"max_packet_size": "32768"})
+             ]
+
+
+@pytest.mark.parametrize("data", test_data,
+                         ids=["ciphers_string", "digests_not_names", "compression_not_bool",
+                              "window_size_not_positive", "max_packet_size_not_integer"])
+def test_transport_profile_raises(data):
+    with pytest.raises(InvalidTransportProfile):
+        TransportProfile(**data)
+
+
+def test_transport_profile():
+    profile = TransportProfile(ciphers=["aes128-ctr"], compression=True, window_size=1024)
+    assert profile.ciphers == ("aes128-ctr",)
+    assert profile.digests is None
+    assert repr(profile) == "TransportProfile(ciphers=('aes128-ctr',), compression=True, window_size=1024)"
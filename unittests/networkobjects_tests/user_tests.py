@@ -44,3 +44,14 @@ def test_user_generate_id_protected():
     gen_id = User._generate_id(username=username, password=password)
     assert user.id == gen_id
     assert gen_id == sim_id
+
+
+def test_user_key_authentication():
+    user = User(username="key_user", key_filename="~/.ssh/id_rsa", passphrase="secret", allow_agent=False)
+    assert (user.key_filename, user.passphrase, user.allow_agent) == ("~/.ssh/id_rsa", "secret", False)
+    assert user.id == User.generate_id(username="key_user", password=None, key_filename="~/.ssh/id_rsa",
+                                       passphrase="secret", allow_agent=False)
+    assert User(username="key_user").key_filename is None  # key settings are part of the id
+    assert User(username="key_user", key_filename="/k").key_filename == "/k"
+    with pytest.raises(InvalidUserException):
+        User(username="key_user", key_filename=1)